@@ -0,0 +1,201 @@
+import asyncio
+import logging
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+from postgrest import ReturnMethod
+from supabase import PostgrestAPIError
+
+import backend.config as config
+import backend.services as services
+from backend.database import get_async_supabase
+
+logger = logging.getLogger(__name__)
+
+# Activity types the dashboard knows (activities.type check constraint)
+MESSAGE, BOT_RESPONSE = 'message', 'bot_response'
+
+class AnalyticsSink:
+    """Write-behind aggregation of dashboard analytics.
+
+    record() only updates in-memory aggregates: a message-count delta per
+    (bot, chat) for the conversations table, and a count per (company, bot,
+    activity type) for activities. A background task flushes them every
+    flush_interval seconds: one increment_message_counts RPC for all the
+    conversation deltas, and one bulk upsert with a single summarized
+    activity per (company, bot, type) ("12 new messages from 5 customers").
+    A failed flush merges its deltas back so the next one retries them;
+    what is still pending at shutdown after a last flush is lost (these are
+    dashboard counters, not billing).
+    """
+
+    def __init__(self, flush_interval: float = 5.0, max_pending: int = 100000):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.events_recorded = 0
+        self.events_dropped = 0
+        self.conversation_rows = 0
+        self.activity_rows = 0
+        self.flushes = 0
+        self.errors = 0
+        self._batch_rpc = True  # False once the database turns out not to have increment_message_counts
+        # (bot id, chat id) -> [messages, last message at]
+        self._counts: Dict[Tuple[str, str], list] = {}
+        # (company id, bot id, type) -> [events, chat ids, owner user id, bot name]
+        self._activities: Dict[Tuple[str, Optional[str], str], list] = {}
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    def record(self, kind: str, company: Dict[str, Any], bot_id: Optional[str], bot_name: Optional[str],
+               chat_id: Any) -> None:
+        """Counts one customer message or bot response. Never blocks on the database."""
+        if len(self._counts) >= self.max_pending and (bot_id, str(chat_id)) not in self._counts:
+            # Keep memory bounded while the database is unreachable
+            self.events_dropped += 1
+            return
+        now = datetime.now(timezone.utc).isoformat()
+        if bot_id:
+            # conversations rows belong to a bot; legacy company-token bots only get activities
+            counts = self._counts.setdefault((bot_id, str(chat_id)), [0, now])
+            counts[0] += 1
+            counts[1] = now
+        if company.get('user_id'):
+            activity = self._activities.setdefault((company['id'], bot_id, kind),
+                                                   [0, set(), company['user_id'], bot_name])
+            activity[0] += 1
+            activity[1].add(str(chat_id))
+        self.events_recorded += 1
+
+    def _take(self) -> Tuple[Dict[Tuple[str, str], list], Dict[Tuple[str, Optional[str], str], list]]:
+        counts, activities = self._counts, self._activities
+        self._counts, self._activities = {}, {}
+        return counts, activities
+
+    def _merge_back(self, counts: Dict[Tuple[str, str], list],
+                    activities: Dict[Tuple[str, Optional[str], str], list]) -> None:
+        """Returns the deltas of a failed flush to the aggregates, to retry on the next flush."""
+        for key, (messages, last_at) in counts.items():
+            current = self._counts.setdefault(key, [0, last_at])
+            current[0] += messages
+            current[1] = max(current[1], last_at)
+        for key, (events, chats, owner, bot_name) in activities.items():
+            current = self._activities.setdefault(key, [0, set(), owner, bot_name])
+            current[0] += events
+            current[1] |= chats
+
+    @staticmethod
+    def _describe(kind: str, events: int, customers: int) -> str:
+        if kind == MESSAGE:
+            return (f"{events} new message{'s' if events != 1 else ''} from "
+                    f"{customers} customer{'s' if customers != 1 else ''}")
+        return f"{events} answer{'s' if events != 1 else ''} sent to {customers} customer{'s' if customers != 1 else ''}"
+
+    def _activity_rows(self, activities: Dict[Tuple[str, Optional[str], str], list]) -> List[Dict[str, Any]]:
+        now = datetime.now(timezone.utc).isoformat()
+        return [{
+            'user_id': owner,
+            'company_id': company_id,
+            'type': kind,
+            'description': self._describe(kind, events, len(chats)),
+            'metadata': {'botId': bot_id, 'botName': bot_name, 'count': events, 'customers': len(chats)},
+            'created_at': now
+        } for (company_id, bot_id, kind), (events, chats, owner, bot_name) in activities.items()]
+
+    async def _write_counts(self, counts: Dict[Tuple[str, str], list]) -> None:
+        rows = [{'bot_id': bot_id, 'user_id': chat_id, 'count': messages, 'last_message_at': last_at}
+                for (bot_id, chat_id), (messages, last_at) in counts.items()]
+        if self._batch_rpc:
+            supabase = await get_async_supabase()
+            try:
+                await supabase.rpc('increment_message_counts', {'p_counts': rows}).execute()
+                return
+            except PostgrestAPIError as e:
+                if e.code != 'PGRST202':  # function not found: the schema predates it
+                    raise
+                logger.warning("increment_message_counts is missing, falling back to one RPC per conversation")
+                self._batch_rpc = False
+        for key, row in zip(list(counts), rows):
+            if await services.increment_message_count(row['bot_id'], row['user_id'], row['count']) is None:
+                raise RuntimeError("increment_message_count failed")
+            del counts[key]  # applied: not retried if a later row fails
+
+    async def _write_activities(self, rows: List[Dict[str, Any]]) -> None:
+        supabase = await get_async_supabase()
+        await supabase.table('activities').insert(rows, returning=ReturnMethod.minimal).execute()
+
+    async def flush(self) -> int:
+        """Writes the pending deltas. Returns the number of rows written."""
+        async with self._lock:
+            counts, activities = self._take()
+            if not counts and not activities:
+                return 0
+            written = 0
+            try:
+                if counts:
+                    conversations = len(counts)
+                    await self._write_counts(counts)
+                    written += conversations
+                    self.conversation_rows += conversations
+                    counts = {}
+                if activities:
+                    rows = self._activity_rows(activities)
+                    await self._write_activities(rows)
+                    written += len(rows)
+                    self.activity_rows += len(rows)
+                    activities = {}
+            except PostgrestAPIError as e:
+                self.errors += 1
+                logger.error(f"Database error writing analytics: {e}")
+                self._merge_back(counts, activities)
+            except Exception as e:
+                self.errors += 1
+                logger.error(f"Unexpected error writing analytics: {e}")
+                self._merge_back(counts, activities)
+            if written:
+                self.flushes += 1
+                logger.info(f"Wrote {written} analytics rows")
+            return written
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                self.errors += 1
+                logger.error(f"Unexpected error flushing analytics: {e}")
+
+    def start(self) -> None:
+        """Starts the periodic flush task."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stops the flush task and writes what is still pending."""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    def stats(self) -> Dict[str, Any]:
+        """Sink counters for the /metrics endpoint."""
+        return {
+            'pending_conversations': len(self._counts),
+            'pending_activities': len(self._activities),
+            'events_recorded': self.events_recorded,
+            'events_dropped': self.events_dropped,
+            'conversation_rows_written': self.conversation_rows,
+            'activity_rows_written': self.activity_rows,
+            'flushes': self.flushes,
+            'errors': self.errors
+        }
+
+analytics_sink = AnalyticsSink(
+    flush_interval=config.ANALYTICS_FLUSH_INTERVAL,
+    max_pending=config.ANALYTICS_MAX_PENDING
+)
@@ -0,0 +1,1193 @@
+#!/usr/bin/env python3
+"""
+BotAI Backend - Offline Benchmarks
+==================================
+Benchmarks for the webhook pipeline that run entirely on a laptop.
+
+Supabase, Gemini and the Telegram Bot API are replaced by in-process
+fakes that only simulate their network latency, so the numbers measure
+the backend's own scheduling overhead and how well it overlaps I/O.
+
+The concurrency benchmark reports two rows per level: how fast the
+webhook acknowledges Telegram, and how fast the background workers
+finish processing the queued updates.
+
+Usage:
+    python3 backend/benchmark.py concurrency [--requests 500] [--latency-ms 50]
+    python3 backend/benchmark.py retrieval [--top-k 4] [--embeddings hashing]
+    python3 backend/benchmark.py telegram [--requests 500] [--concurrency 20]
+    python3 backend/benchmark.py streaming [--requests 20] [--first-token-ms 400]
+    python3 backend/benchmark.py tokens  (needs GOOGLE_API_KEY for the Gemini column)
+    python3 backend/benchmark.py cache [--messages 1000] [--similarity 0.75]
+    python3 backend/benchmark.py context-cache [--messages 50] [--kb-tokens 40000]
+    python3 backend/benchmark.py routing [--full-ms 1200] [--small-ms 350]
+    python3 backend/benchmark.py coalescing [--identical 200] [--spread-ms 3000]
+    python3 backend/benchmark.py resilience [--rate 50] [--seconds 10]
+    python3 backend/benchmark.py bulkheads [--noisy 2000] [--quiet-rate 20]
+    python3 backend/benchmark.py memory [--turns 40] [--history-tokens 400]
+    python3 backend/benchmark.py analytics [--messages 2000] [--chats 300]
+    python3 backend/benchmark.py dedup [--updates 300] [--redelivery 0.3]
+    python3 backend/benchmark.py polling [--bots 5] [--rate 1000]
+    python3 backend/benchmark.py webhooks [--bots 1000] [--probes 500]
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+# The benchmark never talks to real services, but config/database validate these on import
+os.environ.setdefault("GOOGLE_API_KEY", "benchmark")
+os.environ.setdefault("TELEGRAM_WEBHOOK_SECRET", "benchmark")
+os.environ.setdefault("SUPABASE_URL", "https://benchmark.supabase.co")
+os.environ.setdefault("SUPABASE_KEY", "eyJhbGciOiJIUzI1NiJ9.e30.benchmark")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+os.environ.setdefault("USAGE_COUNTER_BACKEND", "memory")
+os.environ.setdefault("LLM_PROVIDER", "stub")
+# Every simulated message asks the same question; keep the pipeline benchmark measuring the pipeline
+os.environ.setdefault("RESPONSE_CACHE_ENABLED", "false")
+# ...and all of it comes from one bot, which the per-tenant bulkhead would cap at its plan's share
+os.environ.setdefault("BULKHEAD_ENABLED", "false")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+
+BENCHMARK_TOKEN = "123456:BENCHMARK"
+
+def percentile(values, pct):
+    """Returns the pct-th percentile of a list of numbers"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+def print_row(label, total, elapsed, latencies):
+    """Print one line of benchmark results"""
+    print(
+        f"{label:<24} {total / elapsed:>10.1f} req/s   "
+        f"p50 {percentile(latencies, 50) * 1000:>8.1f} ms   "
+        f"p95 {percentile(latencies, 95) * 1000:>8.1f} ms"
+    )
+
+def install_fake_services(latency, model_latency):
+    """Replace every network-bound service call with a fake that only sleeps"""
+    import backend.services as services
+    import backend.tenant_context as tenant_context
+    from backend.llm_provider import StubProvider
+    from backend.webhook_router import webhook_router
+
+    async def fake_io(*args, **kwargs):
+        await asyncio.sleep(latency)
+
+    async def refresh_routes():
+        await fake_io()
+        return 0
+
+    async def fetch_tenant_context(token):
+        await fake_io()
+        return tenant_context.TenantContext(
+            bot_token=token,
+            company={'id': 'company-1', 'name': 'Benchmark Co'},
+            subscription={
+                'id': 'subscription-1',
+                'start_date': '2026-01-01T00:00:00+00:00',
+                'end_date': None,
+                'plans': {'name': 'Pro Plan', 'token_limit': 10 ** 12}
+            },
+            knowledge_documents=[{'id': 'kb-1', 'content': "Benchmark knowledge base."}]
+        )
+
+    async def fetch_total_usage(subscription_id, start_date, end_date):
+        await fake_io()
+        return 0
+
+    async def record_usage(subscription_id, tokens_used):
+        await fake_io()
+        return True
+
+    async def send_telegram_message(token, chat_id, text):
+        await fake_io()
+        return True
+
+    tenant_context._fetch_tenant_context = fetch_tenant_context
+    services.provider = StubProvider(latency=model_latency, output_tokens=42)
+    services.fetch_total_usage = fetch_total_usage
+    services.record_usage = record_usage
+    services.send_telegram_message = send_telegram_message
+    webhook_router.refresh = refresh_routes
+
+async def wait_for_drain(worker_pool):
+    """Wait until every queued update has been processed"""
+    while await worker_pool.queue.size() > 0 or worker_pool.in_flight > 0:
+        await asyncio.sleep(0.005)
+
+async def run_concurrency(args):
+    """Fire webhook requests at increasing concurrency and report throughput"""
+    model_latency = args.latency_ms if args.model_latency_ms is None else args.model_latency_ms
+    install_fake_services(args.latency_ms / 1000, model_latency / 1000)
+    from backend.main import app, worker_pool
+
+    transport = httpx.ASGITransport(app=app)
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+            print(f"Simulated per-call latency: {args.latency_ms} ms (model {model_latency} ms), "
+                  f"{args.requests} requests per level, "
+                  f"{worker_pool.concurrency} workers\n")
+            for concurrency in args.levels:
+                semaphore = asyncio.Semaphore(concurrency)
+                latencies = []
+
+                async def one_request(i):
+                    async with semaphore:
+                        payload = {'update_id': i, 'message': {'chat': {'id': i}, 'text': 'What are your shipping times?'}}
+                        started = time.perf_counter()
+                        response = await client.post(f"/webhook/{BENCHMARK_TOKEN}", json=payload)
+                        latencies.append(time.perf_counter() - started)
+                        response.raise_for_status()
+
+                started = time.perf_counter()
+                await asyncio.gather(*(one_request(i) for i in range(args.requests)))
+                print_row(f"ack  concurrency={concurrency}", args.requests, time.perf_counter() - started, latencies)
+                await wait_for_drain(worker_pool)
+                elapsed = time.perf_counter() - started
+                print(f"{'processed':<24} {args.requests / elapsed:>10.1f} msg/s   end-to-end {elapsed:.2f} s")
+
+class StubTelegramServer:
+    """Minimal keep-alive HTTP/1.1 server that answers Bot API calls like Telegram.
+
+    Bots whose token contains THROTTLED get a 429 with retry_after until
+    throttle_seconds have passed since their first call. With bot_limit set,
+    any bot sending more than that many messages in one second gets a 429.
+    getUpdates long-polls the updates appended to pending[token], dropping
+    those below the offset like Telegram does.
+    """
+
+    def __init__(self, latency, throttle_seconds=1, bot_limit=None):
+        self.latency = latency
+        self.throttle_seconds = throttle_seconds
+        self.bot_limit = bot_limit
+        self.connections = 0
+        self.rejected = 0
+        self.throttled_since = {}
+        self.recent_sends = {}
+        self.calls = []  # (time, method, chat_id)
+        self.pending = {}  # token -> updates not yet confirmed with an offset
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        return f"http://127.0.0.1:{self.server.sockets[0].getsockname()[1]}"
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def _get_updates(self, token, request):
+        updates = self.pending.setdefault(token, [])
+        deadline = time.monotonic() + request.get("timeout", 0)
+        while True:
+            updates[:] = [u for u in updates if u["update_id"] >= request.get("offset", 0)]
+            if updates or time.monotonic() >= deadline:
+                return updates[:request.get("limit", 100)]
+            await asyncio.sleep(0.005)
+
+    async def _handle(self, reader, writer):
+        import json
+        self.connections += 1
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode().partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                request = json.loads(await reader.readexactly(int(headers.get("content-length", 0))) or b"{}")
+                await asyncio.sleep(self.latency)
+
+                path = request_line.decode().split()[1]
+                self.calls.append((time.perf_counter(), path.rsplit("/", 1)[-1], request.get("chat_id")))
+                status, body = "200 OK", {"ok": True, "result": {"message_id": len(self.calls)}}
+                if path.endswith("/getUpdates"):
+                    body["result"] = await self._get_updates(path.split("/")[1][3:], request)
+                elif path.endswith("/deleteWebhook"):
+                    body["result"] = True
+                retry_after = 0
+                if "THROTTLED" in path:
+                    since = self.throttled_since.setdefault(path, time.monotonic())
+                    retry_after = self.throttle_seconds - (time.monotonic() - since)
+                elif self.bot_limit:
+                    recent = self.recent_sends.setdefault(path, [])
+                    now = time.monotonic()
+                    recent[:] = [t for t in recent if now - t < 1]
+                    if len(recent) >= self.bot_limit:
+                        retry_after = 1 - (now - recent[0])
+                    else:
+                        recent.append(now)
+                if retry_after > 0:
+                    self.rejected += 1
+                    status = "429 Too Many Requests"
+                    body = {"ok": False, "error_code": 429, "parameters": {"retry_after": round(retry_after, 3)}}
+                data = json.dumps(body).encode()
+                writer.write(
+                    f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\n"
+                    f"Content-Length: {len(data)}\r\nConnection: keep-alive\r\n\r\n".encode() + data
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            # Long polls still open at shutdown are cancelled
+            pass
+        finally:
+            writer.close()
+
+async def run_telegram(args):
+    """Compare a new connection per sendMessage with the pooled TelegramClient, then its pacing"""
+    import logging
+    from backend.telegram_client import TelegramClient
+
+    logging.getLogger("backend.telegram_client").setLevel(logging.ERROR)
+
+    stub = StubTelegramServer(args.latency_ms / 1000, throttle_seconds=args.throttle_seconds)
+    base_url = await stub.start()
+    print(f"Stub Telegram server at {base_url}, {args.latency_ms} ms per call, "
+          f"{args.requests} messages, concurrency {args.concurrency}\n")
+
+    async def fire(send, tokens):
+        semaphore = asyncio.Semaphore(args.concurrency)
+        latencies = {token: [] for token in tokens}
+
+        async def one(i):
+            token = tokens[i % len(tokens)]
+            async with semaphore:
+                started = time.perf_counter()
+                await send(token, i)
+                latencies[token].append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(args.requests)))
+        return time.perf_counter() - started, latencies
+
+    # 1. The old pattern: a fresh connection for every call, 429 handled by sleeping in the worker
+    async def send_fresh(token, i):
+        async with httpx.AsyncClient() as client:
+            for _ in range(3):
+                response = await client.post(f"{base_url}/bot{token}/sendMessage", json={"chat_id": i, "text": "hi"})
+                if response.status_code != 429:
+                    return
+                await asyncio.sleep(response.json()["parameters"]["retry_after"])
+
+    # Pacing off here, so these rows measure connection reuse and 429 handling only
+    client = TelegramClient(base_url=base_url, rate=1e9, burst=1e9)
+
+    async def send_pooled(token, i):
+        await client.send_message(token, i, "hi")
+
+    for label, send in (("new connection", send_fresh), ("pooled client", send_pooled)):
+        stub.connections = 0
+        elapsed, latencies = await fire(send, [BENCHMARK_TOKEN])
+        print_row(label, args.requests, elapsed, latencies[BENCHMARK_TOKEN])
+        print(f"{'':<24} {stub.connections:>10} TCP connections")
+
+    # 2. One bot is rate limited; the healthy bot's sends should not wait behind it
+    print(f"\nOne of two bots rate limited for {args.throttle_seconds} s (healthy bot's latency):")
+    for label, send in (("sleep in worker", send_fresh), ("per-bot outbox", send_pooled)):
+        stub.throttled_since.clear()
+        elapsed, latencies = await fire(send, [BENCHMARK_TOKEN, f"{BENCHMARK_TOKEN}THROTTLED{label[0]}"])
+        print_row(label, args.requests, elapsed, latencies[BENCHMARK_TOKEN])
+
+    await client.close(timeout=args.throttle_seconds + 5)
+
+    # 3. A broadcast-style burst to many chats against a server enforcing 30 msg/s per bot
+    print(f"\nBurst of {args.burst} messages to different chats, server allows 30 msg/s per bot:")
+    print(f"{'':<24} {'delivered in':>12} {'429s':>6} {'retries':>8} {'queue wait p95':>15}")
+    stub.bot_limit = 30
+    for label, client in (("react to 429", TelegramClient(base_url=base_url, rate=1e9, burst=1e9, retries=10)),
+                          ("token buckets", TelegramClient(base_url=base_url, retries=10))):
+        stub.rejected = 0
+        stub.recent_sends.clear()
+        started = time.perf_counter()
+        await asyncio.gather(*(client.send_message(f"{BENCHMARK_TOKEN}{label[0]}", i, "hi") for i in range(args.burst)))
+        while client.stats()['queue_depth']:
+            await asyncio.sleep(0.01)
+        stats = client.stats()
+        print(f"{label:<24} {time.perf_counter() - started:>10.2f} s {stub.rejected:>6} {stats['retried']:>8} "
+              f"{stats['wait_ms_p95']:>12.0f} ms")
+        await client.close()
+
+    await stub.stop()
+
+async def run_streaming(args):
+    """Time to the first visible text: full response then sendMessage vs streaming with edits"""
+    import logging
+    import backend.services as services
+    from backend.llm_provider import StubProvider
+    from backend.telegram_client import TelegramClient
+
+    logging.getLogger("backend.telegram_client").setLevel(logging.ERROR)
+    # One chunk of CHUNK_TOKENS words per chunk interval after the first token
+    services.provider = StubProvider(latency=args.first_token_ms / 1000,
+                                     output_tokens=args.chunks * StubProvider.CHUNK_TOKENS,
+                                     tokens_per_second=StubProvider.CHUNK_TOKENS / (args.chunk_ms / 1000))
+    stub = StubTelegramServer(args.latency_ms / 1000)
+    base_url = await stub.start()
+    print(f"Stub model: first token {args.first_token_ms} ms, {args.chunks} chunks every {args.chunk_ms} ms; "
+          f"{args.requests} concurrent answers\n")
+    print(f"{'':<12} {'first text p50':>15} {'p95':>9} {'complete p50':>13} {'edits/answer':>13}")
+
+    for mode in ("full", "streaming"):
+        client = TelegramClient(base_url=base_url)
+        stub.calls.clear()
+
+        async def answer(chat_id):
+            if mode == "streaming":
+                stream = client.stream(BENCHMARK_TOKEN, chat_id, edit_interval=args.edit_interval)
+                text, _ = await services.stream_ai_response_and_count_tokens("Question?", "KB", on_text=stream.update)
+                await stream.finish(text)
+            else:
+                text, _ = await services.get_ai_response_and_count_tokens("Question?", "KB")
+                await client.send_message(BENCHMARK_TOKEN, chat_id, text)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(answer(i) for i in range(args.requests)))
+        while client.stats()['queue_depth']:
+            await asyncio.sleep(0.01)
+        first, complete = {}, {}
+        for at, method, chat_id in stub.calls:
+            first.setdefault(chat_id, at - started)
+            complete[chat_id] = at - started
+        edits = sum(1 for _, method, _ in stub.calls if method == "editMessageText") / args.requests
+        first_times, complete_times = list(first.values()), list(complete.values())
+        print(f"{mode:<12} {percentile(first_times, 50) * 1000:>12.0f} ms {percentile(first_times, 95) * 1000:>6.0f} ms "
+              f"{percentile(complete_times, 50) * 1000:>10.0f} ms {edits:>13.1f}")
+        await client.close()
+
+    await stub.stop()
+
+def load_constant(filename, name):
+    """Read a string constant from one of the setup scripts without running it (they need a database)"""
+    import ast
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), filename)
+    with open(path) as f:
+        tree = ast.parse(f.read())
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and any(getattr(t, 'id', None) == name for t in node.targets):
+            return ast.literal_eval(node.value)
+    raise ValueError(f"{name} not found in {filename}")
+
+def sample_knowledge_bases():
+    """The TechNova and UrbanStep sample KBs with questions and the facts a good answer needs"""
+    technova_queries = [(q['question'], q['expected_keywords']) for q in load_constant('test_bot.py', 'TEST_QUERIES')]
+    urbanstep_queries = [
+        ("How long does shipping take to London?", ['5–8 working days', 'internationally', 'tracking number']),
+        ("Can I pay cash on delivery?", ['Cash on delivery', 'Accra']),
+        ("What is your return policy?", ['7-day return', 'size exchanges']),
+        ("What is your support phone number?", ['+233 550 123 456', 'support@urbanstep.com']),
+        ("What materials are your shoes made from?", ['premium leather', 'rubber soles', 'eco-friendly']),
+    ]
+    return [
+        ('TechNova', load_constant('setup_test_data.py', 'TECHNOVA_KNOWLEDGE_BASE'), technova_queries),
+        ('UrbanStep', load_constant('add_knowledge_base.py', 'KNOWLEDGE_BASE_TEXT'), urbanstep_queries),
+    ]
+
+async def run_retrieval(args):
+    """Compare prompt tokens and keyword recall: full KB vs retrieved top-k chunks"""
+    import backend.services as services
+    from backend.retrieval import RetrievalEngine, create_embedding_backend
+
+    engine = RetrievalEngine(top_k=args.top_k, chunk_size=args.chunk_size,
+                             embeddings=create_embedding_backend(args.embeddings))
+    print(f"top_k={args.top_k} chunk_size={args.chunk_size} embeddings={args.embeddings}")
+    print("Answer quality is measured as recall of the expected facts in the context given to the model.\n")
+    print(f"{'KB':<10} {'mode':<10} {'tokens/msg':>10} {'recall':>8} {'retrieve ms':>12}")
+
+    for name, text, queries in sample_knowledge_bases():
+        documents = [{'id': f"{name}-{i}", 'content': part} for i, part in enumerate(text.split("\n\n")) if part.strip()]
+        full_kb = " ".join(doc['content'] for doc in documents)
+        rows = {'full': ([], [], []), 'retrieval': ([], [], [])}
+        for question, keywords in queries:
+            started = time.perf_counter()
+            retrieved = engine.retrieve(name, documents, question)
+            elapsed = time.perf_counter() - started
+            for mode, context, spent in (('full', full_kb, 0.0), ('retrieval', retrieved, elapsed)):
+                tokens, recall, timings = rows[mode]
+                tokens.append(services.estimate_tokens(services.build_prompt(question, context), scale=1.0))
+                recall.append(sum(k.lower() in context.lower() for k in keywords) / len(keywords))
+                timings.append(spent)
+        for mode, (tokens, recall, timings) in rows.items():
+            print(f"{name:<10} {mode:<10} {sum(tokens) / len(tokens):>10.0f} {sum(recall) / len(recall):>8.0%} "
+                  f"{sum(timings) / len(timings) * 1000:>12.2f}")
+
+async def run_tokens(args):
+    """Calibration report: the local token estimator vs Gemini's count_tokens on the sample KB prompts"""
+    import math
+    import backend.services as services
+    from backend.llm_provider import GeminiProvider
+    from backend.retrieval import RetrievalEngine
+
+    online = os.environ["GOOGLE_API_KEY"] != "benchmark"
+    gemini_provider = GeminiProvider(os.environ["GOOGLE_API_KEY"]) if online else None
+    engine = RetrievalEngine(top_k=args.top_k)
+    print("Prompts: every sample question with the full KB and with retrieved chunks.")
+    print(f"{'KB':<10} {'prompts':>7} {'chars/4':>8} {'estimate':>9} {'gemini':>8} {'est/gemini':>14} {'estimate us':>12}")
+
+    worst = 0.0
+    for name, text, queries in sample_knowledge_bases():
+        documents = [{'id': f"{name}-{i}", 'content': part} for i, part in enumerate(text.split("\n\n")) if part.strip()]
+        full_kb = " ".join(doc['content'] for doc in documents)
+        prompts = []
+        for question, _ in queries:
+            prompts.append(services.build_prompt(question, full_kb))
+            prompts.append(services.build_prompt(question, engine.retrieve(name, documents, question)))
+
+        started = time.perf_counter()
+        estimates = [services.estimate_tokens(prompt, scale=1.0) for prompt in prompts]
+        elapsed = (time.perf_counter() - started) / len(prompts)
+        chars = [len(prompt) / 4 for prompt in prompts]
+        gemini, ratios = "-", "-"
+        if online:
+            counts = [await gemini_provider.count_tokens(prompt) for prompt in prompts]
+            spread = [estimate / count for estimate, count in zip(estimates, counts)]
+            worst = max(worst, max(count / estimate for estimate, count in zip(estimates, counts)))
+            gemini = f"{sum(counts) / len(counts):.0f}"
+            ratios = f"{min(spread):.2f}-{max(spread):.2f}"
+        print(f"{name:<10} {len(prompts):>7} {sum(chars) / len(chars):>8.0f} {sum(estimates) / len(estimates):>9.0f} "
+              f"{gemini:>8} {ratios:>14} {elapsed * 1e6:>12.1f}")
+
+    if online:
+        print(f"\nSmallest TOKEN_ESTIMATE_SCALE that never under-estimates these prompts: {math.ceil(worst * 20) / 20:.2f}")
+    else:
+        print("\nSet a real GOOGLE_API_KEY to compare against Gemini's count_tokens.")
+
+PARAPHRASES = {
+    "How long does shipping take to London?": ["how long does shipping take to london",
+                                               "Shipping to London, how long does it take?"],
+    "Can I pay cash on delivery?": ["Can I pay cash on delivery please?", "cash on delivery - can I pay that way?"],
+    "What is your return policy?": ["What's your return policy?", "Tell me about the return policy",
+                                    "return policies?"],
+    "What is your support phone number?": ["what's the support phone number", "Support phone number?"],
+    "What materials are your shoes made from?": ["What materials are the shoes made from?"],
+}
+
+async def run_cache(args):
+    """Replay repeated and paraphrased customer questions through the response cache"""
+    import random
+    import backend.services as services
+    from backend.response_cache import ResponseCache
+
+    random.seed(7)
+    _, text, queries = sample_knowledge_bases()[1]
+    # Different questions that must NOT be answered from each other's cache entries
+    distinct = [question for question, _ in queries] + [
+        "How long does shipping take to Dubai?", "Can I pay by card on delivery?", "What is your exchange policy?",
+        "How long does express shipping take to London?", "Can I not pay cash on delivery?"
+    ]
+    pool = distinct + [p for variants in PARAPHRASES.values() for p in variants]
+    canonical = {p: q for q, variants in PARAPHRASES.items() for p in variants}
+    cache = ResponseCache(similarity=args.similarity)
+    tokens_saved = wrong = 0
+    started = time.perf_counter()
+    for _ in range(args.messages):
+        question = random.choice(pool)
+        answer = cache.get("UrbanStep", 1, question)
+        if answer is None:
+            cache.set("UrbanStep", 1, question, f"answer to: {canonical.get(question, question)}")
+        else:
+            tokens_saved += services.estimate_tokens(services.build_prompt(question, text)) + 100
+            wrong += answer != f"answer to: {canonical.get(question, question)}"
+    elapsed = time.perf_counter() - started
+    stats = cache.stats()
+    print(f"{args.messages} messages drawn from {len(distinct)} distinct questions and "
+          f"{len(pool) - len(distinct)} paraphrases (similarity >= {args.similarity})\n")
+    print(f"exact hits {stats['exact_hits']}, near-duplicate hits {stats['similar_hits']}, misses {stats['misses']}, "
+          f"hit rate {stats['hit_rate']:.0%}")
+    print(f"wrong answers served {wrong}, model calls avoided {stats['exact_hits'] + stats['similar_hits']}, "
+          f"~{tokens_saved} prompt+answer tokens saved (full KB prompts)")
+    print(f"cache lookup+store {elapsed / args.messages * 1e6:.0f} us per message")
+
+async def run_context_cache(args):
+    """Full-KB prompts on every message vs a prefix cached once on the provider"""
+    import backend.services as services
+    from backend.context_cache import ContextCache
+    from backend.llm_provider import StubProvider
+
+    _, text, queries = sample_knowledge_bases()[1]
+    # Repeat the sample KB until it is big enough to be worth caching
+    sections = []
+    while services.estimate_tokens("\n\n".join(sections), scale=1.0) < args.kb_tokens:
+        sections.append(f"Section {len(sections) + 1}\n{text}")
+    knowledge_base = "\n\n".join(sections)
+    questions = [queries[i % len(queries)][0] for i in range(args.messages)]
+
+    print(f"{args.messages} messages, KB of ~{services.estimate_tokens(knowledge_base, scale=1.0)} tokens, "
+          f"prefill {args.prefill_us:g} us/token, output {args.output_ms:g} ms\n")
+    print(f"{'mode':<18} {'p50':>10} {'p95':>10} {'tokens sent':>14} {'uploads':>8} {'cached tokens':>14}")
+    for mode in ("full prompt", "context cache"):
+        # The stub processes input at a fixed cost per token; cached prefixes are processed once
+        services.provider = StubProvider(latency=args.output_ms / 1000, prefill_per_token=args.prefill_us / 1e6)
+        cache = ContextCache(enabled=mode == "context cache", ttl=3600, min_tokens=args.min_tokens)
+        latencies = []
+        for question in questions:
+            started = time.perf_counter()
+            cached_prefix = await cache.get_prefix("UrbanStep", 1, knowledge_base)
+            await services.get_ai_response_and_count_tokens(question, knowledge_base, cached_prefix=cached_prefix)
+            latencies.append(time.perf_counter() - started)
+        stub = services.provider
+        uploaded = cache.stats()['creates'] and stub.count(services.build_prompt_prefix(knowledge_base))
+        print(f"{mode:<18} {percentile(latencies, 50) * 1000:>8.1f}ms {percentile(latencies, 95) * 1000:>8.1f}ms "
+              f"{stub.prompt_tokens + uploaded:>14} {stub.caches_created:>8} {stub.cached_tokens:>14}")
+
+SMALL_TALK = ["hi", "Hello!", "hey there", "good morning", "thanks!", "thank you so much", "ok thanks", "bye", "great, thanks"]
+COMPLEX_QUESTIONS = [
+    "My order arrived damaged and the box was open, what should I do?",
+    "What's the difference between your two delivery options and which is better for a gift?",
+    "I was charged twice but didn't get a confirmation email. Can you help?",
+    "Why hasn't my refund been processed yet?",
+]
+
+async def run_routing(args):
+    """Tokens and latency with every message on the full model vs routed by tier"""
+    import backend.services as services
+    from backend.llm_provider import StubProvider
+    from backend.model_router import ModelRouter
+    from backend.retrieval import RetrievalEngine
+
+    full = StubProvider(latency=args.full_ms / 1000, output_tokens=200, output_tokens_sigma=0.3)
+    small = StubProvider(latency=args.small_ms / 1000, output_tokens=80, output_tokens_sigma=0.3)
+    router = ModelRouter(small_provider=small)
+    engine = RetrievalEngine(top_k=4)
+    services.provider = full
+
+    messages = []
+    for name, text, queries in sample_knowledge_bases():
+        documents = [{'id': f"{name}-{i}", 'content': part} for i, part in enumerate(text.split("\n\n")) if part.strip()]
+        messages += [(name, documents, question) for question, _ in queries]
+        messages += [(name, documents, greeting) for greeting in SMALL_TALK]
+        messages += [(name, documents, question) for question in COMPLEX_QUESTIONS]
+
+    async def answer(name, documents, message, routed):
+        started = time.perf_counter()
+        decision = router.route(message) if routed else None
+        tier = decision.tier if decision else 'full'
+        if tier == 'template':
+            router.template_reply(message, {'name': name})
+            tokens = 0
+        else:
+            knowledge_base = engine.retrieve(name, documents, message, top_k=2 if tier == 'small' else None)
+            _, tokens = await services.get_ai_response_and_count_tokens(
+                message, knowledge_base, llm=router.provider(tier), max_output_tokens=256 if tier == 'small' else None
+            )
+        latency = time.perf_counter() - started
+        if decision:
+            router.record(name, decision, tokens, latency)
+        return tier, tokens, latency
+
+    print(f"{len(messages)} messages from both sample KBs, full model {args.full_ms:g} ms, "
+          f"small model {args.small_ms:g} ms\n")
+    for routed in (False, True):
+        results = await asyncio.gather(*(answer(*message, routed) for message in messages))
+        tiers = {tier: sum(1 for t, _, _ in results if t == tier) for tier in ("template", "small", "full")}
+        latencies = [latency for _, _, latency in results]
+        print(f"{'routed' if routed else 'all full model':<16} tokens {sum(t for _, t, _ in results):>7}   "
+              f"p50 {percentile(latencies, 50) * 1000:>6.0f} ms   mean {sum(latencies) / len(latencies) * 1000:>6.0f} ms   "
+              f"tiers {tiers}")
+    print("\nClassification:")
+    for message in dict.fromkeys(message for _, _, message in messages):
+        requested, reason = router.classify(message)
+        print(f"  {requested:<9} {reason:<18} {message}")
+
+async def run_coalescing(args):
+    """A burst of identical questions with and without single-flight coalescing"""
+    import random
+    import backend.services as services
+    from backend.coalescer import RequestCoalescer
+    from backend.llm_provider import StubProvider
+
+    class QuotaLimitedStub(StubProvider):
+        """The provider only runs so many generations at once (rate limits, quota)"""
+
+        def __init__(self, concurrency, **kwargs):
+            super().__init__(**kwargs)
+            self.slots = asyncio.Semaphore(concurrency)
+
+        async def generate(self, *a, **kw):
+            async with self.slots:
+                return await super().generate(*a, **kw)
+
+    random.seed(1)
+    questions = ["What are your shipping times to Dubai?"] * args.identical
+    questions += [f"Do you ship product {i} to Accra?" for i in range(args.distinct)]
+    arrivals = sorted((random.uniform(0, args.spread_ms / 1000), question) for question in questions)
+    print(f"{len(questions)} messages over {args.spread_ms:g} ms ({args.identical} identical), "
+          f"model {args.model_ms:g} ms, provider runs {args.provider_concurrency} at once\n")
+    print(f"{'mode':<24} {'model calls':>11} {'p50':>9} {'p95':>9} {'billed tokens':>14}")
+
+    for mode in ("no coalescing", "each", "leader", "split"):
+        services.provider = QuotaLimitedStub(args.provider_concurrency, latency=args.model_ms / 1000)
+        coalescer = RequestCoalescer(billing="each" if mode == "no coalescing" else mode)
+        latencies, billed = [], 0
+
+        async def ask(at, question):
+            nonlocal billed
+            await asyncio.sleep(at)
+            started = time.perf_counter()
+
+            async def generate(on_text):
+                return await services.get_ai_response_and_count_tokens(question, "KB")
+
+            if mode == "no coalescing":
+                _, tokens = await generate(None)
+            else:
+                # No plan limit in this benchmark: followers have room for the full answer
+                tokens = coalescer.billed_tokens(await coalescer.run(("company", question), generate), reserved=10 ** 9)
+            billed += tokens
+            latencies.append(time.perf_counter() - started)
+
+        await asyncio.gather(*(ask(at, question) for at, question in arrivals))
+        label = mode if mode == "no coalescing" else f"coalescing, bill {mode}"
+        print(f"{label:<24} {services.provider.calls:>11} {percentile(latencies, 50) * 1000:>7.0f}ms "
+              f"{percentile(latencies, 95) * 1000:>7.0f}ms {billed:>14}")
+
+async def run_resilience(args):
+    """A provider brownout with and without the circuit breaker, and a slow tail with and without hedging"""
+    import logging
+    import random
+    import backend.services as services
+    from backend.llm_provider import StubProvider
+    from backend.llm_resilience import CircuitBreaker, ResilientProvider
+
+    logging.getLogger("backend.services").setLevel(logging.CRITICAL)
+    logging.getLogger("backend.llm_resilience").setLevel(logging.CRITICAL)
+
+    class UnreliableStub(StubProvider):
+        """Fails every call during the brownout window; otherwise some calls are very slow"""
+
+        def __init__(self, brownout, slow_ratio, slow_factor, **kwargs):
+            super().__init__(**kwargs)
+            self.brownout = brownout
+            self.slow_ratio = slow_ratio
+            self.slow_factor = slow_factor
+            self.started = time.perf_counter()
+            self.rng = random.Random(3)
+
+        async def generate(self, prompt, max_output_tokens=None, cached_prefix=None):
+            self.calls += 1
+            elapsed = time.perf_counter() - self.started
+            if self.brownout[0] <= elapsed < self.brownout[1]:
+                await asyncio.sleep(self.latency)
+                raise RuntimeError("503 Service Unavailable")
+            slow = self.rng.random() < self.slow_ratio
+            await asyncio.sleep(self.latency * (self.slow_factor if slow else 1))
+            return await super().generate(prompt, max_output_tokens, cached_prefix)
+
+    async def simulate(provider, seconds):
+        latencies, fallbacks = [], 0
+
+        async def one(at):
+            nonlocal fallbacks
+            await asyncio.sleep(at)
+            started = time.perf_counter()
+            text, _ = await services.get_ai_response_and_count_tokens("What is your return policy?", "KB")
+            fallbacks += text == services.FALLBACK_RESPONSE
+            latencies.append(time.perf_counter() - started)
+
+        await asyncio.gather(*(one(i / args.rate) for i in range(int(seconds * args.rate))))
+        return latencies, fallbacks
+
+    def breaker():
+        return CircuitBreaker(failure_rate=0.5, window=20, min_calls=10, open_seconds=2)
+
+    latency = args.model_ms / 1000
+    print(f"Brownout: every call fails from {args.brownout_start:g}s to {args.brownout_end:g}s, "
+          f"{args.rate:g} msg/s for {args.seconds:g}s, model {args.model_ms:g} ms\n")
+    print(f"{'mode':<20} {'p50':>9} {'p95':>9} {'p99':>9} {'model calls':>12} {'fallbacks':>10}")
+    for mode in ("no breaker", "circuit breaker"):
+        stub = UnreliableStub((args.brownout_start, args.brownout_end), 0.0, 1, latency=latency)
+        services.provider = stub if mode == "no breaker" else ResilientProvider(stub, breaker())
+        latencies, fallbacks = await simulate(services.provider, args.seconds)
+        print(f"{mode:<20} {percentile(latencies, 50) * 1000:>7.0f}ms {percentile(latencies, 95) * 1000:>7.0f}ms "
+              f"{percentile(latencies, 99) * 1000:>7.0f}ms {stub.calls:>12} {fallbacks:>10}")
+
+    print(f"\nSlow tail: {args.slow_ratio:.0%} of calls take {args.slow_factor:g}x longer, no brownout\n")
+    print(f"{'mode':<20} {'p50':>9} {'p95':>9} {'p99':>9} {'model calls':>12} {'hedges won':>10}")
+    for hedge in (False, True):
+        stub = UnreliableStub((0, 0), args.slow_ratio, args.slow_factor, latency=latency)
+        services.provider = ResilientProvider(stub, breaker(), hedge=hedge, hedge_min_delay=0, hedge_max_ratio=0.1)
+        latencies, _ = await simulate(services.provider, args.seconds)
+        print(f"{'hedged' if hedge else 'not hedged':<20} {percentile(latencies, 50) * 1000:>7.0f}ms "
+              f"{percentile(latencies, 95) * 1000:>7.0f}ms {percentile(latencies, 99) * 1000:>7.0f}ms "
+              f"{stub.calls:>12} {services.provider.hedges_won:>10}")
+
+async def run_bulkheads(args):
+    """A Free tenant floods the queue with slow messages while an Enterprise tenant sends a steady trickle"""
+    import logging
+    import backend.tenant_context as tenant_context
+    from backend.bulkhead import Bulkhead, TenantOverloaded
+    from backend.job_queue import InMemoryJobQueue, WorkerPool
+
+    logging.getLogger("backend.bulkhead").setLevel(logging.ERROR)
+    tenants = {"111:NOISY": ("Free Plan", args.noisy_ms / 1000), "222:QUIET": ("Enterprise Plan", args.quiet_ms / 1000)}
+    for token, (plan, _) in tenants.items():
+        tenant_context.tenant_cache.set(token, tenant_context.TenantContext(
+            bot_token=token, company={'id': token.split(":")[1].lower()},
+            subscription={'plans': {'name': plan, 'features': {}}}
+        ), ttl=3600)
+
+    print(f"{args.workers} workers; noisy Free tenant sends {args.noisy} messages at once ({args.noisy_ms:g} ms each), "
+          f"quiet Enterprise tenant {args.quiet_rate:g} msg/s ({args.quiet_ms:g} ms each) for {args.seconds:g}s\n")
+    print(f"{'mode':<12} {'tenant':<8} {'wait p50':>10} {'wait p95':>10} {'wait max':>10} {'answered':>9} {'shed':>6}")
+    for enabled in (False, True):
+        waits = {token: [] for token in tenants}
+        shed = {token: 0 for token in tenants}
+
+        async def handler(job):
+            waits[job['bot_token']].append(time.time() - job['enqueued_at'])
+            await asyncio.sleep(tenants[job['bot_token']][1])
+
+        async def on_shed(job):
+            shed[job['bot_token']] += 1
+
+        bulkhead = Bulkhead(max_wait=args.max_wait) if enabled else None
+        pool = WorkerPool(InMemoryJobQueue(), handler, concurrency=args.workers, bulkhead=bulkhead, on_shed=on_shed)
+        pool.start()
+
+        async def submit(token, i):
+            try:
+                await pool.submit(token, {'bot_token': token, 'chat_id': i})
+            except TenantOverloaded:
+                shed[token] += 1
+
+        for i in range(args.noisy):
+            await submit("111:NOISY", i)
+        for i in range(int(args.quiet_rate * args.seconds)):
+            await submit("222:QUIET", i)
+            await asyncio.sleep(1 / args.quiet_rate)
+        await pool.stop(timeout=120)
+        for token in tenants:
+            name = token.split(":")[1].lower()
+            print(f"{'bulkhead' if enabled else 'shared':<12} {name:<8} {percentile(waits[token], 50) * 1000:>8.0f}ms "
+                  f"{percentile(waits[token], 95) * 1000:>8.0f}ms {max(waits[token], default=0) * 1000:>8.0f}ms "
+                  f"{len(waits[token]):>9} {shed[token]:>6}")
+
+async def run_memory(args):
+    """Prompt size over a long conversation: no history, the full history, and bounded memory"""
+    import json
+    import random
+    import backend.services as services
+    from backend.conversation_memory import InMemoryConversationMemory
+
+    random.seed(2)
+    memory = InMemoryConversationMemory(max_turns=args.max_turns, history_tokens=args.history_tokens)
+    knowledge_base = "Benchmark knowledge base. " * 50
+    follow_ups = ["How long does that take?", "And what does it cost?", "Does that include tracking?",
+                  "What if it arrives damaged?", "Can I change the address after ordering?"]
+    transcript, sizes = [], {"no history": [], "full history": [], "bounded memory": []}
+    for turn in range(args.turns):
+        question = random.choice(follow_ups)
+        answer = " ".join(random.choice(["Yes,", "orders", "ship", "within", "three", "business", "days",
+                                         "from", "our", "warehouse."]) for _ in range(args.answer_words))
+        full = "\n".join(f"{role}: {text}" for role, text in transcript)
+        history = await memory.history("bot:chat")
+        sizes["no history"].append(services.estimate_tokens(services.build_prompt(question, knowledge_base)))
+        sizes["full history"].append(services.estimate_tokens(services.build_prompt(question, knowledge_base, full)))
+        sizes["bounded memory"].append(services.estimate_tokens(services.build_prompt(question, knowledge_base, history)))
+        transcript += [("Customer", question), ("Agent", answer)]
+        await memory.append("bot:chat", question, answer)
+
+    print(f"{args.turns} exchanges in one chat, {args.answer_words}-word answers, "
+          f"last {args.max_turns} messages kept, history budget {args.history_tokens} tokens\n")
+    print(f"{'prompt':<16} {'first':>8} {'last':>8} {'mean':>8} {'total':>10}")
+    for label, values in sizes.items():
+        print(f"{label:<16} {values[0]:>8} {values[-1]:>8} {sum(values) / len(values):>8.0f} {sum(values):>10}")
+    state = await memory.load("bot:chat")
+    print(f"\nStored state: {len(json.dumps(state))} bytes ({len(state['turns'])} turns, "
+          f"{len(state['summary'])} summary lines)")
+
+async def run_analytics(args):
+    """Database writes for dashboard analytics: one RPC per message vs the batched sink"""
+    import random
+    import backend.services as services
+    from backend.analytics_sink import BOT_RESPONSE, MESSAGE, AnalyticsSink
+
+    latency = args.db_latency_ms / 1000
+    calls = {'rpc': 0, 'batch': 0}
+
+    async def increment_message_count(bot_id, user_id, increment=1):
+        calls['rpc'] += 1
+        await asyncio.sleep(latency)
+        return "conversation-id"
+
+    services.increment_message_count = increment_message_count
+    random.seed(4)
+    company = {'id': 'company-1', 'user_id': 'owner-1'}
+    events = [(random.randrange(args.chats), kind) for _ in range(args.messages) for kind in (MESSAGE, BOT_RESPONSE)]
+
+    started = time.perf_counter()
+    for chat_id, _ in events:
+        await services.increment_message_count('bot-1', str(chat_id))
+    per_message = time.perf_counter() - started
+
+    sink = AnalyticsSink(flush_interval=args.flush_interval)
+
+    async def write_counts(counts):
+        calls['batch'] += 1
+        await asyncio.sleep(latency)
+
+    async def write_activities(rows):
+        calls['batch'] += 1
+        await asyncio.sleep(latency)
+
+    sink._write_counts = write_counts
+    sink._write_activities = write_activities
+    sink.start()
+    started = time.perf_counter()
+    spacing = args.seconds / len(events)
+    recording = 0.0
+    for chat_id, kind in events:
+        before = time.perf_counter()
+        sink.record(kind, company, 'bot-1', "Benchmark Bot", chat_id)
+        recording += time.perf_counter() - before
+        await asyncio.sleep(spacing)
+    await sink.stop()
+
+    print(f"{args.messages} messages + answers from {args.chats} chats over {args.seconds:g}s, "
+          f"database round trip {args.db_latency_ms:g} ms, flush every {args.flush_interval:g}s\n")
+    print(f"{'per-message RPC':<18} {calls['rpc']:>6} database calls   "
+          f"{per_message / len(events) * 1000:>8.3f} ms added per event")
+    print(f"{'batched sink':<18} {calls['batch']:>6} database calls   "
+          f"{recording / len(events) * 1000:>8.3f} ms added per event   "
+          f"{sink.conversation_rows} conversation rows, {sink.activity_rows} activities")
+
+async def run_dedup(args):
+    """Telegram redeliveries with and without update_id dedup: model calls and replies sent"""
+    import random
+    import backend.config as config
+    import backend.services as services
+    install_fake_services(args.latency_ms / 1000, args.model_ms / 1000)
+    from backend.main import app, worker_pool
+
+    replies = 0
+    send_telegram_message = services.send_telegram_message
+
+    async def counting_send(token, chat_id, text):
+        nonlocal replies
+        replies += 1
+        return await send_telegram_message(token, chat_id, text)
+
+    services.send_telegram_message = counting_send
+    random.seed(5)
+    transport = httpx.ASGITransport(app=app)
+    print(f"{args.updates} updates, {args.redelivery:.0%} redelivered 1-3 times after "
+          f"{args.redelivery_delay_ms:g} ms, model {args.model_ms:g} ms\n")
+    print(f"{'mode':<12} {'deliveries':>10} {'model calls':>12} {'replies':>8} {'ignored':>8}")
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+            for run, enabled in enumerate((False, True)):
+                config.UPDATE_DEDUP_ENABLED = enabled
+                replies, ignored, deliveries = 0, 0, []
+                calls_before = services.provider.calls
+                for i in range(args.updates):
+                    copies = 1 + (random.randint(1, 3) if random.random() < args.redelivery else 0)
+                    deliveries += [(copy * args.redelivery_delay_ms / 1000, run * args.updates + i) for copy in range(copies)]
+
+                async def deliver(at, update_id):
+                    nonlocal ignored
+                    await asyncio.sleep(at)
+                    payload = {'update_id': update_id,
+                               'message': {'chat': {'id': update_id}, 'text': f"Where is order {update_id}?"}}
+                    response = await client.post(f"/webhook/{BENCHMARK_TOKEN}", json=payload)
+                    ignored += response.json().get('detail') == "Duplicate update"
+
+                await asyncio.gather(*(deliver(at, update_id) for at, update_id in deliveries))
+                await wait_for_drain(worker_pool)
+                print(f"{'dedup' if enabled else 'no dedup':<12} {len(deliveries):>10} "
+                      f"{services.provider.calls - calls_before:>12} {replies:>8} {ignored:>8}")
+
+async def run_polling(args):
+    """getUpdates ingestion for several bots, with a restart halfway: latency, batching, lost and replayed updates"""
+    import logging
+    import tempfile
+    from backend.job_queue import ACCEPTED
+    from backend.telegram_client import telegram
+    from backend.update_poller import FileOffsetStore, UpdatePoller
+
+    logging.getLogger("backend.update_poller").setLevel(logging.ERROR)
+    stub = StubTelegramServer(args.latency_ms / 1000)
+    telegram.base_url = await stub.start()
+    tokens = [f"{BENCHMARK_TOKEN}{bot}" for bot in range(args.bots)]
+    total = int(args.rate * args.seconds)
+    print(f"{args.bots} bots, {total} updates over {args.seconds:g} s, Bot API latency {args.latency_ms:g} ms, "
+          f"restart after {args.seconds / 2:g} s\n")
+    print(f"{'restart':<26} {'queued':>7} {'lost':>5} {'replayed':>9} {'polls':>6} {'avg batch':>10} "
+          f"{'p50':>8} {'p95':>8}")
+
+    for label, graceful, keep_offsets in (("graceful (stop)", True, True),
+                                          ("crash, offset file", False, True),
+                                          ("crash, no offset file", False, False)):
+        directory = tempfile.mkdtemp()
+        sent_at, queued = {}, []
+
+        async def enqueue(token, update_id, chat_id, text):
+            await asyncio.sleep(args.enqueue_ms / 1000)  # dedup check and queue push (Redis round trips)
+            queued.append((update_id, time.perf_counter() - sent_at[update_id]))
+            return ACCEPTED
+
+        def new_poller(path):
+            poller = UpdatePoller(enqueue, FileOffsetStore(path), timeout=args.poll_timeout, limit=args.limit)
+
+            async def active_bot_tokens():
+                return tokens
+            poller.active_bot_tokens = active_bot_tokens
+            return poller
+
+        async def produce():
+            for i in range(total):
+                update_id = len(sent_at) + 1
+                sent_at[update_id] = time.perf_counter()
+                stub.pending.setdefault(tokens[i % len(tokens)], []).append(
+                    {'update_id': update_id, 'message': {'chat': {'id': i}, 'text': "Hello"}})
+                await asyncio.sleep(1 / args.rate)
+
+        poller = new_poller(os.path.join(directory, "offsets.json"))
+        poller.start()
+        producer = asyncio.create_task(produce())
+        await asyncio.sleep(args.seconds / 2)
+        polls = poller.polls
+        if graceful:
+            await poller.stop()
+        else:
+            # Killed mid-poll: no confirming getUpdates, only what the offset store already has
+            for task in [poller._task, *poller._pollers.values()]:
+                task.cancel()
+            await poller._http.aclose()
+        poller = new_poller(os.path.join(directory, "offsets.json" if keep_offsets else "fresh.json"))
+        poller.start()
+        await producer
+        while len({update_id for update_id, _ in queued}) < total:
+            await asyncio.sleep(0.05)
+        await asyncio.sleep(args.poll_timeout / 10)
+        polls += poller.polls
+        await poller.stop()
+        unique = {update_id for update_id, _ in queued}
+        latencies = [latency for _, latency in queued]
+        print(f"{label:<26} {len(queued):>7} {total - len(unique):>5} {len(queued) - len(unique):>9} {polls:>6} "
+              f"{len(queued) / polls:>10.1f} {percentile(latencies, 50) * 1000:>5.0f} ms "
+              f"{percentile(latencies, 95) * 1000:>5.0f} ms")
+        stub.pending.clear()
+
+    await stub.stop()
+
+async def run_webhooks(args):
+    """Legacy token-in-path webhooks vs the per-bot routing table, with genuine and probing traffic"""
+    import logging
+    import random
+    import uuid
+    import backend.tenant_context as tenant_context
+    install_fake_services(args.latency_ms / 1000, args.model_ms / 1000)
+    from backend.main import app, worker_pool
+    from backend.webhook_router import webhook_router
+
+    logging.getLogger("backend.main").setLevel(logging.ERROR)
+    logging.getLogger("backend.pipeline").setLevel(logging.CRITICAL)
+    lookups = {'tenant': 0, 'routes': 0}
+    fetch_tenant_context, refresh_routes = tenant_context._fetch_tenant_context, webhook_router.refresh
+
+    async def counting_fetch(token):
+        lookups['tenant'] += 1
+        return await fetch_tenant_context(token) if token.startswith(BENCHMARK_TOKEN) else None
+
+    async def counting_refresh():
+        lookups['routes'] += 1
+        return await refresh_routes()
+
+    tenant_context._fetch_tenant_context = counting_fetch
+    webhook_router.refresh = counting_refresh
+    tokens = [f"{BENCHMARK_TOKEN}{bot}" for bot in range(args.bots)]
+    known = set(tokens)
+    for token in tokens:
+        webhook_router.add(token)
+
+    timings = []
+    for _ in range(10000):
+        token = random.choice(tokens)
+        started = time.perf_counter()
+        await webhook_router.resolve(webhook_router.webhook_id(token), webhook_router.secret(token))
+        timings.append(time.perf_counter() - started)
+    print(f"{args.bots} bots in the routing table: resolve p50 {percentile(timings, 50) * 1e6:.1f} us, "
+          f"p99 {percentile(timings, 99) * 1e6:.1f} us (incl. deriving the test id and secret)\n")
+
+    random.seed(7)
+    print(f"{args.requests} genuine updates + {args.probes} with unknown tokens/ids, "
+          f"{args.latency_ms:g} ms per database call\n")
+    print(f"{'endpoint':<22} {'genuine ack p50':>15} {'p95':>9} {'rejected':>9} {'tenant lookups':>15} {'route loads':>12}")
+    transport = httpx.ASGITransport(app=app)
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+            for routed in (False, True):
+                tenant_context.tenant_cache.clear()
+                lookups.update(tenant=0, routes=0)
+                latencies, rejected = [], 0
+                requests = [random.choice(tokens) for _ in range(args.requests)] + \
+                    [f"{random.randint(10 ** 9, 10 ** 10)}:{uuid.uuid4().hex}" for _ in range(args.probes)]
+                random.shuffle(requests)
+
+                async def deliver(i, token):
+                    nonlocal rejected
+                    await asyncio.sleep(i / args.rate)
+                    payload = {'update_id': i + routed * len(requests),
+                               'message': {'chat': {'id': i}, 'text': "Do you ship abroad?"}}
+                    if routed:
+                        # Probes do not know a valid id or secret
+                        webhook_id = webhook_router.webhook_id(token) if token in known else uuid.uuid4().hex
+                        path, headers = f"/webhook/telegram/{webhook_id}", {
+                            "X-Telegram-Bot-Api-Secret-Token": webhook_router.secret(token) if token in known else "guess"}
+                    else:
+                        path, headers = f"/webhook/{token}", {"X-Telegram-Bot-Api-Secret-Token": "benchmark"}
+                    started = time.perf_counter()
+                    response = await client.post(path, json=payload, headers=headers)
+                    if token in known:
+                        latencies.append(time.perf_counter() - started)
+                    rejected += response.status_code == 401
+
+                await asyncio.gather(*(deliver(i, token) for i, token in enumerate(requests)))
+                await wait_for_drain(worker_pool)
+                print(f"{'/webhook/telegram/{id}' if routed else '/webhook/{token}':<22} "
+                      f"{percentile(latencies, 50) * 1000:>12.1f} ms {percentile(latencies, 95) * 1000:>6.1f} ms "
+                      f"{rejected:>9} {lookups['tenant']:>15} {lookups['routes']:>12}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the BotAI backend")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    concurrency = subparsers.add_parser("concurrency", help="Webhook throughput as concurrency grows")
+    concurrency.add_argument("--requests", type=int, default=500)
+    concurrency.add_argument("--latency-ms", type=float, default=50)
+    concurrency.add_argument("--model-latency-ms", type=float, default=None, help="defaults to --latency-ms")
+    concurrency.add_argument("--levels", type=int, nargs="+", default=[1, 10, 100, 500])
+    concurrency.set_defaults(func=run_concurrency)
+
+    retrieval = subparsers.add_parser("retrieval", help="Prompt tokens and recall with KB retrieval vs full KB")
+    retrieval.add_argument("--top-k", type=int, default=4)
+    retrieval.add_argument("--chunk-size", type=int, default=800)
+    retrieval.add_argument("--embeddings", default="none", choices=["none", "hashing", "sentence-transformers"])
+    retrieval.set_defaults(func=run_retrieval)
+
+    telegram = subparsers.add_parser("telegram", help="Bot API send latency against a local stub server")
+    telegram.add_argument("--requests", type=int, default=500)
+    telegram.add_argument("--concurrency", type=int, default=20)
+    telegram.add_argument("--latency-ms", type=float, default=5)
+    telegram.add_argument("--throttle-seconds", type=float, default=1)
+    telegram.add_argument("--burst", type=int, default=150)
+    telegram.set_defaults(func=run_telegram)
+
+    streaming = subparsers.add_parser("streaming", help="Time to first visible text with streaming edits")
+    streaming.add_argument("--requests", type=int, default=20)
+    streaming.add_argument("--first-token-ms", type=float, default=400)
+    streaming.add_argument("--chunk-ms", type=float, default=150)
+    streaming.add_argument("--chunks", type=int, default=30)
+    streaming.add_argument("--edit-interval", type=float, default=1.0)
+    streaming.add_argument("--latency-ms", type=float, default=20)
+    streaming.set_defaults(func=run_streaming)
+
+    tokens = subparsers.add_parser("tokens", help="Calibrate the local token estimator against Gemini")
+    tokens.add_argument("--top-k", type=int, default=4)
+    tokens.set_defaults(func=run_tokens)
+
+    cache = subparsers.add_parser("cache", help="Response cache hit rate on repeated and paraphrased questions")
+    cache.add_argument("--messages", type=int, default=1000)
+    cache.add_argument("--similarity", type=float, default=0.75)
+    cache.set_defaults(func=run_cache)
+
+    context = subparsers.add_parser("context-cache", help="Full-KB prompts vs a provider-cached prompt prefix")
+    context.add_argument("--messages", type=int, default=50)
+    context.add_argument("--kb-tokens", type=int, default=40000)
+    context.add_argument("--min-tokens", type=int, default=32768)
+    context.add_argument("--prefill-us", type=float, default=20)
+    context.add_argument("--output-ms", type=float, default=300)
+    context.set_defaults(func=run_context_cache)
+
+    routing = subparsers.add_parser("routing", help="Tokens and latency with model routing by query tier")
+    routing.add_argument("--full-ms", type=float, default=1200)
+    routing.add_argument("--small-ms", type=float, default=350)
+    routing.set_defaults(func=run_routing)
+
+    coalescing = subparsers.add_parser("coalescing", help="Model calls and latency for a burst of identical questions")
+    coalescing.add_argument("--identical", type=int, default=200)
+    coalescing.add_argument("--distinct", type=int, default=20)
+    coalescing.add_argument("--spread-ms", type=float, default=3000)
+    coalescing.add_argument("--model-ms", type=float, default=1200)
+    coalescing.add_argument("--provider-concurrency", type=int, default=10)
+    coalescing.set_defaults(func=run_coalescing)
+
+    resilience = subparsers.add_parser("resilience", help="Circuit breaker during a brownout, hedging on a slow tail")
+    resilience.add_argument("--rate", type=float, default=50)
+    resilience.add_argument("--seconds", type=float, default=10)
+    resilience.add_argument("--model-ms", type=float, default=300)
+    resilience.add_argument("--brownout-start", type=float, default=2)
+    resilience.add_argument("--brownout-end", type=float, default=6)
+    resilience.add_argument("--slow-ratio", type=float, default=0.04)
+    resilience.add_argument("--slow-factor", type=float, default=10)
+    resilience.set_defaults(func=run_resilience)
+
+    bulkheads = subparsers.add_parser("bulkheads", help="Per-tenant isolation with one tenant flooding the queue")
+    bulkheads.add_argument("--workers", type=int, default=50)
+    bulkheads.add_argument("--noisy", type=int, default=2000)
+    bulkheads.add_argument("--noisy-ms", type=float, default=2000)
+    bulkheads.add_argument("--quiet-rate", type=float, default=20)
+    bulkheads.add_argument("--quiet-ms", type=float, default=300)
+    bulkheads.add_argument("--seconds", type=float, default=10)
+    bulkheads.add_argument("--max-wait", type=float, default=10)
+    bulkheads.set_defaults(func=run_bulkheads)
+
+    memory = subparsers.add_parser("memory", help="Prompt size over a long conversation with bounded memory")
+    memory.add_argument("--turns", type=int, default=40)
+    memory.add_argument("--answer-words", type=int, default=60)
+    memory.add_argument("--max-turns", type=int, default=6)
+    memory.add_argument("--history-tokens", type=int, default=400)
+    memory.set_defaults(func=run_memory)
+
+    analytics = subparsers.add_parser("analytics", help="Dashboard analytics writes, per message vs batched")
+    analytics.add_argument("--messages", type=int, default=2000)
+    analytics.add_argument("--chats", type=int, default=300)
+    analytics.add_argument("--seconds", type=float, default=10)
+    analytics.add_argument("--db-latency-ms", type=float, default=20)
+    analytics.add_argument("--flush-interval", type=float, default=5)
+    analytics.set_defaults(func=run_analytics)
+
+    dedup = subparsers.add_parser("dedup", help="Telegram redeliveries with and without update_id dedup")
+    dedup.add_argument("--updates", type=int, default=300)
+    dedup.add_argument("--redelivery", type=float, default=0.3)
+    dedup.add_argument("--redelivery-delay-ms", type=float, default=1500)
+    dedup.add_argument("--latency-ms", type=float, default=20)
+    dedup.add_argument("--model-ms", type=float, default=500)
+    dedup.set_defaults(func=run_dedup)
+
+    polling = subparsers.add_parser("polling", help="getUpdates ingestion across a restart, against a stub server")
+    polling.add_argument("--bots", type=int, default=5)
+    polling.add_argument("--rate", type=float, default=1000)
+    polling.add_argument("--enqueue-ms", type=float, default=1)
+    polling.add_argument("--seconds", type=float, default=6)
+    polling.add_argument("--latency-ms", type=float, default=30)
+    polling.add_argument("--poll-timeout", type=int, default=2)
+    polling.add_argument("--limit", type=int, default=100)
+    polling.set_defaults(func=run_polling)
+
+    webhooks = subparsers.add_parser("webhooks", help="Token-in-path webhooks vs per-bot routing with probing traffic")
+    webhooks.add_argument("--bots", type=int, default=1000)
+    webhooks.add_argument("--requests", type=int, default=1000)
+    webhooks.add_argument("--probes", type=int, default=500)
+    webhooks.add_argument("--rate", type=float, default=500)
+    webhooks.add_argument("--latency-ms", type=float, default=20)
+    webhooks.add_argument("--model-ms", type=float, default=50)
+    webhooks.set_defaults(func=run_webhooks)
+
+    args = parser.parse_args()
+    asyncio.run(args.func(args))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+import logging
+from collections import defaultdict, deque
+from dataclasses import dataclass
+from typing import Any, Dict, Optional, Set
+
+import backend.config as config
+from backend.cache import MISSING
+from backend.tenant_context import tenant_cache
+
+logger = logging.getLogger(__name__)
+
+# Sent instead of an answer when a tenant's share of the workers is used up
+BUSY_MESSAGE = "Sorry, we're receiving a lot of messages right now. Please try again in a minute."
+
+class TenantOverloaded(Exception):
+    """The tenant already has its maximum number of queued messages."""
+
+@dataclass
+class TenantLimits:
+    weight: int  # jobs dequeued per round-robin turn
+    max_concurrency: int  # jobs processed at once
+    max_queued: int  # jobs waiting before new ones are shed
+
+def parse_plan_weights(value: str) -> Dict[str, int]:
+    """'free:1,pro:4' -> {'free': 1, 'pro': 4}"""
+    weights = {}
+    for item in value.split(","):
+        name, _, weight = item.partition(":")
+        if name.strip() and weight.strip():
+            weights[name.strip().lower()] = max(1, int(weight))
+    return weights
+
+PLAN_WEIGHTS = parse_plan_weights(config.BULKHEAD_PLAN_WEIGHTS)
+
+def plan_limits(plan: Optional[Dict[str, Any]]) -> TenantLimits:
+    """Limits for a plan: features.queue_weight / max_concurrency / max_queued, else by plan name.
+
+    The weight comes from the first BULKHEAD_PLAN_WEIGHTS entry whose name
+    appears in the plan name ("Enterprise Plan" -> enterprise); concurrency
+    and queue length scale with it.
+    """
+    plan = plan or {}
+    features = plan.get('features') if isinstance(plan.get('features'), dict) else {}
+    name = (plan.get('name') or "").lower()
+    weight = next((w for key, w in PLAN_WEIGHTS.items() if key in name), 1)
+    weight = max(1, int(features.get('queue_weight') or weight))
+    return TenantLimits(
+        weight=weight,
+        max_concurrency=max(1, int(features.get('max_concurrency')
+                                   or min(config.WORKER_CONCURRENCY, config.BULKHEAD_CONCURRENCY_PER_WEIGHT * weight))),
+        max_queued=max(1, int(features.get('max_queued') or config.BULKHEAD_QUEUED_PER_WEIGHT * weight))
+    )
+
+class Bulkhead:
+    """Per-tenant isolation for the webhook workers.
+
+    Each tenant (bot token) gets a plan-weighted share of the dequeue turns,
+    at most max_concurrency jobs in flight (further jobs stay queued while
+    other tenants are served), and at most max_queued waiting jobs; beyond
+    that, and for jobs that waited longer than max_wait, the customer gets a
+    short "busy" reply instead of an answer. Limits come from the cached
+    tenant context, so a bot's first messages use the default plan's limits.
+    """
+
+    def __init__(self, max_wait: float = 60.0):
+        self.max_wait = max_wait
+        self.in_flight: Dict[str, int] = defaultdict(int)
+        # Tenants at their concurrency limit; the queue skips them (read live while waiting)
+        self.saturated: Set[str] = set()
+        self._limits: Dict[str, TenantLimits] = {}
+        self._labels: Dict[str, str] = {}
+        # label -> [jobs, total wait, max wait, shed when full, shed after waiting]
+        self._tenants: Dict[str, list] = defaultdict(lambda: [0, 0.0, 0.0, 0, 0])
+        self._waits: Dict[str, deque] = defaultdict(lambda: deque(maxlen=200))
+
+    def limits(self, tenant_key: str) -> TenantLimits:
+        """The tenant's current limits, refreshed from the cached tenant context if present."""
+        context = tenant_cache.peek(tenant_key)
+        if context is not MISSING and context is not None:
+            self._limits[tenant_key] = plan_limits(context.plan)
+            self._labels[tenant_key] = context.company_id
+        return self._limits.get(tenant_key) or plan_limits(None)
+
+    def label(self, tenant_key: str) -> str:
+        """Company id for metrics when known; never the full bot token."""
+        return self._labels.get(tenant_key) or f"{tenant_key[:10]}..."
+
+    def acquire(self, tenant_key: str, waited: float) -> bool:
+        """Starts a dequeued job. False if it waited too long and should get the busy reply."""
+        totals = self._tenants[self.label(tenant_key)]
+        totals[0] += 1
+        totals[1] += waited
+        totals[2] = max(totals[2], waited)
+        self._waits[self.label(tenant_key)].append(waited)
+        if self.max_wait and waited > self.max_wait:
+            totals[4] += 1
+            logger.warning(f"Shedding message for {self.label(tenant_key)} after {waited:.1f}s in the queue")
+            return False
+        self.in_flight[tenant_key] += 1
+        if self.in_flight[tenant_key] >= self.limits(tenant_key).max_concurrency:
+            self.saturated.add(tenant_key)
+        return True
+
+    def release(self, tenant_key: str) -> bool:
+        """Finishes a job. True if the tenant was saturated and can be served again."""
+        self.in_flight[tenant_key] -= 1
+        if self.in_flight[tenant_key] <= 0:
+            del self.in_flight[tenant_key]
+        if tenant_key in self.saturated and self.in_flight.get(tenant_key, 0) < self.limits(tenant_key).max_concurrency:
+            self.saturated.discard(tenant_key)
+            return True
+        return False
+
+    def check_queued(self, tenant_key: str, queued: int) -> None:
+        """Raises TenantOverloaded if the tenant already has max_queued waiting jobs."""
+        if queued >= self.limits(tenant_key).max_queued:
+            self._tenants[self.label(tenant_key)][3] += 1
+            logger.warning(f"Shedding message for {self.label(tenant_key)}: {queued} messages already queued")
+            raise TenantOverloaded(tenant_key)
+
+    def stats(self) -> Dict[str, Any]:
+        """Per-tenant queue wait, concurrency and shedding for the /metrics endpoint."""
+        tenants = {}
+        for label, (jobs, total_wait, max_wait, shed_full, shed_wait) in self._tenants.items():
+            waits = sorted(self._waits[label])
+            tenants[label] = {
+                'jobs': jobs,
+                'avg_wait_ms': round(total_wait / jobs * 1000, 1) if jobs else 0.0,
+                'p95_wait_ms': round(waits[min(len(waits) - 1, int(0.95 * len(waits)))] * 1000, 1) if waits else 0.0,
+                'max_wait_ms': round(max_wait * 1000, 1),
+                'shed_queue_full': shed_full,
+                'shed_waited_too_long': shed_wait
+            }
+        for tenant_key, count in self.in_flight.items():
+            limits = self.limits(tenant_key)
+            tenants.setdefault(self.label(tenant_key), {}).update(
+                in_flight=count, max_concurrency=limits.max_concurrency, weight=limits.weight
+            )
+        return {
+            'saturated_tenants': len(self.saturated),
+            'max_wait_seconds': self.max_wait,
+            'tenants': tenants
+        }
+
+bulkhead = Bulkhead(max_wait=config.BULKHEAD_MAX_QUEUE_WAIT)
@@ -0,0 +1,93 @@
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+# Returned by TTLCache.get when a key is absent or expired (None is a valid cached value)
+MISSING = object()
+
+class TTLCache:
+    """Size-bounded LRU cache whose entries expire after a TTL.
+
+    Caching None records a negative result (e.g. an unknown bot token),
+    which uses negative_ttl so missing rows are re-checked sooner.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 300.0, negative_ttl: Optional[float] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key: Hashable) -> Any:
+        """Returns the cached value, or MISSING if absent or expired."""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return MISSING
+        value, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            self.misses += 1
+            return MISSING
+        self._entries.move_to_end(key)
+        if value is None:
+            self.negative_hits += 1
+        else:
+            self.hits += 1
+        return value
+
+    def peek(self, key: Hashable) -> Any:
+        """Like get, but without counting a lookup or refreshing the LRU order."""
+        entry = self._entries.get(key)
+        if entry is None or entry[1] <= time.monotonic():
+            return MISSING
+        return entry[0]
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        """Stores a value, evicting the least recently used entry when full."""
+        if ttl is None:
+            ttl = self.negative_ttl if value is None else self.ttl
+        self._entries[key] = (value, time.monotonic() + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key: Hashable) -> bool:
+        """Drops one entry. Returns True if it was cached."""
+        if self._entries.pop(key, None) is not None:
+            self.invalidations += 1
+            return True
+        return False
+
+    def clear(self) -> None:
+        """Drops every entry."""
+        self.invalidations += len(self._entries)
+        self._entries.clear()
+
+    def items(self) -> List[Tuple[Hashable, Any]]:
+        """Snapshot of the live (unexpired) entries."""
+        now = time.monotonic()
+        return [(key, value) for key, (value, expires_at) in self._entries.items() if expires_at > now]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit/miss counters for the /metrics endpoint."""
+        lookups = self.hits + self.negative_hits + self.misses
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'negative_hits': self.negative_hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+            'hit_rate': round((self.hits + self.negative_hits) / lookups, 4) if lookups else 0.0
+        }
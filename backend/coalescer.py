@@ -0,0 +1,127 @@
+import asyncio
+import logging
+import math
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+import backend.config as config
+
+logger = logging.getLogger(__name__)
+
+BILLING_POLICIES = ("each", "leader", "split")
+
+@dataclass
+class CoalescedResult:
+    text: str
+    tokens: int  # tokens the one shared generation used
+    participants: int  # requests that received this answer
+    leader: bool  # True for the request that started the generation
+
+@dataclass
+class Flight:
+    task: asyncio.Future
+    participants: int = 1
+    text: str = ""
+    listeners: List[Callable[[str], None]] = field(default_factory=list)
+
+    def publish(self, text: str) -> None:
+        """Forwards the text streamed so far to every waiting request."""
+        self.text = text
+        for listener in list(self.listeners):
+            try:
+                listener(text)
+            except Exception as e:
+                logger.warning(f"Error forwarding streamed text to a coalesced request: {e}")
+
+class RequestCoalescer:
+    """Single-flight deduplication of identical in-flight AI queries.
+
+    Requests with the same key (company, normalized question, KB version,
+    model tier) that arrive while a generation is running wait for that
+    generation instead of starting their own. Streamed text is forwarded to
+    every waiting request as it arrives. The generation runs in its own
+    task, so it survives the cancellation of the request that started it.
+
+    The billing policy decides what each request is charged: "each" charges
+    every request the full tokens (as if it had not been coalesced),
+    "leader" charges only the request that started the generation, and
+    "split" divides the tokens between all requests (rounded up).
+    """
+
+    def __init__(self, billing: str = "each"):
+        if billing not in BILLING_POLICIES:
+            raise ValueError(f"Unknown coalescing billing policy: {billing}")
+        self.billing = billing
+        self._flights: Dict[Hashable, Flight] = {}
+        self.leaders = 0
+        self.followers = 0
+        self.tokens_saved = 0
+
+    async def run(self, key: Hashable,
+                  generate: Callable[[Callable[[str], None]], Awaitable[Tuple[str, int]]],
+                  on_text: Optional[Callable[[str], None]] = None) -> CoalescedResult:
+        """Returns the answer for key, generating it only if no identical request is in flight.
+
+        generate receives a callback for the text streamed so far.
+        """
+        flight = self._flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = Flight(task=None)
+            flight.task = asyncio.ensure_future(self._generate(key, flight, generate))
+            self._flights[key] = flight
+            self.leaders += 1
+        else:
+            flight.participants += 1
+            self.followers += 1
+            if on_text and flight.text:
+                on_text(flight.text)
+        if on_text:
+            flight.listeners.append(on_text)
+        try:
+            text, tokens = await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            # This request is gone (e.g. shutdown); the others still get the answer
+            # and share its cost without it
+            if on_text in flight.listeners:
+                flight.listeners.remove(on_text)
+            if not flight.task.done():
+                flight.participants -= 1
+            raise
+        if not leader:
+            self.tokens_saved += tokens
+        return CoalescedResult(text, tokens, flight.participants, leader)
+
+    async def _generate(self, key: Hashable, flight: Flight,
+                        generate: Callable[[Callable[[str], None]], Awaitable[Tuple[str, int]]]) -> Tuple[str, int]:
+        try:
+            return await generate(flight.publish)
+        finally:
+            # No one can join once the answer is out, so participants is final
+            self._flights.pop(key, None)
+
+    def billed_tokens(self, result: CoalescedResult, reserved: int) -> int:
+        """Tokens to charge one request under the billing policy.
+
+        A follower is never charged more than it reserved, so coalescing
+        cannot push a subscription past its plan limit.
+        """
+        if self.billing == "leader":
+            tokens = result.tokens if result.leader else 0
+        elif self.billing == "split":
+            tokens = math.ceil(result.tokens / max(result.participants, 1))
+        else:
+            tokens = result.tokens
+        return tokens if result.leader else min(tokens, reserved)
+
+    def stats(self) -> Dict[str, Any]:
+        """Coalescing counters for the /metrics endpoint."""
+        return {
+            'billing': self.billing,
+            'in_flight': len(self._flights),
+            'generations': self.leaders,
+            'coalesced_requests': self.followers,
+            'tokens_saved': self.tokens_saved
+        }
+
+coalescer = RequestCoalescer(billing=config.COALESCE_BILLING)
@@ -8,16 +8,185 @@ if os.getenv("ENVIRONMENT", "development") == "development":
 # API Keys from environment variables
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 TELEGRAM_WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET")
+# Key for deriving each bot's opaque webhook id and its own secret_token (/webhook/telegram/{id}).
+# Changing it invalidates every registered webhook; re-run /api/webhooks/setup afterwards.
+TELEGRAM_WEBHOOK_KEY = os.getenv("TELEGRAM_WEBHOOK_KEY") or TELEGRAM_WEBHOOK_SECRET
+# How often (seconds) bots changed in the database are applied to the webhook routing table
+WEBHOOK_ROUTES_REFRESH_INTERVAL = float(os.getenv("WEBHOOK_ROUTES_REFRESH_INTERVAL", "60"))
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
 ENVIRONMENT = os.getenv("ENVIRONMENT", "development")
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
 BACKEND_URL = os.getenv("BACKEND_URL", "http://localhost:8000")
 
+# Outbound HTTP client (Telegram Bot API) connection pool settings
+# (the Bot API base URL can point at a local stub server for benchmarks)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org")
+# Outbound pacing to Telegram's send limits (messages/second per bot and per chat).
+# Telegram counts over a sliding second, so a burst plus the refill rate must stay under it.
+TELEGRAM_BOT_RATE = float(os.getenv("TELEGRAM_BOT_RATE", "30"))
+TELEGRAM_BOT_BURST = float(os.getenv("TELEGRAM_BOT_BURST", "1"))
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+TELEGRAM_CHAT_BURST = float(os.getenv("TELEGRAM_CHAT_BURST", "1"))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "30"))
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "20"))
+
+# Background job queue for webhook processing ("memory" for single instance, "redis" for multi-instance)
+JOB_QUEUE_BACKEND = os.getenv("JOB_QUEUE_BACKEND", "memory")
+JOB_QUEUE_MAX_SIZE = int(os.getenv("JOB_QUEUE_MAX_SIZE", "10000"))
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "50"))
+SHUTDOWN_DRAIN_TIMEOUT = float(os.getenv("SHUTDOWN_DRAIN_TIMEOUT", "25"))
+# Telegram update_ids already accepted, so redeliveries are not answered twice
+# ("memory" for a single instance, "redis" to share across instances). Telegram drops updates after 24h.
+UPDATE_DEDUP_ENABLED = os.getenv("UPDATE_DEDUP_ENABLED", "true").lower() == "true"
+UPDATE_DEDUP_BACKEND = os.getenv("UPDATE_DEDUP_BACKEND", "memory")
+UPDATE_DEDUP_TTL = float(os.getenv("UPDATE_DEDUP_TTL", "86400"))
+UPDATE_DEDUP_MAX_SIZE = int(os.getenv("UPDATE_DEDUP_MAX_SIZE", "100000"))
+# How updates arrive: "webhook" (Telegram POSTs to /webhook/{token}) or "polling" (getUpdates
+# long polling for every active bot, for deployments without a public HTTPS endpoint).
+# Polling waits up to TELEGRAM_POLL_TIMEOUT seconds per call for up to TELEGRAM_POLL_LIMIT updates,
+# re-reads the active bots every TELEGRAM_POLL_BOTS_INTERVAL seconds, and persists each bot's
+# offset ("file" at TELEGRAM_OFFSET_PATH, or "redis") so a restart neither loses nor replays updates.
+TELEGRAM_INGESTION = os.getenv("TELEGRAM_INGESTION", "webhook").lower()
+TELEGRAM_POLL_TIMEOUT = int(os.getenv("TELEGRAM_POLL_TIMEOUT", "25"))
+TELEGRAM_POLL_LIMIT = int(os.getenv("TELEGRAM_POLL_LIMIT", "100"))
+TELEGRAM_POLL_BOTS_INTERVAL = float(os.getenv("TELEGRAM_POLL_BOTS_INTERVAL", "60"))
+TELEGRAM_OFFSET_BACKEND = os.getenv("TELEGRAM_OFFSET_BACKEND", "file")
+TELEGRAM_OFFSET_PATH = os.getenv("TELEGRAM_OFFSET_PATH", os.path.join(os.path.dirname(__file__), "telegram_offsets.json"))
+# Per-tenant bulkheads: plan-weighted fair queuing ("name:weight", matched against plan names),
+# concurrency and queued messages per unit of weight, and the longest a message may wait
+# in the queue before the customer gets a "busy" reply instead (seconds, 0 = no limit).
+# plans.features.queue_weight / max_concurrency / max_queued override these per plan.
+BULKHEAD_ENABLED = os.getenv("BULKHEAD_ENABLED", "true").lower() == "true"
+BULKHEAD_PLAN_WEIGHTS = os.getenv("BULKHEAD_PLAN_WEIGHTS", "free:1,basic:2,pro:4,enterprise:8")
+BULKHEAD_CONCURRENCY_PER_WEIGHT = int(os.getenv("BULKHEAD_CONCURRENCY_PER_WEIGHT", "5"))
+BULKHEAD_QUEUED_PER_WEIGHT = int(os.getenv("BULKHEAD_QUEUED_PER_WEIGHT", "100"))
+BULKHEAD_MAX_QUEUE_WAIT = float(os.getenv("BULKHEAD_MAX_QUEUE_WAIT", "60"))
+
+# In-process cache of bot token -> tenant context lookups (seconds)
+TENANT_CACHE_TTL = float(os.getenv("TENANT_CACHE_TTL", "60"))
+TENANT_CACHE_NEGATIVE_TTL = float(os.getenv("TENANT_CACHE_NEGATIVE_TTL", "30"))
+TENANT_CACHE_MAX_SIZE = int(os.getenv("TENANT_CACHE_MAX_SIZE", "10000"))
+# Knowledge base retrieval: only the top-k relevant chunks are sent in each prompt
+RETRIEVAL_ENABLED = os.getenv("RETRIEVAL_ENABLED", "true").lower() == "true"
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", "4"))
+RETRIEVAL_CHUNK_SIZE = int(os.getenv("RETRIEVAL_CHUNK_SIZE", "800"))
+RETRIEVAL_CHUNK_OVERLAP = int(os.getenv("RETRIEVAL_CHUNK_OVERLAP", "100"))
+# "none" (BM25 only), "hashing" (dependency-free) or "sentence-transformers"
+RETRIEVAL_EMBEDDING_BACKEND = os.getenv("RETRIEVAL_EMBEDDING_BACKEND", "none")
+# How often (seconds) changed knowledge_bases rows are applied to the retrieval indexes
+KB_RECONCILE_INTERVAL = float(os.getenv("KB_RECONCILE_INTERVAL", "60"))
+# Running token usage counters ("redis" with automatic in-process fallback, or "memory")
+USAGE_COUNTER_BACKEND = os.getenv("USAGE_COUNTER_BACKEND", "redis")
+# How often (seconds) counters are corrected against usage_logs
+USAGE_RECONCILE_INTERVAL = float(os.getenv("USAGE_RECONCILE_INTERVAL", "300"))
+# Reservations not committed or refunded within USAGE_RESERVATION_TTL seconds (the worker died,
+# or Redis was unreachable at commit time) are released back to the plan's budget
+USAGE_RESERVATION_TTL = float(os.getenv("USAGE_RESERVATION_TTL", "600"))
+# Write-behind buffer for usage_logs: bulk insert every N ms or M rows, whichever comes first.
+# Rows that cannot be written are appended to the spill file and replayed later.
+USAGE_FLUSH_INTERVAL_MS = float(os.getenv("USAGE_FLUSH_INTERVAL_MS", "500"))
+USAGE_FLUSH_BATCH_SIZE = int(os.getenv("USAGE_FLUSH_BATCH_SIZE", "500"))
+USAGE_BUFFER_MAX_ROWS = int(os.getenv("USAGE_BUFFER_MAX_ROWS", "10000"))
+USAGE_SPILL_PATH = os.getenv("USAGE_SPILL_PATH", os.path.join(os.path.dirname(__file__), "usage_spill.jsonl"))
+# Output token budget reserved per answer; a message is rejected before calling the
+# model unless at least MIN_OUTPUT_TOKENS of output still fit in the plan's limit
+MAX_OUTPUT_TOKENS = int(os.getenv("MAX_OUTPUT_TOKENS", "1024"))
+MIN_OUTPUT_TOKENS = int(os.getenv("MIN_OUTPUT_TOKENS", "64"))
+# Per-company cache of answers to repeated (or near-duplicate) questions; hits skip the model
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "true").lower() == "true"
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "21600"))
+RESPONSE_CACHE_MAX_SIZE = int(os.getenv("RESPONSE_CACHE_MAX_SIZE", "10000"))
+# Minimum Jaccard similarity of question terms for a near-duplicate hit
+RESPONSE_CACHE_SIMILARITY = float(os.getenv("RESPONSE_CACHE_SIMILARITY", "0.75"))
+# Tokens charged for an answer served from the cache
+RESPONSE_CACHE_HIT_TOKENS = int(os.getenv("RESPONSE_CACHE_HIT_TOKENS", "0"))
+# Text generation provider: "gemini", "openai" (any OpenAI-compatible /chat/completions API)
+# or "stub" (local fake with configurable latency, for load tests without API quota)
+LLM_PROVIDER = os.getenv("LLM_PROVIDER", "gemini")
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-1.5-flash")
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1")
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
+# Stub: log-normal time to first token and output length, output speed (0 = instant)
+LLM_STUB_LATENCY_MS = float(os.getenv("LLM_STUB_LATENCY_MS", "300"))
+LLM_STUB_LATENCY_SIGMA = float(os.getenv("LLM_STUB_LATENCY_SIGMA", "0"))
+LLM_STUB_OUTPUT_TOKENS = int(os.getenv("LLM_STUB_OUTPUT_TOKENS", "150"))
+LLM_STUB_OUTPUT_TOKENS_SIGMA = float(os.getenv("LLM_STUB_OUTPUT_TOKENS_SIGMA", "0"))
+LLM_STUB_TOKENS_PER_SECOND = float(os.getenv("LLM_STUB_TOKENS_PER_SECOND", "0"))
+LLM_STUB_SEED = int(os.getenv("LLM_STUB_SEED", "0"))
+
+# Every model call: per-attempt timeout (seconds, 0 = none) and a circuit breaker that opens
+# when at least LLM_BREAKER_FAILURE_RATE of the last LLM_BREAKER_WINDOW calls failed and then
+# answers with the fallback text for LLM_BREAKER_OPEN_SECONDS before probing the provider again
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "30"))
+LLM_BREAKER_FAILURE_RATE = float(os.getenv("LLM_BREAKER_FAILURE_RATE", "0.5"))
+LLM_BREAKER_WINDOW = int(os.getenv("LLM_BREAKER_WINDOW", "20"))
+LLM_BREAKER_MIN_CALLS = int(os.getenv("LLM_BREAKER_MIN_CALLS", "10"))
+LLM_BREAKER_OPEN_SECONDS = float(os.getenv("LLM_BREAKER_OPEN_SECONDS", "30"))
+# Hedged requests: a second identical call once the first is slower than the recent
+# p-th percentile latency, for at most LLM_HEDGE_MAX_RATIO of calls
+LLM_HEDGE_ENABLED = os.getenv("LLM_HEDGE_ENABLED", "false").lower() == "true"
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "95"))
+LLM_HEDGE_MIN_DELAY_MS = float(os.getenv("LLM_HEDGE_MIN_DELAY_MS", "500"))
+LLM_HEDGE_MAX_RATIO = float(os.getenv("LLM_HEDGE_MAX_RATIO", "0.1"))
+
+# Model routing: small talk gets a template reply, short simple questions the small model
+# (same provider; the small tier is off unless LLM_SMALL_MODEL is set), the rest the full model.
+# Plans can restrict tiers with features.model_tiers, e.g. ["template", "small"].
+ROUTER_ENABLED = os.getenv("ROUTER_ENABLED", "true").lower() == "true"
+LLM_SMALL_MODEL = os.getenv("LLM_SMALL_MODEL", "")
+ROUTER_SIMPLE_MAX_WORDS = int(os.getenv("ROUTER_SIMPLE_MAX_WORDS", "12"))
+ROUTER_SMALL_TOP_K = int(os.getenv("ROUTER_SMALL_TOP_K", "2"))
+ROUTER_SMALL_MAX_OUTPUT_TOKENS = int(os.getenv("ROUTER_SMALL_MAX_OUTPUT_TOKENS", "256"))
+
+# Provider-side caching of the prompt prefix (instructions + full KB) for large, stable KBs.
+# Used when the full KB goes into the prompt (RETRIEVAL_ENABLED=false)
+CONTEXT_CACHE_ENABLED = os.getenv("CONTEXT_CACHE_ENABLED", "false").lower() == "true"
+# Gemini cached content needs a versioned model name
+CONTEXT_CACHE_MODEL = os.getenv("CONTEXT_CACHE_MODEL", "models/gemini-1.5-flash-002")
+CONTEXT_CACHE_TTL = float(os.getenv("CONTEXT_CACHE_TTL", "3600"))
+# Smaller prefixes are sent in full (Gemini 1.5 rejects cached content under 32768 tokens)
+CONTEXT_CACHE_MIN_TOKENS = int(os.getenv("CONTEXT_CACHE_MIN_TOKENS", "32768"))
+CONTEXT_CACHE_MAX_SIZE = int(os.getenv("CONTEXT_CACHE_MAX_SIZE", "100"))
+# Identical questions (same company, KB version and model tier) arriving while one is being
+# answered wait for that answer instead of calling the model again. Billing for the shared
+# answer: "each" (every request pays the full tokens), "leader" (only the first) or "split"
+COALESCE_ENABLED = os.getenv("COALESCE_ENABLED", "true").lower() == "true"
+COALESCE_BILLING = os.getenv("COALESCE_BILLING", "each")
+# Per-chat conversation memory ("memory" or "redis"): the last CONVERSATION_MAX_TURNS messages
+# plus a rolling summary of older ones, put into the prompt within CONVERSATION_HISTORY_TOKENS.
+# Conversations idle for CONVERSATION_TTL seconds are forgotten. Only questions that look like
+# follow-ups get the history (and so skip the response cache and coalescing). Off by default.
+CONVERSATION_MEMORY_ENABLED = os.getenv("CONVERSATION_MEMORY_ENABLED", "false").lower() == "true"
+CONVERSATION_MEMORY_BACKEND = os.getenv("CONVERSATION_MEMORY_BACKEND", "memory")
+CONVERSATION_MAX_TURNS = int(os.getenv("CONVERSATION_MAX_TURNS", "6"))
+CONVERSATION_SUMMARY_TOKENS = int(os.getenv("CONVERSATION_SUMMARY_TOKENS", "150"))
+CONVERSATION_HISTORY_TOKENS = int(os.getenv("CONVERSATION_HISTORY_TOKENS", "400"))
+CONVERSATION_TTL = float(os.getenv("CONVERSATION_TTL", "86400"))
+CONVERSATION_MAX_SIZE = int(os.getenv("CONVERSATION_MAX_SIZE", "10000"))
+# Dashboard analytics (conversations.message_count and activities), aggregated in memory and
+# written in batches every ANALYTICS_FLUSH_INTERVAL seconds instead of once per message
+ANALYTICS_ENABLED = os.getenv("ANALYTICS_ENABLED", "true").lower() == "true"
+ANALYTICS_FLUSH_INTERVAL = float(os.getenv("ANALYTICS_FLUSH_INTERVAL", "5"))
+ANALYTICS_MAX_PENDING = int(os.getenv("ANALYTICS_MAX_PENDING", "100000"))
+# Multiplier on the local token estimator used for budgeting (>1 errs on the safe side)
+TOKEN_ESTIMATE_SCALE = float(os.getenv("TOKEN_ESTIMATE_SCALE", "1.15"))
+# Streaming mode: send the first chunk of an answer early, then edit it in place as it grows
+STREAMING_ENABLED = os.getenv("STREAMING_ENABLED", "false").lower() == "true"
+TELEGRAM_EDIT_INTERVAL = float(os.getenv("TELEGRAM_EDIT_INTERVAL", "1"))
+# Shared secret for Supabase database webhooks that call /api/cache/invalidate (disabled if unset)
+CACHE_INVALIDATION_SECRET = os.getenv("CACHE_INVALIDATION_SECRET")
+
 # Validate required environment variables
 import sys
-if not GOOGLE_API_KEY:
+if LLM_PROVIDER == "gemini" and not GOOGLE_API_KEY:
     print("ERROR: GOOGLE_API_KEY environment variable is required", file=sys.stderr)
     raise ValueError("GOOGLE_API_KEY environment variable is required")
-if not TELEGRAM_WEBHOOK_SECRET:
+if TELEGRAM_INGESTION not in ("webhook", "polling"):
+    print(f"ERROR: TELEGRAM_INGESTION must be 'webhook' or 'polling', got '{TELEGRAM_INGESTION}'", file=sys.stderr)
+    raise ValueError("TELEGRAM_INGESTION must be 'webhook' or 'polling'")
+# Also guarantees a TELEGRAM_WEBHOOK_KEY (it defaults to the secret) for the per-bot webhooks
+if TELEGRAM_INGESTION == "webhook" and not TELEGRAM_WEBHOOK_SECRET:
     print("ERROR: TELEGRAM_WEBHOOK_SECRET environment variable is required", file=sys.stderr)
     raise ValueError("TELEGRAM_WEBHOOK_SECRET environment variable is required")
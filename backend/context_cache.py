@@ -0,0 +1,148 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+import backend.config as config
+import backend.services as services
+
+logger = logging.getLogger(__name__)
+
+@dataclass
+class CachedContext:
+    version: Hashable
+    handle: Any
+    prefix_tokens: int
+    expires_at: float
+
+class ContextCache:
+    """Per-company cached prompt prefixes (instructions + full KB).
+
+    Large knowledge bases are uploaded once per KB version and TTL instead of
+    once per message; answers then send only the question. The entry is
+    recreated shortly before the provider expires it, or when the KB version
+    (documents_fingerprint) changes. KBs under min_tokens are not worth a
+    cache entry and keep using the full prompt.
+    """
+
+    def __init__(self, enabled: bool = True, ttl: float = 3600.0, min_tokens: int = 32768, max_size: int = 100):
+        self.enabled = enabled
+        self.ttl = ttl
+        self.min_tokens = min_tokens
+        self.max_size = max_size
+        # Recreate entries this long before the provider expires them
+        self.refresh_margin = min(60.0, ttl / 10)
+        self._entries: "OrderedDict[str, CachedContext]" = OrderedDict()
+        self._creating: Dict[Tuple[str, Hashable], asyncio.Future] = {}
+        self._too_small: Dict[str, Hashable] = {}  # company id -> KB version under min_tokens
+        self.hits = 0
+        self.creates = 0
+        self.failures = 0
+        self.skipped = 0
+        self.deletes = 0
+        self.prefix_tokens_saved = 0
+
+    async def get_prefix(self, company_id: str, version: Hashable, knowledge_base: str) -> Optional[Any]:
+        """The provider's handle to this KB's cached prompt prefix, or None to send the full prompt."""
+        if not self.enabled:
+            return None
+        entry = self._entries.get(company_id)
+        if entry is not None and entry.version == version and entry.expires_at > time.monotonic():
+            self._entries.move_to_end(company_id)
+            self.hits += 1
+            self.prefix_tokens_saved += entry.prefix_tokens
+            return entry.handle
+        if self._too_small.get(company_id) == version:
+            self.skipped += 1
+            return None
+
+        prefix = services.build_prompt_prefix(knowledge_base)
+        prefix_tokens = services.estimate_tokens(prefix, scale=1.0)
+        if prefix_tokens < self.min_tokens:
+            self._too_small[company_id] = version
+            self.skipped += 1
+            return None
+
+        # Concurrent messages for the same KB version share one upload
+        key = (company_id, version)
+        creating = self._creating.get(key)
+        if creating is None:
+            creating = self._creating[key] = asyncio.ensure_future(
+                self._create(company_id, version, prefix, prefix_tokens)
+            )
+            creating.add_done_callback(lambda _: self._creating.pop(key, None))
+        entry = await asyncio.shield(creating)
+        return entry.handle if entry is not None else None
+
+    async def _create(self, company_id: str, version: Hashable, prefix: str,
+                      prefix_tokens: int) -> Optional[CachedContext]:
+        try:
+            handle = await services.provider.create_cache(prefix, self.ttl)
+        except Exception as e:
+            # Answer with the full prompt; the next message tries again
+            self.failures += 1
+            logger.error(f"Error caching prompt prefix for company {company_id}: {e}")
+            return None
+        self.creates += 1
+        logger.info(f"Cached {prefix_tokens}-token prompt prefix for company: {company_id}")
+        entry = CachedContext(version, handle, prefix_tokens, time.monotonic() + self.ttl - self.refresh_margin)
+        previous = self._entries.pop(company_id, None)
+        self._entries[company_id] = entry
+        if previous is not None:
+            self._discard(previous)
+        while len(self._entries) > self.max_size:
+            _, evicted = self._entries.popitem(last=False)
+            self._discard(evicted)
+        return entry
+
+    def _discard(self, entry: CachedContext) -> None:
+        """Deletes a replaced entry on the provider's side (storage is billed until it expires)."""
+        async def delete() -> None:
+            try:
+                await services.provider.delete_cache(entry.handle)
+                self.deletes += 1
+            except Exception as e:
+                logger.warning(f"Error deleting cached prompt prefix: {e}")
+        asyncio.ensure_future(delete())
+
+    def invalidate_company(self, company_id: str) -> bool:
+        """Drops a company's cached prefix (its KB changed). Returns True if one was cached."""
+        self._too_small.pop(company_id, None)
+        entry = self._entries.pop(company_id, None)
+        if entry is None:
+            return False
+        self._discard(entry)
+        return True
+
+    async def close(self) -> None:
+        """Deletes every cached prefix; handles do not survive a restart anyway."""
+        entries = list(self._entries.values())
+        self._entries.clear()
+        for entry in entries:
+            try:
+                await services.provider.delete_cache(entry.handle)
+                self.deletes += 1
+            except Exception as e:
+                logger.warning(f"Error deleting cached prompt prefix: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        """Cache counters for the /metrics endpoint."""
+        return {
+            'enabled': self.enabled,
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'creates': self.creates,
+            'failures': self.failures,
+            'skipped': self.skipped,
+            'deletes': self.deletes,
+            'prefix_tokens_saved': self.prefix_tokens_saved
+        }
+
+context_cache = ContextCache(
+    enabled=config.CONTEXT_CACHE_ENABLED,
+    ttl=config.CONTEXT_CACHE_TTL,
+    min_tokens=config.CONTEXT_CACHE_MIN_TOKENS,
+    max_size=config.CONTEXT_CACHE_MAX_SIZE
+)
@@ -0,0 +1,212 @@
+import json
+import logging
+import re
+import time
+from abc import ABC, abstractmethod
+from typing import Any, Callable, Dict, List, Optional
+
+import backend.config as config
+import backend.services as services
+from backend.cache import MISSING, TTLCache
+
+logger = logging.getLogger(__name__)
+
+ROLES = {'user': "Customer", 'assistant': "Agent"}
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s")
+# Words that point back at something said earlier ("how long does that take?", "and the price?")
+_REFERENCE = re.compile(r"\b(it|its|that|this|these|those|they|them|their|there|one|ones|same|else|"
+                        r"more|also|too|instead|again|above|previous|earlier)\b", re.IGNORECASE)
+_CONTINUATION = re.compile(r"^(and|but|or|so|then|also|what about|how about)\b", re.IGNORECASE)
+
+def is_follow_up(question: str, max_words: int = 12) -> bool:
+    """Whether a question looks like it depends on the conversation so far.
+
+    A question that opens with a continuation ("and...", "what about...") is
+    one, and so is a short question that refers back to something with a
+    pronoun. Other questions are answered without history, so they can still
+    use the response cache and coalescing.
+    """
+    text = " ".join(question.split())
+    if _CONTINUATION.match(text):
+        return True
+    return len(text.split()) <= max_words and bool(_REFERENCE.search(text))
+
+def digest(role: str, text: str, max_words: int = 25) -> str:
+    """One summary line for a turn: its first sentence, at most max_words words."""
+    first = _SENTENCE_END.split(" ".join(text.split()), 1)[0]
+    words = first.split()
+    if len(words) > max_words:
+        first = " ".join(words[:max_words]) + "..."
+    return f"{ROLES[role]}: {first}"
+
+class ConversationMemory(ABC):
+    """Recent history per (bot, chat), so follow-up questions make sense to the model.
+
+    Each conversation keeps the last max_turns messages verbatim (a ring
+    buffer) and a rolling summary of older ones: a turn that falls out of
+    the buffer is folded into the summary as a one-line digest, and the
+    oldest digests are dropped beyond summary_tokens. No model call is made
+    to summarize. The history put into a prompt never exceeds history_tokens:
+    the newest turns first, then the summary if it still fits.
+
+    State is a small JSON document per chat, kept in-process (LRU with an
+    idle TTL) or in Redis, keyed like the chat's conversations row (bot, chat).
+    """
+
+    def __init__(self, max_turns: int = 6, summary_tokens: int = 150, history_tokens: int = 400,
+                 ttl: float = 86400.0):
+        self.max_turns = max_turns
+        self.summary_tokens = summary_tokens
+        self.history_tokens = history_tokens
+        self.ttl = ttl
+        self.loads = 0
+        self.saves = 0
+        self.errors = 0
+        self.history_tokens_sent = 0
+
+    @abstractmethod
+    async def _load(self, key: str) -> Optional[Dict[str, Any]]:
+        """The stored state, or None for a new conversation."""
+
+    @abstractmethod
+    async def _save(self, key: str, state: Dict[str, Any]) -> None:
+        """Stores the state, expiring it after ttl seconds."""
+
+    async def _update(self, key: str, change: Callable[[Optional[Dict[str, Any]]], Dict[str, Any]]) -> None:
+        """Replaces the chat's state with change(state); no other update may land in between."""
+        # No await between the read and the write matters for the in-process store
+        await self._save(key, change(await self._load(key)))
+
+    async def load(self, key: str) -> Dict[str, Any]:
+        """The chat's state: {'turns': [[role, text], ...], 'summary': [line, ...]}."""
+        self.loads += 1
+        try:
+            state = await self._load(key)
+        except Exception as e:
+            # Memory is best-effort: answer without history rather than fail the message
+            self.errors += 1
+            logger.warning(f"Error loading conversation {key}: {e}")
+            state = None
+        return state or {'turns': [], 'summary': []}
+
+    def render(self, state: Dict[str, Any]) -> str:
+        """The history for the prompt, within history_tokens."""
+        budget = self.history_tokens
+        lines: List[str] = []
+        for role, text in reversed(state['turns']):
+            line = f"{ROLES[role]}: {text}"
+            cost = services.estimate_tokens(line)
+            if cost > budget:
+                break
+            lines.append(line)
+            budget -= cost
+        lines.reverse()
+        if state['summary'] and len(lines) == len(state['turns']):
+            summary = "Earlier:\n" + "\n".join(state['summary'])
+            if services.estimate_tokens(summary) <= budget:
+                lines.insert(0, summary)
+        history = "\n".join(lines)
+        if history:
+            self.history_tokens_sent += services.estimate_tokens(history)
+        return history
+
+    async def history(self, key: str) -> str:
+        """The rendered history of a chat ("" for a new conversation)."""
+        return self.render(await self.load(key))
+
+    async def append(self, key: str, question: str, answer: str) -> None:
+        """Records one exchange (atomically, so concurrent answers in a chat do not drop turns)."""
+        def change(state: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+            state = state or {'turns': [], 'summary': []}
+            state['turns'].extend([['user', question], ['assistant', answer]])
+            while len(state['turns']) > self.max_turns:
+                role, text = state['turns'].pop(0)
+                state['summary'].append(digest(role, text))
+            while state['summary'] and services.estimate_tokens("\n".join(state['summary'])) > self.summary_tokens:
+                state['summary'].pop(0)
+            state['updated_at'] = time.time()
+            return state
+
+        try:
+            await self._update(key, change)
+            self.saves += 1
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f"Error saving conversation {key}: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        """Memory counters for the /metrics endpoint."""
+        return {
+            'backend': type(self).__name__,
+            'loads': self.loads,
+            'saves': self.saves,
+            'errors': self.errors,
+            'history_tokens_sent': self.history_tokens_sent
+        }
+
+class InMemoryConversationMemory(ConversationMemory):
+    """Per-process conversations; the least recently active are evicted first."""
+
+    def __init__(self, max_size: int = 10000, **kwargs):
+        super().__init__(**kwargs)
+        self._states = TTLCache(max_size=max_size, ttl=self.ttl)
+
+    async def _load(self, key: str) -> Optional[Dict[str, Any]]:
+        state = self._states.get(key)
+        return None if state is MISSING else state
+
+    async def _save(self, key: str, state: Dict[str, Any]) -> None:
+        self._states.set(key, state)
+
+    def stats(self) -> Dict[str, Any]:
+        return {**super().stats(), 'conversations': len(self._states)}
+
+class RedisConversationMemory(ConversationMemory):
+    """Conversations shared by every instance; Redis expires idle ones after the TTL."""
+
+    def __init__(self, redis, prefix: str = "botai:conversation", **kwargs):
+        super().__init__(**kwargs)
+        self.redis = redis
+        self.prefix = prefix
+
+    async def _load(self, key: str) -> Optional[Dict[str, Any]]:
+        raw = await self.redis.get(f"{self.prefix}:{key}")
+        return json.loads(raw) if raw else None
+
+    async def _save(self, key: str, state: Dict[str, Any]) -> None:
+        await self.redis.set(f"{self.prefix}:{key}", json.dumps(state), ex=int(self.ttl))
+
+    async def _update(self, key: str, change: Callable[[Optional[Dict[str, Any]]], Dict[str, Any]],
+                      attempts: int = 50) -> None:
+        """Optimistic read-modify-write: WATCH the key and retry if another instance wrote it first."""
+        from redis.exceptions import WatchError
+
+        name = f"{self.prefix}:{key}"
+        async with self.redis.pipeline(transaction=True) as pipe:
+            for _ in range(attempts):
+                try:
+                    await pipe.watch(name)
+                    raw = await pipe.get(name)
+                    state = change(json.loads(raw) if raw else None)
+                    pipe.multi()
+                    pipe.set(name, json.dumps(state), ex=int(self.ttl))
+                    await pipe.execute()
+                    return
+                except WatchError:
+                    continue
+        raise RuntimeError(f"conversation {key} kept changing during {attempts} attempts")
+
+def create_conversation_memory() -> ConversationMemory:
+    """Builds the store selected by config.CONVERSATION_MEMORY_BACKEND."""
+    options = dict(
+        max_turns=config.CONVERSATION_MAX_TURNS,
+        summary_tokens=config.CONVERSATION_SUMMARY_TOKENS,
+        history_tokens=config.CONVERSATION_HISTORY_TOKENS,
+        ttl=config.CONVERSATION_TTL
+    )
+    if config.CONVERSATION_MEMORY_BACKEND == "redis":
+        from backend.database import get_async_redis
+        return RedisConversationMemory(get_async_redis(), **options)
+    return InMemoryConversationMemory(max_size=config.CONVERSATION_MAX_SIZE, **options)
+
+conversation_memory = create_conversation_memory()
@@ -1,5 +1,7 @@
 import os
-from supabase import create_client, Client
+import asyncio
+from typing import Any, Callable, Dict, List, Optional
+from supabase import create_client, acreate_client, Client, AsyncClient
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
@@ -16,3 +18,57 @@ if not SUPABASE_KEY:
     raise ValueError("SUPABASE_KEY environment variable is required")
 
 supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+
+# Async client used by the webhook pipeline so database calls never block the event loop.
+# Created lazily because acreate_client must be awaited inside a running loop.
+_async_supabase: Optional[AsyncClient] = None
+_async_supabase_lock = asyncio.Lock()
+
+async def get_async_supabase() -> AsyncClient:
+    """Returns the shared async Supabase client, creating it on first use."""
+    global _async_supabase
+    if _async_supabase is None:
+        async with _async_supabase_lock:
+            if _async_supabase is None:
+                _async_supabase = await acreate_client(SUPABASE_URL, SUPABASE_KEY)
+    return _async_supabase
+
+# PostgREST returns at most max-rows (1000 by default on Supabase) rows per request
+SELECT_PAGE_SIZE = 1000
+
+async def select_all(build: Callable[[], Any], page_size: int = SELECT_PAGE_SIZE) -> List[Dict[str, Any]]:
+    """Every row of a select, fetched page by page with .range().
+
+    build returns a fresh query with a stable .order() (a unique column), so
+    pages neither overlap nor skip rows. Paging stops at the first empty
+    page, so a server max-rows below page_size still returns everything.
+    """
+    rows: List[Dict[str, Any]] = []
+    while True:
+        response = await build().range(len(rows), len(rows) + page_size - 1).execute()
+        page = response.data or []
+        if not page:
+            return rows
+        rows.extend(page)
+
+# Shared async Redis client for queues, caches and counters (REDIS_URL from config)
+_async_redis = None
+
+def get_async_redis():
+    """Returns the shared async Redis client, creating it on first use."""
+    global _async_redis
+    if _async_redis is None:
+        import redis.asyncio as aioredis
+        _async_redis = aioredis.from_url(
+            os.getenv("REDIS_URL", "redis://localhost:6379"),
+            socket_connect_timeout=2,
+            socket_timeout=5
+        )
+    return _async_redis
+
+async def close_async_redis() -> None:
+    """Closes the shared async Redis client (called on application shutdown)."""
+    global _async_redis
+    if _async_redis is not None:
+        await _async_redis.aclose()
+    _async_redis = None
@@ -0,0 +1,343 @@
+import asyncio
+import json
+import logging
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from typing import AbstractSet, Any, Awaitable, Callable, Deque, Dict, Optional, Tuple
+
+import backend.config as config
+from backend.bulkhead import Bulkhead
+
+logger = logging.getLogger(__name__)
+
+Job = Dict[str, Any]
+
+# Outcomes of queueing one incoming Telegram update (main.enqueue_update)
+ACCEPTED, DUPLICATE, EMPTY, SHED, REJECTED = "accepted", "duplicate", "empty", "shed", "rejected"
+
+class JobQueue(ABC):
+    """Interface for the webhook work queue.
+
+    Jobs are grouped by a tenant key and handed out round-robin across
+    tenants, so one busy bot cannot starve the others. A tenant with weight
+    n gets n jobs per turn, and tenants in `skip` (at their concurrency
+    limit) are passed over until they are woken.
+    """
+
+    # Durable queues keep undelivered jobs across restarts, so shutdown only
+    # needs to finish in-flight work instead of draining the whole queue.
+    durable = False
+
+    @abstractmethod
+    async def put(self, tenant_key: str, job: Job, weight: int = 1) -> bool:
+        """Enqueues a job. Returns False if the queue is full."""
+
+    @abstractmethod
+    async def get(self, timeout: Optional[float] = None,
+                  skip: AbstractSet[str] = frozenset()) -> Optional[Tuple[str, Job]]:
+        """Dequeues the next (tenant_key, job), or None if the timeout expires."""
+
+    @abstractmethod
+    async def size(self) -> int:
+        """Number of jobs waiting to be processed."""
+
+    @abstractmethod
+    async def tenant_size(self, tenant_key: str) -> int:
+        """Number of jobs waiting for one tenant."""
+
+    async def wake(self) -> None:
+        """Re-checks waiting getters after a skipped tenant became available."""
+
+    async def close(self) -> None:
+        """Releases any resources held by the queue."""
+
+class InMemoryJobQueue(JobQueue):
+    """Single-process queue with per-tenant weighted round-robin fairness."""
+
+    def __init__(self, max_size: int = 10000):
+        self.max_size = max_size
+        self._jobs: Dict[str, Deque[Job]] = {}
+        self._ready: Deque[str] = deque()  # tenants that have pending jobs, in service order
+        self._weights: Dict[str, int] = {}
+        self._served: Dict[str, int] = {}  # jobs handed out in the current turn of the front tenant
+        self._size = 0
+        self._not_empty = asyncio.Condition()
+
+    async def put(self, tenant_key: str, job: Job, weight: int = 1) -> bool:
+        if self._size >= self.max_size:
+            return False
+        async with self._not_empty:
+            self._weights[tenant_key] = weight
+            pending = self._jobs.get(tenant_key)
+            if pending is None:
+                pending = self._jobs[tenant_key] = deque()
+            if not pending:
+                self._ready.append(tenant_key)
+            pending.append(job)
+            self._size += 1
+            self._not_empty.notify()
+        return True
+
+    async def get(self, timeout: Optional[float] = None,
+                  skip: AbstractSet[str] = frozenset()) -> Optional[Tuple[str, Job]]:
+        def servable() -> bool:
+            return any(tenant_key not in skip for tenant_key in self._ready)
+
+        async with self._not_empty:
+            if not servable():
+                try:
+                    await asyncio.wait_for(self._not_empty.wait_for(servable), timeout)
+                except asyncio.TimeoutError:
+                    return None
+            while self._ready[0] in skip:
+                self._ready.rotate(-1)
+                self._served.pop(self._ready[-1], None)
+            tenant_key = self._ready.popleft()
+            pending = self._jobs[tenant_key]
+            job = pending.popleft()
+            self._size -= 1
+            served = self._served.get(tenant_key, 0) + 1
+            if not pending:
+                del self._jobs[tenant_key]
+                self._weights.pop(tenant_key, None)
+                self._served.pop(tenant_key, None)
+            elif served < self._weights.get(tenant_key, 1):
+                # Still within this tenant's turn
+                self._ready.appendleft(tenant_key)
+                self._served[tenant_key] = served
+            else:
+                self._ready.append(tenant_key)
+                self._served.pop(tenant_key, None)
+            return tenant_key, job
+
+    async def size(self) -> int:
+        return self._size
+
+    async def tenant_size(self, tenant_key: str) -> int:
+        return len(self._jobs.get(tenant_key, ()))
+
+    async def wake(self) -> None:
+        async with self._not_empty:
+            self._not_empty.notify_all()
+
+class RedisJobQueue(JobQueue):
+    """Redis-backed queue shared by every instance of the backend.
+
+    Each tenant has its own list and a ring list holds the tenants that
+    have pending jobs, which gives the same weighted round-robin fairness as
+    the in-memory queue across all instances. Enqueue and dequeue run as Lua
+    scripts so the ring and the tenant lists never disagree.
+    """
+
+    durable = True
+
+    PUT_SCRIPT = """
+    if tonumber(redis.call('GET', KEYS[3]) or '0') >= tonumber(ARGV[3]) then
+        return 0
+    end
+    if redis.call('RPUSH', KEYS[1], ARGV[1]) == 1 then
+        redis.call('RPUSH', KEYS[2], ARGV[2])
+    end
+    redis.call('HSET', KEYS[4], ARGV[2], ARGV[4])
+    redis.call('INCR', KEYS[3])
+    return 1
+    """
+
+    # ARGV[2..] are tenants to skip; they are rotated to the back of the ring
+    GET_SCRIPT = """
+    local skip = {}
+    for i = 2, #ARGV do
+        skip[ARGV[i]] = true
+    end
+    for _ = 1, redis.call('LLEN', KEYS[1]) do
+        local tenant = redis.call('LPOP', KEYS[1])
+        if not tenant then
+            return nil
+        end
+        if skip[tenant] then
+            redis.call('RPUSH', KEYS[1], tenant)
+            redis.call('HDEL', KEYS[4], tenant)
+        else
+            local tenant_list = ARGV[1] .. tenant
+            local job = redis.call('LPOP', tenant_list)
+            if redis.call('LLEN', tenant_list) > 0 then
+                local served = redis.call('HINCRBY', KEYS[4], tenant, 1)
+                if served < tonumber(redis.call('HGET', KEYS[3], tenant) or '1') then
+                    redis.call('LPUSH', KEYS[1], tenant)
+                else
+                    redis.call('HDEL', KEYS[4], tenant)
+                    redis.call('RPUSH', KEYS[1], tenant)
+                end
+            else
+                redis.call('HDEL', KEYS[3], tenant)
+                redis.call('HDEL', KEYS[4], tenant)
+            end
+            if job then
+                redis.call('DECR', KEYS[2])
+                return {tenant, job}
+            end
+        end
+    end
+    return nil
+    """
+
+    def __init__(self, redis, prefix: str = "botai:jobs", max_size: int = 10000, poll_interval: float = 0.05):
+        self.redis = redis
+        self.prefix = prefix
+        self.max_size = max_size
+        self.poll_interval = poll_interval
+        self._ring_key = f"{prefix}:ready"
+        self._size_key = f"{prefix}:size"
+        self._weights_key = f"{prefix}:weights"
+        self._served_key = f"{prefix}:served"
+        self._tenant_prefix = f"{prefix}:tenant:"
+        self._put = redis.register_script(self.PUT_SCRIPT)
+        self._get = redis.register_script(self.GET_SCRIPT)
+
+    async def put(self, tenant_key: str, job: Job, weight: int = 1) -> bool:
+        accepted = await self._put(
+            keys=[self._tenant_prefix + tenant_key, self._ring_key, self._size_key, self._weights_key],
+            args=[json.dumps(job), tenant_key, self.max_size, weight]
+        )
+        return bool(accepted)
+
+    async def get(self, timeout: Optional[float] = None,
+                  skip: AbstractSet[str] = frozenset()) -> Optional[Tuple[str, Job]]:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            popped = await self._get(
+                keys=[self._ring_key, self._size_key, self._weights_key, self._served_key],
+                args=[self._tenant_prefix, *skip]
+            )
+            if popped:
+                tenant_key, raw = popped
+                if isinstance(tenant_key, bytes):
+                    tenant_key = tenant_key.decode()
+                return tenant_key, json.loads(raw)
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+            await asyncio.sleep(self.poll_interval)
+
+    async def size(self) -> int:
+        return int(await self.redis.get(self._size_key) or 0)
+
+    async def tenant_size(self, tenant_key: str) -> int:
+        return int(await self.redis.llen(self._tenant_prefix + tenant_key))
+
+class WorkerPool:
+    """Pool of async workers that process jobs from a JobQueue.
+
+    With a Bulkhead, jobs are queued with their tenant's plan weight, tenants
+    at their concurrency limit are skipped, and jobs the bulkhead sheds go to
+    on_shed instead of the handler.
+    """
+
+    def __init__(self, queue: JobQueue, handler: Callable[[Job], Awaitable[None]], concurrency: int = 50,
+                 bulkhead: Optional[Bulkhead] = None, on_shed: Optional[Callable[[Job], Awaitable[None]]] = None):
+        self.queue = queue
+        self.handler = handler
+        self.concurrency = concurrency
+        self.bulkhead = bulkhead
+        self.on_shed = on_shed
+        self.accepting = False
+        self.in_flight = 0
+        self.processed = 0
+        self.failed = 0
+        self.shed = 0
+        self._workers = []
+        self._stopping = False
+
+    def start(self) -> None:
+        """Starts the worker tasks."""
+        self._stopping = False
+        self.accepting = True
+        self._workers = [asyncio.create_task(self._worker(i)) for i in range(self.concurrency)]
+        logger.info(f"Started {self.concurrency} webhook workers")
+
+    async def submit(self, tenant_key: str, job: Job) -> bool:
+        """Enqueues a job. Returns False if shutting down or the queue is full.
+
+        Raises TenantOverloaded if the bulkhead sheds it (the tenant's queue share is full).
+        """
+        if not self.accepting:
+            return False
+        job.setdefault('enqueued_at', time.time())
+        if self.bulkhead is None:
+            return await self.queue.put(tenant_key, job)
+        self.bulkhead.check_queued(tenant_key, await self.queue.tenant_size(tenant_key))
+        return await self.queue.put(tenant_key, job, weight=self.bulkhead.limits(tenant_key).weight)
+
+    async def _worker(self, worker_id: int) -> None:
+        skip = self.bulkhead.saturated if self.bulkhead else frozenset()
+        while not self._stopping:
+            item = await self.queue.get(timeout=1.0, skip=skip)
+            if item is None:
+                continue
+            tenant_key, job = item
+            if self.bulkhead and not self.bulkhead.acquire(tenant_key, time.time() - job.get('enqueued_at', time.time())):
+                await self._shed(worker_id, tenant_key, job)
+                continue
+            self.in_flight += 1
+            try:
+                await self.handler(job)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"Worker {worker_id} failed to process job for {tenant_key[:10]}...: {e}", exc_info=True)
+            finally:
+                self.in_flight -= 1
+                if self.bulkhead and self.bulkhead.release(tenant_key):
+                    await self.queue.wake()
+
+    async def _shed(self, worker_id: int, tenant_key: str, job: Job) -> None:
+        self.shed += 1
+        if self.on_shed is None:
+            return
+        try:
+            await self.on_shed(job)
+        except Exception as e:
+            logger.error(f"Worker {worker_id} failed to shed job for {tenant_key[:10]}...: {e}")
+
+    async def stop(self, timeout: float = 25.0) -> None:
+        """Stops accepting jobs, drains the queue and waits for in-flight jobs."""
+        self.accepting = False
+        deadline = time.monotonic() + timeout
+        if not self.queue.durable:
+            while time.monotonic() < deadline:
+                if await self.queue.size() == 0 and self.in_flight == 0:
+                    break
+                await asyncio.sleep(0.05)
+
+        # Workers exit after their current job; anything still running at the deadline is cancelled
+        self._stopping = True
+        if self._workers:
+            _, still_running = await asyncio.wait(self._workers, timeout=max(deadline - time.monotonic(), 0) + 1.0)
+            if still_running:
+                logger.warning(f"Shutdown drain timed out with {await self.queue.size()} queued and {self.in_flight} in-flight jobs")
+            for worker in still_running:
+                worker.cancel()
+            await asyncio.gather(*still_running, return_exceptions=True)
+        self._workers = []
+        await self.queue.close()
+
+    async def stats(self) -> Dict[str, Any]:
+        """Queue and worker counters for the /metrics endpoint."""
+        return {
+            'backend': type(self.queue).__name__,
+            'workers': self.concurrency,
+            'queued': await self.queue.size(),
+            'in_flight': self.in_flight,
+            'processed': self.processed,
+            'failed': self.failed,
+            'shed': self.shed,
+            'accepting': self.accepting,
+            'bulkhead': self.bulkhead.stats() if self.bulkhead else None
+        }
+
+def create_job_queue() -> JobQueue:
+    """Builds the job queue selected by config.JOB_QUEUE_BACKEND."""
+    if config.JOB_QUEUE_BACKEND == "redis":
+        from backend.database import get_async_redis
+        return RedisJobQueue(get_async_redis(), max_size=config.JOB_QUEUE_MAX_SIZE)
+    return InMemoryJobQueue(max_size=config.JOB_QUEUE_MAX_SIZE)
@@ -0,0 +1,150 @@
+import asyncio
+import logging
+from collections import defaultdict
+from typing import Any, Dict, List, Optional
+
+from supabase import PostgrestAPIError
+
+import backend.config as config
+import backend.retrieval as retrieval
+import backend.tenant_context as tenant_context
+from backend.database import get_async_supabase, select_all
+from backend.response_cache import response_cache
+
+logger = logging.getLogger(__name__)
+
+class KnowledgeBaseReconciler:
+    """Keeps retrieval indexes in step with the knowledge_bases table.
+
+    Every interval it reads only the rows whose updated_at (maintained by the
+    update_knowledge_bases_updated_at trigger) is at or past the last watermark,
+    and applies them to the indexes of companies that have one. Unchanged rows
+    are skipped by content hash, so editing one FAQ entry re-chunks one row.
+    Deleted rows are detected from a cheap id-only listing. Both queries are
+    paged and cover company_batch companies at a time, so neither large
+    tenants nor many tenants are cut off by the row cap or the URL length.
+    The watermark starts at the table's newest updated_at (database clock).
+    """
+
+    def __init__(self, engine: retrieval.RetrievalEngine, interval: float = 60.0, company_batch: int = 50):
+        self.engine = engine
+        self.interval = interval
+        self.company_batch = company_batch
+        self.watermark: Optional[str] = None
+        self.runs = 0
+        self.rows_reindexed = 0
+        self.errors = 0
+        self._task: Optional[asyncio.Task] = None
+
+    async def reconcile(self) -> Dict[str, int]:
+        """Runs one reconciliation pass. Returns counts of changed and deleted rows."""
+        companies = self.engine.indexed_companies()
+        if not companies:
+            return {'changed': 0, 'deleted': 0}
+
+        supabase = await get_async_supabase()
+        if self.watermark is None:
+            await self._seed_watermark()
+        watermark = self.watermark
+        changed: List[Dict[str, Any]] = []
+        listing: List[Dict[str, Any]] = []
+        for start in range(0, len(companies), self.company_batch):
+            batch = companies[start:start + self.company_batch]
+
+            def changed_rows(batch=batch):
+                query = supabase.table('knowledge_bases') \
+                    .select('id, company_id, content, updated_at') \
+                    .in_('company_id', batch) \
+                    .order('id')
+                # Rows at the watermark are re-read; content hashes make that a no-op
+                return query.gte('updated_at', watermark) if watermark else query
+
+            changed += await select_all(changed_rows)
+            listing += await select_all(
+                lambda batch=batch: supabase.table('knowledge_bases')
+                .select('id, company_id')
+                .in_('company_id', batch)
+                .order('id')
+            )
+
+        upserts: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+        for row in changed:
+            upserts[row['company_id']].append(row)
+            if row.get('updated_at') and (self.watermark is None or row['updated_at'] > self.watermark):
+                self.watermark = row['updated_at']
+
+        existing: Dict[str, set] = defaultdict(set)
+        for row in listing:
+            existing[row['company_id']].add(str(row['id']))
+
+        changed_count = deleted_count = 0
+        for company_id in companies:
+            deleted = [doc_id for doc_id in self.engine.indexed_document_ids(company_id)
+                       if doc_id not in existing[company_id]]
+            rows = upserts.get(company_id, [])
+            if not rows and not deleted:
+                continue
+            applied = self.engine.apply_changes(company_id, rows, deleted)
+            if applied:
+                # The cached context and answers still reflect the old rows; reload on the next message
+                tenant_context.invalidate_tenant(company_id=company_id)
+                response_cache.invalidate_company(company_id)
+                changed_count += applied - len(deleted)
+                deleted_count += len(deleted)
+
+        self.runs += 1
+        self.rows_reindexed += changed_count
+        if changed_count or deleted_count:
+            logger.info(f"Reconciled knowledge bases: {changed_count} changed, {deleted_count} deleted rows")
+        return {'changed': changed_count, 'deleted': deleted_count}
+
+    async def _seed_watermark(self) -> None:
+        """Starts the watermark at the newest updated_at in the table (None while it is empty)."""
+        supabase = await get_async_supabase()
+        newest = await supabase.table('knowledge_bases') \
+            .select('updated_at') \
+            .order('updated_at', desc=True) \
+            .limit(1) \
+            .execute()
+        if newest.data and newest.data[0].get('updated_at'):
+            self.watermark = newest.data[0]['updated_at']
+
+    async def _run(self) -> None:
+        try:
+            await self._seed_watermark()
+        except Exception as e:
+            # Seeded on the first reconcile instead
+            logger.warning(f"Error reading the knowledge base watermark: {e}")
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.reconcile()
+            except PostgrestAPIError as e:
+                self.errors += 1
+                logger.error(f"Database error reconciling knowledge bases: {e}")
+            except Exception as e:
+                self.errors += 1
+                logger.error(f"Unexpected error reconciling knowledge bases: {e}")
+
+    def start(self) -> None:
+        """Starts the periodic reconciliation task."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Cancels the periodic reconciliation task."""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def stats(self) -> Dict[str, Any]:
+        """Reconciler counters for the /metrics endpoint."""
+        return {
+            'watermark': self.watermark,
+            'runs': self.runs,
+            'rows_reindexed': self.rows_reindexed,
+            'errors': self.errors
+        }
+
+reconciler = KnowledgeBaseReconciler(retrieval.engine, interval=config.KB_RECONCILE_INTERVAL)
@@ -0,0 +1,318 @@
+import asyncio
+import datetime
+import hashlib
+import json
+import logging
+import math
+import random
+import re
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Dict, Optional
+
+import httpx
+
+import backend.config as config
+
+logger = logging.getLogger(__name__)
+
+@dataclass
+class Generation:
+    text: str
+    total_tokens: Optional[int] = None  # as billed by the provider; None if it did not say
+
+class GenerationStream:
+    """Async iterator over the text pieces of an answer.
+
+    total_tokens is filled in once the stream is exhausted (None if the
+    provider did not report usage).
+    """
+
+    def __init__(self):
+        self.total_tokens: Optional[int] = None
+        self.pieces: Optional[AsyncIterator[str]] = None
+
+    def __aiter__(self) -> AsyncIterator[str]:
+        return self.pieces
+
+class LLMProvider(ABC):
+    """Interface to a text generation model: generate, stream, count tokens and cache prompt prefixes.
+
+    cached_prefix is a handle returned by create_cache(); when given, the
+    prompt passed to generate()/stream() is only the text that follows the
+    cached prefix.
+    """
+
+    @abstractmethod
+    async def generate(self, prompt: str, max_output_tokens: Optional[int] = None,
+                       cached_prefix: Any = None) -> Generation:
+        """Generates a complete answer."""
+
+    def stream(self, prompt: str, max_output_tokens: Optional[int] = None,
+               cached_prefix: Any = None) -> GenerationStream:
+        stream = GenerationStream()
+        stream.pieces = self._stream(prompt, max_output_tokens, cached_prefix, stream)
+        return stream
+
+    @abstractmethod
+    def _stream(self, prompt: str, max_output_tokens: Optional[int], cached_prefix: Any,
+                stream: GenerationStream) -> AsyncIterator[str]:
+        """Async generator of text pieces that sets stream.total_tokens when done."""
+
+    @abstractmethod
+    async def count_tokens(self, text: str) -> int:
+        """Exact token count with the provider's tokenizer (may be a remote call)."""
+
+    def available(self) -> bool:
+        """False while calls would be rejected without trying (e.g. an open circuit breaker)."""
+        return True
+
+    async def create_cache(self, prefix: str, ttl: float) -> Any:
+        """Stores a prompt prefix for ttl seconds and returns a handle to it.
+
+        By default the prefix is kept in process and sent with each prompt;
+        servers with automatic prefix caching (OpenAI, vLLM) still skip
+        re-processing it.
+        """
+        return prefix
+
+    async def delete_cache(self, handle: Any) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+class GeminiProvider(LLMProvider):
+    """Google Gemini through google-generativeai."""
+
+    def __init__(self, api_key: str, model_name: str = 'gemini-1.5-flash', cache_model_name: Optional[str] = None):
+        import google.generativeai as genai
+        from google.generativeai import caching
+        genai.configure(api_key=api_key)
+        self.genai = genai
+        self.caching = caching
+        self.model = genai.GenerativeModel(model_name)
+        # Cached content needs a versioned model name (e.g. models/gemini-1.5-flash-002)
+        self.cache_model_name = cache_model_name or f"models/{model_name}"
+
+    def _model(self, cached_prefix: Any) -> Any:
+        if cached_prefix is None:
+            return self.model
+        return self.genai.GenerativeModel.from_cached_content(cached_prefix)
+
+    @staticmethod
+    def _generation_config(max_output_tokens: Optional[int]) -> Optional[Dict[str, Any]]:
+        return {'max_output_tokens': max_output_tokens} if max_output_tokens else None
+
+    @staticmethod
+    def _usage_tokens(response: Any) -> Optional[int]:
+        usage = getattr(response, 'usage_metadata', None)
+        return getattr(usage, 'total_token_count', None) or None
+
+    @staticmethod
+    def _chunk_text(chunk: Any) -> str:
+        """Text of one streamed chunk ('' for chunks without text parts, e.g. the final metadata)."""
+        try:
+            return chunk.text
+        except ValueError:
+            return ""
+
+    async def generate(self, prompt: str, max_output_tokens: Optional[int] = None,
+                       cached_prefix: Any = None) -> Generation:
+        response = await self._model(cached_prefix).generate_content_async(
+            prompt, generation_config=self._generation_config(max_output_tokens)
+        )
+        return Generation(response.text, self._usage_tokens(response))
+
+    async def _stream(self, prompt: str, max_output_tokens: Optional[int], cached_prefix: Any,
+                      stream: GenerationStream) -> AsyncIterator[str]:
+        response = await self._model(cached_prefix).generate_content_async(
+            prompt, generation_config=self._generation_config(max_output_tokens), stream=True
+        )
+        async for chunk in response:
+            piece = self._chunk_text(chunk)
+            if piece:
+                yield piece
+        stream.total_tokens = self._usage_tokens(response)
+
+    async def count_tokens(self, text: str) -> int:
+        return (await self.model.count_tokens_async(text)).total_tokens
+
+    async def create_cache(self, prefix: str, ttl: float) -> Any:
+        # The SDK's caching calls are blocking; keep them off the event loop
+        return await asyncio.to_thread(
+            self.caching.CachedContent.create,
+            model=self.cache_model_name,
+            contents=[prefix],
+            ttl=datetime.timedelta(seconds=ttl)
+        )
+
+    async def delete_cache(self, handle: Any) -> None:
+        await asyncio.to_thread(handle.delete)
+
+class OpenAICompatibleProvider(LLMProvider):
+    """Any /chat/completions HTTP API (OpenAI, vLLM, llama.cpp, Ollama, ...).
+
+    There is no standard token counting endpoint, so count_tokens returns
+    the local estimate.
+    """
+
+    def __init__(self, base_url: str, api_key: Optional[str], model_name: str, timeout: float = 60.0):
+        self.model_name = model_name
+        headers = {'Authorization': f"Bearer {api_key}"} if api_key else {}
+        self.client = httpx.AsyncClient(base_url=base_url.rstrip('/'), headers=headers, timeout=timeout)
+
+    def _payload(self, prompt: str, max_output_tokens: Optional[int], cached_prefix: Any) -> Dict[str, Any]:
+        payload = {
+            'model': self.model_name,
+            'messages': [{'role': 'user', 'content': (cached_prefix or "") + prompt}]
+        }
+        if max_output_tokens:
+            payload['max_tokens'] = max_output_tokens
+        return payload
+
+    async def generate(self, prompt: str, max_output_tokens: Optional[int] = None,
+                       cached_prefix: Any = None) -> Generation:
+        response = await self.client.post('/chat/completions',
+                                          json=self._payload(prompt, max_output_tokens, cached_prefix))
+        response.raise_for_status()
+        body = response.json()
+        text = body['choices'][0]['message'].get('content') or ""
+        return Generation(text, (body.get('usage') or {}).get('total_tokens'))
+
+    async def _stream(self, prompt: str, max_output_tokens: Optional[int], cached_prefix: Any,
+                      stream: GenerationStream) -> AsyncIterator[str]:
+        payload = self._payload(prompt, max_output_tokens, cached_prefix)
+        payload['stream'] = True
+        payload['stream_options'] = {'include_usage': True}
+        async with self.client.stream('POST', '/chat/completions', json=payload) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line.startswith('data:'):
+                    continue
+                data = line[len('data:'):].strip()
+                if data == '[DONE]':
+                    break
+                event = json.loads(data)
+                if event.get('usage'):
+                    stream.total_tokens = event['usage'].get('total_tokens')
+                for choice in event.get('choices') or []:
+                    piece = (choice.get('delta') or {}).get('content')
+                    if piece:
+                        yield piece
+
+    async def count_tokens(self, text: str) -> int:
+        import backend.services as services  # services imports this module
+        return services.estimate_tokens(text)
+
+    async def close(self) -> None:
+        await self.client.aclose()
+
+# Words and punctuation marks, for the stub's token counts
+_STUB_TOKENS = re.compile(r"\w+|[^\w\s]")
+
+@dataclass
+class StubCache:
+    tokens: int
+
+class StubProvider(LLMProvider):
+    """Local model stand-in for load tests: no network, no API quota.
+
+    Latency is time to first token (log-normal around `latency`) plus input
+    processing per prompt token, then output at `tokens_per_second`. Output
+    length is log-normal around `output_tokens`. Draws are seeded from the
+    prompt, so the same prompt always gets the same answer, latency and
+    token count.
+    """
+
+    CHUNK_TOKENS = 10
+
+    def __init__(self, latency: float = 0.3, latency_sigma: float = 0.0, output_tokens: int = 150,
+                 output_tokens_sigma: float = 0.0, tokens_per_second: float = 0.0,
+                 prefill_per_token: float = 0.0, seed: int = 0):
+        self.latency = latency
+        self.latency_sigma = latency_sigma
+        self.output_tokens = output_tokens
+        self.output_tokens_sigma = output_tokens_sigma
+        self.tokens_per_second = tokens_per_second
+        self.prefill_per_token = prefill_per_token
+        self.seed = seed
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.caches_created = 0
+
+    def count(self, text: str) -> int:
+        return len(_STUB_TOKENS.findall(text))
+
+    def _draw(self, prompt: str, max_output_tokens: Optional[int]) -> tuple:
+        digest = hashlib.blake2b(prompt.encode(), digest_size=8).digest()
+        rng = random.Random(self.seed ^ int.from_bytes(digest, 'little'))
+        first_token = self.latency * math.exp(rng.gauss(0, self.latency_sigma)) if self.latency_sigma else self.latency
+        tokens = max(1, round(self.output_tokens * math.exp(rng.gauss(0, self.output_tokens_sigma))))
+        if max_output_tokens:
+            tokens = min(tokens, max_output_tokens)
+        return first_token, tokens
+
+    def _start(self, prompt: str, max_output_tokens: Optional[int], cached_prefix: Any) -> tuple:
+        """Prompt accounting for one call: (first token delay, output tokens, billed input tokens)."""
+        prompt_tokens = self.count(prompt)
+        cached = cached_prefix.tokens if isinstance(cached_prefix, StubCache) else 0
+        self.calls += 1
+        self.prompt_tokens += prompt_tokens
+        self.cached_tokens += cached
+        first_token, tokens = self._draw(prompt, max_output_tokens)
+        return first_token + prompt_tokens * self.prefill_per_token, tokens, prompt_tokens + cached
+
+    @staticmethod
+    def _answer(tokens: int) -> str:
+        return " ".join(f"word{i}" for i in range(tokens))
+
+    async def generate(self, prompt: str, max_output_tokens: Optional[int] = None,
+                       cached_prefix: Any = None) -> Generation:
+        delay, tokens, input_tokens = self._start(prompt, max_output_tokens, cached_prefix)
+        if self.tokens_per_second:
+            delay += tokens / self.tokens_per_second
+        await asyncio.sleep(delay)
+        return Generation(self._answer(tokens), input_tokens + tokens)
+
+    async def _stream(self, prompt: str, max_output_tokens: Optional[int], cached_prefix: Any,
+                      stream: GenerationStream) -> AsyncIterator[str]:
+        delay, tokens, input_tokens = self._start(prompt, max_output_tokens, cached_prefix)
+        await asyncio.sleep(delay)
+        words = self._answer(tokens).split(" ")
+        for start in range(0, len(words), self.CHUNK_TOKENS):
+            if start and self.tokens_per_second:
+                await asyncio.sleep(self.CHUNK_TOKENS / self.tokens_per_second)
+            yield (" " if start else "") + " ".join(words[start:start + self.CHUNK_TOKENS])
+        stream.total_tokens = input_tokens + tokens
+
+    async def count_tokens(self, text: str) -> int:
+        return self.count(text)
+
+    async def create_cache(self, prefix: str, ttl: float) -> Any:
+        # Simulates provider-side caching: the prefix is processed once here, not per message
+        tokens = self.count(prefix)
+        await asyncio.sleep(tokens * self.prefill_per_token)
+        self.caches_created += 1
+        return StubCache(tokens)
+
+def create_llm_provider(name: str, model_name: Optional[str] = None) -> LLMProvider:
+    """Builds the provider selected by config.LLM_PROVIDER, optionally for another model of it."""
+    if name == "gemini":
+        if not config.GOOGLE_API_KEY:
+            raise ValueError("GOOGLE_API_KEY environment variable is required for LLM_PROVIDER=gemini")
+        return GeminiProvider(config.GOOGLE_API_KEY, model_name or config.GEMINI_MODEL, config.CONTEXT_CACHE_MODEL)
+    if name == "openai":
+        return OpenAICompatibleProvider(config.OPENAI_BASE_URL, config.OPENAI_API_KEY, model_name or config.OPENAI_MODEL,
+                                        timeout=config.HTTP_TIMEOUT)
+    if name == "stub":
+        return StubProvider(
+            latency=config.LLM_STUB_LATENCY_MS / 1000,
+            latency_sigma=config.LLM_STUB_LATENCY_SIGMA,
+            output_tokens=config.LLM_STUB_OUTPUT_TOKENS,
+            output_tokens_sigma=config.LLM_STUB_OUTPUT_TOKENS_SIGMA,
+            tokens_per_second=config.LLM_STUB_TOKENS_PER_SECOND,
+            seed=config.LLM_STUB_SEED
+        )
+    raise ValueError(f"Unknown LLM provider: {name}")
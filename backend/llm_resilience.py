@@ -0,0 +1,278 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Optional
+
+import backend.config as config
+from backend.llm_provider import Generation, GenerationStream, LLMProvider, create_llm_provider
+
+logger = logging.getLogger(__name__)
+
+class CircuitOpenError(Exception):
+    """The provider's circuit is open: fail fast instead of calling it."""
+
+class CircuitBreaker:
+    """Closed -> open when the recent error rate is too high -> half-open after a cooldown.
+
+    The error rate is measured over the last `window` calls once at least
+    `min_calls` were made. While open, calls are rejected. After
+    open_seconds one probe call is let through (half-open): success closes
+    the circuit, failure opens it again.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, failure_rate: float = 0.5, window: int = 20, min_calls: int = 10,
+                 open_seconds: float = 30.0, name: str = "llm"):
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.open_seconds = open_seconds
+        self.name = name
+        self.state = self.CLOSED
+        self._outcomes: deque = deque(maxlen=window)
+        self._state_since = time.monotonic()
+        self._probing = False
+        self.seconds_in_state = {self.CLOSED: 0.0, self.OPEN: 0.0, self.HALF_OPEN: 0.0}
+        self.transitions = {self.CLOSED: 0, self.OPEN: 0, self.HALF_OPEN: 0}
+        self.successes = 0
+        self.failures = 0
+        self.rejected = 0
+
+    def _set_state(self, state: str) -> None:
+        now = time.monotonic()
+        self.seconds_in_state[self.state] += now - self._state_since
+        self.state = state
+        self._state_since = now
+        self.transitions[state] += 1
+        if state == self.OPEN:
+            logger.error(f"Circuit for {self.name} opened: failing fast for {self.open_seconds:g}s")
+        else:
+            logger.warning(f"Circuit for {self.name} is now {state}")
+
+    def allow(self) -> bool:
+        """True if a call may go to the provider now (counts rejections)."""
+        if self.state == self.OPEN and time.monotonic() - self._state_since >= self.open_seconds:
+            self._set_state(self.HALF_OPEN)
+        if self.state == self.CLOSED or (self.state == self.HALF_OPEN and not self._probing):
+            self._probing = self.state == self.HALF_OPEN
+            return True
+        self.rejected += 1
+        return False
+
+    @property
+    def available(self) -> bool:
+        """False while calls would be rejected."""
+        return self.state != self.OPEN or time.monotonic() - self._state_since >= self.open_seconds
+
+    def record(self, success: bool) -> None:
+        if success:
+            self.successes += 1
+        else:
+            self.failures += 1
+        if self.state == self.HALF_OPEN:
+            self._probing = False
+            self._outcomes.clear()
+            self._set_state(self.CLOSED if success else self.OPEN)
+            return
+        if self.state == self.OPEN:
+            return  # a call that started before the circuit opened
+        self._outcomes.append(success)
+        if len(self._outcomes) >= self.min_calls:
+            failed = self._outcomes.count(False)
+            if failed / len(self._outcomes) >= self.failure_rate:
+                self._outcomes.clear()
+                self._set_state(self.OPEN)
+
+    def cancel(self) -> None:
+        """A call ended without an outcome (cancelled); frees the half-open probe."""
+        if self.state == self.HALF_OPEN:
+            self._probing = False
+
+    def stats(self) -> Dict[str, Any]:
+        seconds = dict(self.seconds_in_state)
+        seconds[self.state] += time.monotonic() - self._state_since
+        return {
+            'state': self.state,
+            'successes': self.successes,
+            'failures': self.failures,
+            'rejected': self.rejected,
+            'opened': self.transitions[self.OPEN],
+            'half_opened': self.transitions[self.HALF_OPEN],
+            'closed': self.transitions[self.CLOSED],
+            'seconds_in_state': {state: round(value, 1) for state, value in seconds.items()}
+        }
+
+class ResilientProvider(LLMProvider):
+    """Wraps a provider with a per-attempt timeout, a circuit breaker and optional hedging.
+
+    Hedging: if a generate() call has not finished after the recent p-th
+    percentile latency, a second identical call is started and whichever
+    succeeds first wins (the other is cancelled, though the provider may
+    still bill it). At most hedge_max_ratio of calls are hedged, so a slow
+    provider does not get double the load. Streams are not hedged, but are
+    held to the same timeout.
+    """
+
+    def __init__(self, provider: LLMProvider, breaker: CircuitBreaker, timeout: Optional[float] = None,
+                 hedge: bool = False, hedge_percentile: float = 95, hedge_min_delay: float = 0.5,
+                 hedge_max_ratio: float = 0.1):
+        self.provider = provider
+        self.breaker = breaker
+        self.timeout = timeout or None
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_max_ratio = hedge_max_ratio
+        self._latencies: deque = deque(maxlen=200)
+        self.calls = 0
+        self.timeouts = 0
+        self.hedges = 0
+        self.hedges_won = 0
+
+    def available(self) -> bool:
+        return self.breaker.available
+
+    def _latency_percentile(self, pct: float) -> Optional[float]:
+        if len(self._latencies) < 20:
+            return None
+        ordered = sorted(self._latencies)
+        return ordered[min(len(ordered) - 1, int(pct / 100 * len(ordered)))]
+
+    async def _attempt(self, call: Callable[[], Awaitable[Generation]]) -> Generation:
+        try:
+            return await asyncio.wait_for(call(), self.timeout) if self.timeout else await call()
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise
+
+    async def _hedged(self, call: Callable[[], Awaitable[Generation]]) -> Generation:
+        delay = self._latency_percentile(self.hedge_percentile) if self.hedge else None
+        first = asyncio.ensure_future(self._attempt(call))
+        if delay is None:
+            return await first
+        tasks = {first}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=max(delay, self.hedge_min_delay))
+            if done or self.hedges >= self.hedge_max_ratio * self.calls:
+                return await first
+            self.hedges += 1
+            second = asyncio.ensure_future(self._attempt(call))
+            tasks.add(second)
+            pending = set(tasks)
+            error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is second:
+                            self.hedges_won += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    async def generate(self, prompt: str, max_output_tokens: Optional[int] = None,
+                       cached_prefix: Any = None) -> Generation:
+        if not self.breaker.allow():
+            raise CircuitOpenError(f"{self.breaker.name} circuit is open")
+        self.calls += 1
+        started = time.monotonic()
+        try:
+            generation = await self._hedged(
+                lambda: self.provider.generate(prompt, max_output_tokens=max_output_tokens, cached_prefix=cached_prefix)
+            )
+        except asyncio.CancelledError:
+            self.breaker.cancel()
+            raise
+        except Exception:
+            self.breaker.record(False)
+            raise
+        self.breaker.record(True)
+        self._latencies.append(time.monotonic() - started)
+        return generation
+
+    def stream(self, prompt: str, max_output_tokens: Optional[int] = None,
+               cached_prefix: Any = None) -> GenerationStream:
+        if not self.breaker.allow():
+            raise CircuitOpenError(f"{self.breaker.name} circuit is open")
+        self.calls += 1
+        return super().stream(prompt, max_output_tokens=max_output_tokens, cached_prefix=cached_prefix)
+
+    async def _stream(self, prompt: str, max_output_tokens: Optional[int], cached_prefix: Any,
+                      stream: GenerationStream) -> AsyncIterator[str]:
+        inner = self.provider.stream(prompt, max_output_tokens=max_output_tokens, cached_prefix=cached_prefix)
+        outcome: Optional[bool] = None
+        pieces = inner.__aiter__()
+        deadline = time.monotonic() + self.timeout if self.timeout else None
+        try:
+            while True:
+                # The whole stream gets the same LLM_TIMEOUT as a generate() call
+                try:
+                    if deadline is None:
+                        piece = await pieces.__anext__()
+                    else:
+                        piece = await asyncio.wait_for(pieces.__anext__(), max(deadline - time.monotonic(), 0))
+                except StopAsyncIteration:
+                    break
+                except asyncio.TimeoutError:
+                    self.timeouts += 1
+                    raise
+                yield piece
+            stream.total_tokens = inner.total_tokens
+            outcome = True
+        except Exception:
+            outcome = False
+            raise
+        finally:
+            if outcome is None:
+                self.breaker.cancel()  # the consumer stopped early or was cancelled
+            else:
+                self.breaker.record(outcome)
+
+    async def count_tokens(self, text: str) -> int:
+        return await self.provider.count_tokens(text)
+
+    async def create_cache(self, prefix: str, ttl: float) -> Any:
+        return await self.provider.create_cache(prefix, ttl)
+
+    async def delete_cache(self, handle: Any) -> None:
+        await self.provider.delete_cache(handle)
+
+    async def close(self) -> None:
+        await self.provider.close()
+
+    def stats(self) -> Dict[str, Any]:
+        """Breaker and hedging counters for the /metrics endpoint."""
+        p95 = self._latency_percentile(95)
+        return {
+            'provider': type(self.provider).__name__,
+            'circuit': self.breaker.stats(),
+            'calls': self.calls,
+            'timeouts': self.timeouts,
+            'hedges': self.hedges,
+            'hedges_won': self.hedges_won,
+            'latency_p95_ms': round(p95 * 1000, 1) if p95 is not None else None
+        }
+
+def create_resilient_provider(name: str, model_name: Optional[str] = None) -> ResilientProvider:
+    """Builds the configured provider wrapped with LLM_TIMEOUT, the circuit breaker and hedging."""
+    breaker = CircuitBreaker(
+        failure_rate=config.LLM_BREAKER_FAILURE_RATE,
+        window=config.LLM_BREAKER_WINDOW,
+        min_calls=config.LLM_BREAKER_MIN_CALLS,
+        open_seconds=config.LLM_BREAKER_OPEN_SECONDS,
+        name=f"{name} {model_name}" if model_name else name
+    )
+    return ResilientProvider(
+        create_llm_provider(name, model_name),
+        breaker,
+        timeout=config.LLM_TIMEOUT,
+        hedge=config.LLM_HEDGE_ENABLED,
+        hedge_percentile=config.LLM_HEDGE_PERCENTILE,
+        hedge_min_delay=config.LLM_HEDGE_MIN_DELAY_MS / 1000,
+        hedge_max_ratio=config.LLM_HEDGE_MAX_RATIO
+    )
@@ -8,11 +8,31 @@ from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 import backend.services as services
 import backend.config as config
+import backend.tenant_context as tenant_context
+import backend.retrieval as retrieval
+from backend.kb_indexer import reconciler
+from backend.usage_counter import usage_counter, usage_reconciler
+from backend.usage_writer import usage_writer
+from backend.analytics_sink import analytics_sink
+from backend.coalescer import coalescer
+from backend.context_cache import context_cache
+from backend.conversation_memory import conversation_memory
+from backend.model_router import router
+from backend.response_cache import response_cache
+from backend.telegram_client import telegram
+from backend.update_dedup import update_dedup
+from backend.update_poller import UpdatePoller, create_offset_store
+from backend.webhook_router import webhook_router
+from backend.database import get_async_supabase, close_async_redis
+from backend.bulkhead import BUSY_MESSAGE, TenantOverloaded, bulkhead
+from backend.job_queue import ACCEPTED, DUPLICATE, EMPTY, REJECTED, SHED, WorkerPool, create_job_queue
+from backend.pipeline import process_telegram_update, send_busy_reply
+from contextlib import asynccontextmanager
 from datetime import datetime
 import hmac
 import hashlib
 import logging
-from typing import Optional
+from typing import Any, Dict, Optional
 from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
@@ -33,10 +53,55 @@ except Exception as e:
     logger.warning(f"Redis not available, using in-memory rate limiting: {e}")
     limiter = Limiter(key_func=get_remote_address)
 
+# Background workers that process queued Telegram updates
+worker_pool = WorkerPool(
+    create_job_queue(),
+    process_telegram_update,
+    concurrency=config.WORKER_CONCURRENCY,
+    bulkhead=bulkhead if config.BULKHEAD_ENABLED else None,
+    on_shed=send_busy_reply
+)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Starts shared clients and workers on startup, drains them on shutdown"""
+    await get_async_supabase()
+    worker_pool.start()
+    if config.RETRIEVAL_ENABLED:
+        reconciler.start()
+    # Buffered usage rows are not in usage_logs yet; counter reconciliation must account for them
+    usage_counter.pending_tokens = usage_writer.pending_tokens
+    usage_writer.start()
+    analytics_sink.start()
+    usage_reconciler.start()
+    if not webhook_router.enabled:
+        logger.error("TELEGRAM_WEBHOOK_KEY and TELEGRAM_WEBHOOK_SECRET are not set: per-bot Telegram webhooks are disabled")
+    if config.TELEGRAM_INGESTION == "polling":
+        update_poller.start()
+    else:
+        await webhook_router.load()
+        webhook_router.start()
+    yield
+    # Stop taking updates before draining the workers
+    await update_poller.stop()
+    await webhook_router.stop()
+    await usage_reconciler.stop()
+    await reconciler.stop()
+    await worker_pool.stop(timeout=config.SHUTDOWN_DRAIN_TIMEOUT)
+    await usage_writer.stop()
+    await analytics_sink.stop()
+    await context_cache.close()
+    await services.provider.close()
+    if router.small_provider:
+        await router.small_provider.close()
+    await telegram.close()
+    await close_async_redis()
+
 app = FastAPI(
     title="BotAI Backend API",
     description="Backend API for BotAI chatbot platform",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # CORS configuration
@@ -71,6 +136,7 @@ class Message(BaseModel):
     text: str
 
 class TelegramWebhookPayload(BaseModel):
+    update_id: Optional[int] = None
     message: Message
     
     class Config:
@@ -90,6 +156,29 @@ def health_check():
         "timestamp": datetime.utcnow().isoformat()
     }
 
+@app.get("/metrics")
+async def metrics():
+    """Internal counters for monitoring the webhook pipeline"""
+    return {
+        "job_queue": await worker_pool.stats(),
+        "tenant_cache": tenant_context.tenant_cache.stats(),
+        "retrieval": {**retrieval.engine.stats(), "reconciler": reconciler.stats()},
+        "usage_counter": usage_counter.stats(),
+        "usage_writer": usage_writer.stats(),
+        "analytics": analytics_sink.stats(),
+        "response_cache": response_cache.stats(),
+        "context_cache": context_cache.stats(),
+        "llm": services.provider.stats(),
+        "llm_small": router.small_provider.stats() if router.small_provider else None,
+        "model_router": router.stats(),
+        "coalescer": coalescer.stats(),
+        "conversation_memory": conversation_memory.stats(),
+        "telegram": telegram.stats(),
+        "update_dedup": update_dedup.stats(),
+        "update_poller": update_poller.stats() if config.TELEGRAM_INGESTION == "polling" else None,
+        "webhook_router": webhook_router.stats() if config.TELEGRAM_INGESTION == "webhook" else None
+    }
+
 def verify_telegram_webhook(request: Request, x_telegram_bot_api_secret_token: Optional[str] = Header(None)):
     """Verify that the request comes from Telegram using secret token validation"""
     if config.ENVIRONMENT == "development":
@@ -100,12 +189,96 @@ def verify_telegram_webhook(request: Request, x_telegram_bot_api_secret_token: O
         logger.warning("Missing Telegram secret token header")
         raise HTTPException(status_code=401, detail="Missing authentication header")
     
-    if x_telegram_bot_api_secret_token != config.TELEGRAM_WEBHOOK_SECRET:
+    if not hmac.compare_digest(x_telegram_bot_api_secret_token, config.TELEGRAM_WEBHOOK_SECRET or ""):
         logger.warning("Invalid Telegram secret token")
         raise HTTPException(status_code=401, detail="Invalid authentication token")
     
     return True
 
+async def enqueue_update(telegram_bot_token: str, update_id: Optional[int], chat_id: int, user_message: str) -> str:
+    """Validates one incoming Telegram message and queues it for the workers.
+
+    Shared by the webhook and the getUpdates poller. Returns ACCEPTED,
+    DUPLICATE (already seen), EMPTY, SHED (the bot's share of the queue is
+    full; the caller sends the busy reply) or REJECTED (the queue is full or
+    shutting down; the update must be delivered again later).
+    """
+    # Telegram redelivers updates it thinks were not received; answer each one only once
+    if config.UPDATE_DEDUP_ENABLED and update_id is not None:
+        if not await update_dedup.first_seen(telegram_bot_token, update_id):
+            logger.info(f"Ignoring redelivered update {update_id} for token: {telegram_bot_token[:10]}...")
+            return DUPLICATE
+
+    # Validate message content
+    if not user_message or len(user_message.strip()) == 0:
+        logger.warning(f"Empty message received from chat_id: {chat_id}")
+        return EMPTY
+
+    # Sanitize and validate message length
+    user_message = user_message.strip()
+    if len(user_message) > 4000:  # Reasonable limit
+        user_message = user_message[:4000]
+        logger.warning(f"Message truncated for chat_id: {chat_id}")
+
+    job = {
+        'bot_token': telegram_bot_token,
+        'chat_id': chat_id,
+        'text': user_message,
+        'update_id': update_id
+    }
+    try:
+        accepted = await worker_pool.submit(telegram_bot_token, job)
+    except TenantOverloaded:
+        return SHED
+    if not accepted:
+        logger.error(f"Job queue unavailable, rejecting update for token: {telegram_bot_token[:10]}...")
+        if config.UPDATE_DEDUP_ENABLED and update_id is not None:
+            await update_dedup.forget(telegram_bot_token, update_id)
+        return REJECTED
+    return ACCEPTED
+
+# getUpdates long polling for every active bot (TELEGRAM_INGESTION=polling), into the same queue
+update_poller = UpdatePoller(
+    enqueue_update,
+    create_offset_store(),
+    timeout=config.TELEGRAM_POLL_TIMEOUT,
+    limit=config.TELEGRAM_POLL_LIMIT,
+    refresh_interval=config.TELEGRAM_POLL_BOTS_INTERVAL
+)
+
+async def _webhook_response(telegram_bot_token: str, payload: TelegramWebhookPayload) -> Dict[str, Any]:
+    """Queues a webhook update and builds the response for Telegram."""
+    # Hand the update to the background workers and acknowledge Telegram right away.
+    # Holding the request open for the whole AI round trip makes Telegram time out and redeliver.
+    chat_id = payload.message.chat.id
+    status = await enqueue_update(telegram_bot_token, payload.update_id, chat_id, payload.message.text)
+    if status == DUPLICATE:
+        return {"status": "ignored", "detail": "Duplicate update"}
+    if status == EMPTY:
+        return {"status": "ignored", "detail": "Empty message"}
+    if status == SHED:
+        # This bot already has its share of the queue: answer "busy" in the webhook response
+        # itself (Telegram executes a Bot API method returned here) instead of queueing
+        return {"method": "sendMessage", "chat_id": chat_id, "text": BUSY_MESSAGE}
+    if status == REJECTED:
+        # Non-2xx makes Telegram redeliver later, once the queue has room again
+        raise HTTPException(status_code=503, detail="Server busy, please retry")
+    return {"status": "accepted"}
+
+@app.post("/webhook/telegram/{webhook_id}")
+async def handle_telegram_webhook(
+    webhook_id: str,
+    payload: TelegramWebhookPayload,
+    x_telegram_bot_api_secret_token: Optional[str] = Header(None)
+):
+    """Per-bot webhook registered by /api/webhooks/setup: an opaque id and the bot's own secret token"""
+    route = await webhook_router.resolve(webhook_id, x_telegram_bot_api_secret_token)
+    if route is None:
+        # Same answer for unknown ids and wrong secrets, so ids cannot be probed
+        logger.warning(f"Rejected webhook for unknown id or invalid secret: {webhook_id[:8]}...")
+        raise HTTPException(status_code=401, detail="Invalid authentication token")
+    return await _webhook_response(route.bot_token, payload)
+
 @app.post("/webhook/{telegram_bot_token}")
 # @limiter.limit("60/minute")  # 60 requests per minute per IP - DISABLED for testing (Redis not running)
 async def handle_webhook(
@@ -114,83 +287,67 @@ async def handle_webhook(
     request: Request,
     authenticated: bool = Depends(verify_telegram_webhook)
 ):
-    try:
-        logger.info(f"Received webhook for token: {telegram_bot_token[:10]}...")
-        
-        # 1. Extract chat_id and user message from the payload
-        chat_id = payload.message.chat.id
-        user_message = payload.message.text
-        
-        # Validate message content
-        if not user_message or len(user_message.strip()) == 0:
-            logger.warning(f"Empty message received from chat_id: {chat_id}")
-            return {"status": "ignored", "detail": "Empty message"}
-        
-        # Sanitize and validate message length
-        user_message = user_message.strip()
-        if len(user_message) > 4000:  # Reasonable limit
-            user_message = user_message[:4000]
-            logger.warning(f"Message truncated for chat_id: {chat_id}")
-
-        # 2. Identify the tenant
-        company = services.get_company_by_token(telegram_bot_token)
-        if not company:
-            logger.error(f"Company not found for token: {telegram_bot_token[:10]}...")
-            raise HTTPException(status_code=404, detail="Company not found")
-
-        # 3. Get active subscription and plan details
-        subscription = services.get_active_subscription(company['id'])
-        if not subscription:
-            error_msg = "Error: No active subscription found."
-            services.send_telegram_message(telegram_bot_token, chat_id, error_msg)
-            logger.error(f"No active subscription for company: {company['id']}")
-            return {"status": "error", "detail": "No active subscription"}
-
-        # 4. Get knowledge base
-        knowledge_base = services.get_knowledge_base_content(company['id'])
-        if not knowledge_base:
-            error_msg = "Error: Knowledge base not found."
-            services.send_telegram_message(telegram_bot_token, chat_id, error_msg)
-            logger.error(f"No knowledge base for company: {company['id']}")
-            return {"status": "error", "detail": "Knowledge base not found"}
-
-        # 5. Generate AI response and count tokens
-        ai_response, tokens_used = services.get_ai_response_and_count_tokens(user_message, knowledge_base)
-        logger.info(f"Generated response using {tokens_used} tokens for company: {company['id']}")
-
-        # 6. Check usage against the plan's limit
-        plan = subscription['plans']
-        start_date = subscription['start_date']
-        end_date = subscription['end_date']
-        
-        current_usage = services.get_total_usage(subscription['id'], start_date, end_date)
-        logger.info(f"Current usage: {current_usage}, Plan limit: {plan['token_limit']}")
-
-        if current_usage + tokens_used > plan['token_limit']:
-            limit_exceeded_message = "Sorry, I can't answer right now. The token limit for this billing period has been exceeded."
-            services.send_telegram_message(telegram_bot_token, chat_id, limit_exceeded_message)
-            logger.warning(f"Token limit exceeded for company: {company['id']}")
-            return {"status": "error", "detail": "Token limit exceeded"}
-
-        # 7. Record usage and send response
-        services.record_usage(subscription['id'], tokens_used)
-        services.send_telegram_message(telegram_bot_token, chat_id, ai_response)
-        logger.info(f"Successfully processed message for company: {company['id']}")
-
-        return {"status": "success"}
-    
-    except Exception as e:
-        logger.error(f"Error processing webhook: {str(e)}", exc_info=True)
-        try:
-            services.send_telegram_message(
-                telegram_bot_token, 
-                chat_id, 
-                "Sorry, I'm experiencing technical difficulties. Please try again later."
-            )
-        except:
-            pass  # Don't let telegram errors crash the whole handler
-        
-        raise HTTPException(status_code=500, detail="Internal server error")
+    """Legacy webhook with the token in the path, for bots registered before per-bot webhooks"""
+    logger.info(f"Received webhook for token: {telegram_bot_token[:10]}...")
+    return await _webhook_response(telegram_bot_token, payload)
+
+# Tables whose rows are part of a cached TenantContext
+TENANT_TABLES = {'bots', 'companies', 'subscriptions', 'knowledge_bases', 'plans'}
+
+@app.post("/api/cache/invalidate")
+async def invalidate_cache(
+    payload: dict,
+    x_cache_invalidation_secret: Optional[str] = Header(None)
+):
+    """
+    Change notification hook for Supabase Database Webhooks.
+
+    Point INSERT/UPDATE/DELETE webhooks for the tenant tables here so cached
+    tenant contexts are dropped as soon as the dashboard edits them.
+    Expected payload: {"type": ..., "table": ..., "record": {...}, "old_record": {...}}
+    """
+    if not config.CACHE_INVALIDATION_SECRET:
+        raise HTTPException(status_code=404, detail="Cache invalidation is not configured")
+    if not x_cache_invalidation_secret or not hmac.compare_digest(
+        x_cache_invalidation_secret, config.CACHE_INVALIDATION_SECRET
+    ):
+        logger.warning("Invalid cache invalidation secret")
+        raise HTTPException(status_code=401, detail="Invalid authentication token")
+
+    table = payload.get('table')
+    if table not in TENANT_TABLES:
+        return {"status": "ignored", "table": table}
+
+    record = payload.get('record') or payload.get('old_record') or {}
+    if table == 'plans':
+        # Plans are shared by every tenant
+        dropped = tenant_context.invalidate_tenant()
+    elif table == 'companies':
+        dropped = tenant_context.invalidate_tenant(company_id=record.get('id'))
+    else:
+        dropped = 0
+        if table == 'bots':
+            for row in (payload.get('record'), payload.get('old_record')):
+                if row and row.get('token'):
+                    dropped += tenant_context.invalidate_tenant(token=row['token'])
+            # Keep the webhook routing table in step without waiting for its next refresh
+            old_record = payload.get('old_record') or {}
+            if old_record.get('id'):
+                webhook_router.remove(bot_id=str(old_record['id']), token=old_record.get('token'))
+            new_record = payload.get('record') or {}
+            if webhook_router.enabled and payload.get('type') != 'DELETE' and new_record.get('token') \
+                    and new_record.get('platform') == 'telegram':
+                webhook_router.add(new_record['token'], bot_id=str(new_record['id']),
+                                   company_id=new_record.get('company_id'))
+        if record.get('company_id'):
+            dropped += tenant_context.invalidate_tenant(company_id=record['company_id'])
+            if table == 'knowledge_bases':
+                # Cached answers and the cached prompt prefix were built from the old KB
+                response_cache.invalidate_company(record['company_id'])
+                context_cache.invalidate_company(record['company_id'])
+
+    logger.info(f"Invalidated {dropped} cached tenant contexts after {payload.get('type')} on {table}")
+    return {"status": "success", "invalidated": dropped}
 
 # WhatsApp Webhook Placeholder
 @app.post("/webhook/whatsapp/{business_phone}")
@@ -234,25 +391,29 @@ async def setup_webhook(
     Automatically sets webhook for production environment
     Development: Returns webhook URL for manual setup
     """
-    import os
-    import requests
-
     backend_url = os.getenv("BACKEND_URL", "http://localhost:8000")
     environment = os.getenv("ENVIRONMENT", "development")
 
     if platform == "telegram":
         if not bot_token:
             raise HTTPException(status_code=400, detail="bot_token is required for Telegram")
+        if not webhook_router.enabled:
+            raise HTTPException(status_code=503, detail="Telegram webhooks are not configured (set TELEGRAM_WEBHOOK_KEY)")
+
+        # Opaque per-bot URL and secret; routable right away on this instance, and on
+        # the others once the bots update below reaches their routing tables
+        route = webhook_router.add(bot_token)
+        webhook_url = f"{backend_url}/webhook/telegram/{webhook_router.webhook_id(bot_token)}"
 
-        webhook_url = f"{backend_url}/webhook/{bot_token}"
+        # The bot may have been (re)assigned to a company; drop any cached lookup for it
+        tenant_context.invalidate_tenant(token=bot_token)
 
         if environment == "production":
             # Auto-set Telegram webhook
             try:
-                telegram_api = f"https://api.telegram.org/bot{bot_token}/setWebhook"
-                response = requests.post(telegram_api, json={
+                response = await telegram.call(bot_token, 'setWebhook', {
                     "url": webhook_url,
-                    "secret_token": config.TELEGRAM_WEBHOOK_SECRET if hasattr(config, 'TELEGRAM_WEBHOOK_SECRET') else None
+                    "secret_token": route.secret
                 })
 
                 if response.status_code == 200:
@@ -260,10 +421,12 @@ async def setup_webhook(
 
                     # Update bot record in database with webhook URL and set as active
                     try:
-                        supabase.table('bots').update({
+                        supabase = await get_async_supabase()
+                        await supabase.table('bots').update({
                             'webhook_url': webhook_url,
                             'is_active': True
                         }).eq('token', bot_token).execute()
+                        tenant_context.invalidate_tenant(token=bot_token)
                         logger.info(f"Updated bot in database with webhook URL")
                     except Exception as db_error:
                         logger.error(f"Failed to update bot in database: {str(db_error)}")
@@ -284,8 +447,9 @@ async def setup_webhook(
             return {
                 "status": "manual",
                 "webhook_url": webhook_url,
+                "secret_token": route.secret,
                 "environment": environment,
-                "instructions": "Set this webhook manually using @BotFather or Telegram API"
+                "instructions": "Set this webhook (with secret_token) manually using the Telegram API setWebhook method"
             }
 
     elif platform == "whatsapp":
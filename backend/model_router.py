@@ -0,0 +1,187 @@
+import logging
+import re
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+import backend.config as config
+from backend.llm_provider import LLMProvider
+from backend.llm_resilience import create_resilient_provider
+from backend.retrieval import WORD_RE
+
+logger = logging.getLogger(__name__)
+
+# Cheapest first: a canned reply, a small model with a short excerpt, the full model
+TIERS = ("template", "small", "full")
+
+# Messages made only of these words are small talk, answered without a model
+GREETING_WORDS = frozenset("hi hello hey hiya yo howdy greetings morning afternoon evening".split())
+THANKS_WORDS = frozenset("thanks thank thx ty cheers appreciated appreciate great cool perfect awesome".split())
+BYE_WORDS = frozenset("bye goodbye later cya night".split())
+SMALL_TALK_FILLERS = frozenset("ok okay nice good a lot so much very you there all see again have day".split())
+SMALL_TALK_WORDS = GREETING_WORDS | THANKS_WORDS | BYE_WORDS | SMALL_TALK_FILLERS
+
+# Words that usually mean the customer needs reasoning over the KB, not a lookup
+COMPLEX_WORDS = frozenset("""
+why explain compare comparison difference versus vs recommend should better best problem issue
+wrong broken error complaint damaged late missing cancel
+""".split())
+NEGATION_RE = re.compile(r"\b(?:not|no|never)\b|n't\b")
+
+TEMPLATES = {
+    'greeting': "Hi! I'm the {company} assistant. How can I help you today?",
+    'thanks': "You're welcome! Let me know if there's anything else I can help with.",
+    'bye': "Goodbye! Message us anytime if you have more questions.",
+}
+
+@dataclass
+class RouteDecision:
+    tier: str
+    reason: str
+    requested_tier: str  # what the message needed before the plan's restrictions
+
+    @property
+    def restricted(self) -> bool:
+        return self.tier != self.requested_tier
+
+def small_talk_kind(text: str) -> Optional[str]:
+    """'greeting', 'thanks' or 'bye' if the message is only small talk, else None."""
+    words = WORD_RE.findall(text.lower().replace("’", "'"))
+    if not words or len(words) > 6 or any(word not in SMALL_TALK_WORDS for word in words):
+        return None
+    if any(word in BYE_WORDS for word in words):
+        return 'bye'
+    if any(word in THANKS_WORDS for word in words):
+        return 'thanks'
+    if any(word in GREETING_WORDS for word in words):
+        return 'greeting'
+    return None
+
+def allowed_tiers(plan: Optional[Dict[str, Any]]) -> Tuple[str, ...]:
+    """Tiers a plan may use, from plans.features.model_tiers (all tiers if unset)."""
+    features = (plan or {}).get('features') or {}
+    tiers = features.get('model_tiers') if isinstance(features, dict) else None
+    if not tiers:
+        return TIERS
+    return tuple(tier for tier in TIERS if tier in tiers) or TIERS
+
+class ModelRouter:
+    """Sends each message to the cheapest tier that can answer it.
+
+    A keyword heuristic (no model call) classifies messages: small talk gets
+    a template, short single questions go to the small model with a shorter
+    KB excerpt, anything else to the full model. A plan can restrict its
+    tiers with features.model_tiers; a message then uses the cheapest allowed
+    tier at or above the one it needs, or the best allowed tier below it.
+    Only small talk ever gets a template; other messages fall back to the
+    best available model tier, or the full model if the plan allows none.
+    Decisions are counted per company with their tokens and latency.
+    """
+
+    def __init__(self, small_provider: Optional[LLMProvider] = None, simple_max_words: int = 12):
+        self.small_provider = small_provider
+        self.simple_max_words = simple_max_words
+        self.decisions = defaultdict(int)
+        self.restricted = 0
+        # company id -> tier -> [messages, tokens, latency seconds]
+        self._tenants: Dict[str, Dict[str, list]] = defaultdict(lambda: defaultdict(lambda: [0, 0, 0.0]))
+
+    def classify(self, text: str) -> Tuple[str, str]:
+        """The tier a message needs and why."""
+        if small_talk_kind(text):
+            return 'template', 'small talk'
+        words = WORD_RE.findall(text.lower())
+        if len(words) > self.simple_max_words:
+            return 'full', 'long message'
+        if text.count('?') > 1 or len([s for s in re.split(r"[.!?]+", text) if s.strip()]) > 1:
+            return 'full', 'several sentences'
+        if NEGATION_RE.search(text.lower()) or any(word in COMPLEX_WORDS for word in words):
+            return 'full', 'complex wording'
+        return 'small', 'short question'
+
+    def _available(self, tiers: Iterable[str]) -> Tuple[str, ...]:
+        return tuple(tier for tier in tiers if tier != 'small' or self.small_provider is not None)
+
+    def route(self, text: str, plan: Optional[Dict[str, Any]] = None) -> RouteDecision:
+        requested, reason = self.classify(text)
+        tiers = self._available(allowed_tiers(plan)) or ('full',)
+        if requested != 'template':
+            # A canned reply never answers a real question
+            models = tuple(tier for tier in tiers if tier != 'template')
+            if not models:
+                logger.warning(f"Plan allows no model tier for a {reason} message, using the full model")
+            tiers = models or ('full',)
+        rank = TIERS.index(requested)
+        at_or_above = [tier for tier in tiers if TIERS.index(tier) >= rank]
+        tier = at_or_above[0] if at_or_above else tiers[-1]
+        if not at_or_above:
+            logger.info(f"Routing a {reason} message to {tier} tier: {requested} tier not available")
+        decision = RouteDecision(tier, reason, requested)
+        self.decisions[tier] += 1
+        if decision.restricted:
+            self.restricted += 1
+        return decision
+
+    def template_reply(self, text: str, company: Dict[str, Any]) -> str:
+        kind = small_talk_kind(text) or 'greeting'
+        return TEMPLATES[kind].format(company=company.get('name') or "support")
+
+    def provider(self, tier: str) -> Optional[LLMProvider]:
+        """The provider for a model tier (None means the default provider)."""
+        return self.small_provider if tier == 'small' else None
+
+    def record(self, company_id: str, decision: RouteDecision, tokens: int, latency: float) -> None:
+        """Records the outcome of one routed message."""
+        totals = self._tenants[company_id][decision.tier]
+        totals[0] += 1
+        totals[1] += tokens
+        totals[2] += latency
+        logger.info(f"Routed message for company {company_id} to {decision.tier} tier ({decision.reason}): "
+                    f"{tokens} tokens, {latency * 1000:.0f} ms")
+
+    def tenant_stats(self, company_id: str, overall_full: Optional[list] = None) -> Dict[str, Any]:
+        """Per-tier messages, tokens and latency for one company, with the estimated savings.
+
+        Savings compare each cheaper-tier message with the average full-tier
+        message (this company's, or everyone's if it has none yet).
+        """
+        tiers = self._tenants.get(company_id, {})
+        full = tiers.get('full') or overall_full or self._overall('full')
+        full_tokens = full[1] / full[0] if full[0] else 0.0
+        full_latency = full[2] / full[0] if full[0] else 0.0
+        result: Dict[str, Any] = {}
+        tokens_saved = latency_saved = 0.0
+        for tier, (messages, tokens, latency) in tiers.items():
+            result[tier] = {
+                'messages': messages,
+                'tokens': tokens,
+                'avg_latency_ms': round(latency / messages * 1000, 1) if messages else 0.0
+            }
+            if tier != 'full' and full[0]:
+                tokens_saved += messages * full_tokens - tokens
+                latency_saved += messages * full_latency - latency
+        result['estimated_tokens_saved'] = round(tokens_saved)
+        result['estimated_seconds_saved'] = round(latency_saved, 1)
+        return result
+
+    def _overall(self, tier: str) -> list:
+        totals = [0, 0, 0.0]
+        for tiers in self._tenants.values():
+            if tier in tiers:
+                totals = [a + b for a, b in zip(totals, tiers[tier])]
+        return totals
+
+    def stats(self) -> Dict[str, Any]:
+        """Routing counters for the /metrics endpoint."""
+        overall_full = self._overall('full')
+        return {
+            'decisions': dict(self.decisions),
+            'restricted_by_plan': self.restricted,
+            'small_model': self.small_provider is not None,
+            'tenants': {company_id: self.tenant_stats(company_id, overall_full) for company_id in self._tenants}
+        }
+
+router = ModelRouter(
+    small_provider=create_resilient_provider(config.LLM_PROVIDER, config.LLM_SMALL_MODEL) if config.LLM_SMALL_MODEL else None,
+    simple_max_words=config.ROUTER_SIMPLE_MAX_WORDS
+)
@@ -0,0 +1,207 @@
+import logging
+import time
+from typing import Any, Callable, Dict, Tuple
+
+import backend.config as config
+import backend.retrieval as retrieval
+import backend.services as services
+from backend.analytics_sink import BOT_RESPONSE, MESSAGE, analytics_sink
+from backend.bulkhead import BUSY_MESSAGE
+from backend.coalescer import coalescer
+from backend.context_cache import context_cache
+from backend.conversation_memory import conversation_memory, is_follow_up
+from backend.model_router import router
+from backend.response_cache import normalize_question, response_cache
+from backend.telegram_client import telegram
+from backend.tenant_context import TenantContext, get_tenant_context
+from backend.usage_counter import usage_counter
+
+logger = logging.getLogger(__name__)
+
+async def _send_limit_exceeded(telegram_bot_token: str, chat_id: int, company_id: str) -> Dict[str, Any]:
+    limit_exceeded_message = "Sorry, I can't answer right now. The token limit for this billing period has been exceeded."
+    await services.send_telegram_message(telegram_bot_token, chat_id, limit_exceeded_message)
+    logger.warning(f"Token limit exceeded for company: {company_id}")
+    return {"status": "error", "detail": "Token limit exceeded"}
+
+async def _send_answer_without_model(telegram_bot_token: str, chat_id: int, company_id: str,
+                                     subscription: Dict[str, Any], answer: str, tokens: int,
+                                     source: str) -> Dict[str, Any]:
+    """Sends a cached or template answer, charging `tokens` (usually 0)."""
+    # Still refused once the plan's limit is used up, like any other answer
+    reservation = await usage_counter.reserve(subscription, minimum=tokens, desired=tokens,
+                                              limit=subscription['plans']['token_limit'])
+    if reservation is None:
+        return await _send_limit_exceeded(telegram_bot_token, chat_id, company_id)
+    await usage_counter.commit(reservation, tokens)
+    await services.send_telegram_message(telegram_bot_token, chat_id, answer)
+    logger.info(f"Answered from {source} for company: {company_id}")
+    return {"status": "success", "source": source}
+
+def _conversation_key(context: TenantContext, chat_id: int) -> str:
+    """Same identity as the conversations row: the bot (or the company for legacy bots) and the chat."""
+    return f"{context.bot_id or context.company_id}:{chat_id}"
+
+def _record(kind: str, context: TenantContext, chat_id: int) -> None:
+    """Counts a message or answer for the dashboards (buffered, written in batches)."""
+    if config.ANALYTICS_ENABLED:
+        analytics_sink.record(kind, context.company, context.bot_id, context.bot_name, chat_id)
+
+async def _answered(context: TenantContext, chat_id: int, question: str, answer: str) -> None:
+    """Counts a sent answer and adds the exchange to the chat's memory (fallback answers are left out)."""
+    _record(BOT_RESPONSE, context, chat_id)
+    if config.CONVERSATION_MEMORY_ENABLED and answer != services.FALLBACK_RESPONSE:
+        await conversation_memory.append(_conversation_key(context, chat_id), question, answer)
+
+async def send_busy_reply(job: Dict[str, Any]) -> None:
+    """Tells the customer to retry a message the bulkhead shed (it waited too long in the queue)."""
+    await services.send_telegram_message(job['bot_token'], job['chat_id'], BUSY_MESSAGE)
+
+async def process_telegram_update(job: Dict[str, Any]) -> Dict[str, Any]:
+    """Processes one queued Telegram message: tenant lookup, AI answer, usage and reply."""
+    telegram_bot_token = job['bot_token']
+    chat_id = job['chat_id']
+    user_message = job['text']
+    started = time.perf_counter()
+
+    try:
+        # 1. Identify the tenant (company, subscription, plan and KB in one cached lookup)
+        context = await get_tenant_context(telegram_bot_token)
+        if not context:
+            logger.error(f"Company not found for token: {telegram_bot_token[:10]}...")
+            return {"status": "error", "detail": "Company not found"}
+        company = context.company
+        subscription = context.subscription
+        _record(MESSAGE, context, chat_id)
+
+        # 2. Check for an active subscription and plan details
+        if not subscription:
+            error_msg = "Error: No active subscription found."
+            await services.send_telegram_message(telegram_bot_token, chat_id, error_msg)
+            logger.error(f"No active subscription for company: {company['id']}")
+            return {"status": "error", "detail": "No active subscription"}
+
+        # 3. Validate knowledge base
+        if not context.knowledge_base:
+            error_msg = "Error: Knowledge base not found."
+            await services.send_telegram_message(telegram_bot_token, chat_id, error_msg)
+            logger.error(f"No knowledge base for company: {company['id']}")
+            return {"status": "error", "detail": "Knowledge base not found"}
+
+        plan = subscription['plans']
+        # Small talk gets a template, simple questions a small model, the rest the full model
+        decision = router.route(user_message, plan) if config.ROUTER_ENABLED else None
+        tier = decision.tier if decision else 'full'
+        if tier == 'template':
+            answer = router.template_reply(user_message, company)
+            result = await _send_answer_without_model(telegram_bot_token, chat_id, company['id'], subscription,
+                                                      answer, 0, "template")
+            router.record(company['id'], decision, 0, time.perf_counter() - started)
+            if result['status'] == "success":
+                await _answered(context, chat_id, user_message, answer)
+            return result
+
+        # Recent turns of this chat, for questions that look like follow-ups. Answers that
+        # depend on them are specific to this chat: they are neither cached nor shared.
+        history = await conversation_memory.history(_conversation_key(context, chat_id)) \
+            if config.CONVERSATION_MEMORY_ENABLED and is_follow_up(user_message) else ""
+
+        if config.RESPONSE_CACHE_ENABLED and not history:
+            cached_answer = response_cache.get(company['id'], context.kb_version, user_message)
+            if cached_answer is not None:
+                result = await _send_answer_without_model(telegram_bot_token, chat_id, company['id'], subscription,
+                                                          cached_answer, config.RESPONSE_CACHE_HIT_TOKENS,
+                                                          "response cache")
+                if result['status'] == "success":
+                    await _answered(context, chat_id, user_message, cached_answer)
+                return result
+
+        # Only the chunks relevant to this question go into the prompt (fewer for the small model).
+        # With the full KB, a large one is cached on the provider's side and only the question is sent.
+        cached_prefix = None
+        max_output = config.MAX_OUTPUT_TOKENS
+        if tier == 'small':
+            max_output = min(max_output, config.ROUTER_SMALL_MAX_OUTPUT_TOKENS)
+        if config.RETRIEVAL_ENABLED:
+            knowledge_base = retrieval.engine.retrieve(company['id'], context.knowledge_documents, user_message,
+                                                       top_k=config.ROUTER_SMALL_TOP_K if tier == 'small' else None)
+        else:
+            knowledge_base = context.knowledge_base
+            if tier == 'full':
+                cached_prefix = await context_cache.get_prefix(company['id'], context.kb_version, knowledge_base)
+
+        # 4. Reserve the worst-case token cost against the plan's limit before calling the model.
+        # Reservations are atomic, so concurrent messages cannot overshoot the limit together.
+        prompt_tokens = services.estimate_tokens(services.build_prompt(user_message, knowledge_base, history))
+        reservation = await usage_counter.reserve(
+            subscription,
+            minimum=prompt_tokens + config.MIN_OUTPUT_TOKENS,
+            desired=prompt_tokens + max_output,
+            limit=plan['token_limit']
+        )
+        if reservation is None:
+            return await _send_limit_exceeded(telegram_bot_token, chat_id, company['id'])
+
+        # 5. Generate AI response within the reserved budget, then settle the reservation.
+        # In streaming mode the user sees the answer grow in one message while it is generated.
+        max_output_tokens = max(reservation.amount - prompt_tokens, config.MIN_OUTPUT_TOKENS)
+        stream = telegram.stream(telegram_bot_token, chat_id, config.TELEGRAM_EDIT_INTERVAL) \
+            if config.STREAMING_ENABLED else None
+        llm = router.provider(tier)
+
+        async def generate(on_text: Callable[[str], None]) -> Tuple[str, int]:
+            if stream:
+                return await services.stream_ai_response_and_count_tokens(
+                    user_message, knowledge_base, on_text=on_text, max_output_tokens=max_output_tokens,
+                    cached_prefix=cached_prefix, llm=llm, history=history
+                )
+            return await services.get_ai_response_and_count_tokens(
+                user_message, knowledge_base, max_output_tokens=max_output_tokens, cached_prefix=cached_prefix, llm=llm,
+                history=history
+            )
+
+        try:
+            if config.COALESCE_ENABLED and not history:
+                # Identical questions already being answered share that one generation
+                key = (company['id'], normalize_question(user_message), context.kb_version, tier)
+                result = await coalescer.run(key, generate, on_text=stream.update if stream else None)
+                ai_response, tokens_used = result.text, coalescer.billed_tokens(result, reservation.amount)
+                generated_here = result.leader
+            else:
+                ai_response, tokens_used = await generate(stream.update if stream else None)
+                generated_here = True
+        except BaseException:
+            await usage_counter.refund(reservation)
+            if stream:
+                stream.cancel()
+            raise
+        # Settles the reservation and records the usage_logs row
+        await usage_counter.commit(reservation, tokens_used)
+        logger.info(f"Generated response using {tokens_used} tokens for company: {company['id']}")
+
+        # 6. Send response
+        if config.RESPONSE_CACHE_ENABLED and generated_here and not history and ai_response != services.FALLBACK_RESPONSE:
+            response_cache.set(company['id'], context.kb_version, user_message, ai_response)
+        if stream:
+            await stream.finish(ai_response)
+        else:
+            await services.send_telegram_message(telegram_bot_token, chat_id, ai_response)
+        if decision:
+            router.record(company['id'], decision, tokens_used, time.perf_counter() - started)
+        await _answered(context, chat_id, user_message, ai_response)
+        logger.info(f"Successfully processed message for company: {company['id']}")
+
+        return {"status": "success", "source": f"{tier} model"}
+
+    except Exception as e:
+        logger.error(f"Error processing update: {str(e)}", exc_info=True)
+        try:
+            await services.send_telegram_message(
+                telegram_bot_token,
+                chat_id,
+                "Sorry, I'm experiencing technical difficulties. Please try again later."
+            )
+        except Exception:
+            pass  # Don't let telegram errors crash the worker
+
+        return {"status": "error", "detail": "Internal server error"}
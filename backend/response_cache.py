@@ -0,0 +1,206 @@
+import hashlib
+import logging
+import time
+from collections import OrderedDict, defaultdict
+from dataclasses import dataclass
+from typing import Any, Dict, FrozenSet, Hashable, List, Optional, Set, Tuple
+
+import backend.config as config
+from backend.retrieval import STOPWORDS, WORD_RE, tokenize
+
+logger = logging.getLogger(__name__)
+
+MERSENNE_PRIME = (1 << 61) - 1
+
+# Words that change how a question is phrased, not what it asks
+QUESTION_FILLERS = frozenset("""
+any anyone could hello hey hi just kindly know like please tell thank thanks want would wondering whats
+""".split())
+
+# Words that flip a question's meaning; a near-duplicate must use the same ones
+NEGATIONS = frozenset("""
+no not never nor none nothing without cannot can't don't doesn't didn't won't wouldn't isn't aren't wasn't weren't
+haven't hasn't hadn't shouldn't couldn't
+""".split())
+
+def normalize_question(text: str) -> str:
+    """Exact-match key: lowercase words only, so case, punctuation and spacing don't matter."""
+    return " ".join(WORD_RE.findall(text.lower()))
+
+def question_terms(text: str) -> FrozenSet[str]:
+    """The content words of a question, compared for near-duplicate matches."""
+    terms = set()
+    for term in tokenize(text.replace("’", "'")):
+        if term.endswith("'s") or term.endswith("'"):
+            term = term[:term.rindex("'")]  # tokenize turns "what's" into "what'"
+        if term.endswith("ie") and len(term) > 4:
+            term = term[:-2] + "y"  # tokenize turns "policies" into "policie"
+        if term not in QUESTION_FILLERS and term not in STOPWORDS:
+            terms.add(term)
+    return frozenset(terms)
+
+def question_guards(text: str) -> FrozenSet[str]:
+    """Negations and numbers of a question, which a near-duplicate must match exactly."""
+    words = WORD_RE.findall(text.lower().replace("’", "'"))
+    return frozenset(word for word in words if word in NEGATIONS or any(c.isdigit() for c in word))
+
+class MinHasher:
+    """MinHash signatures over a question's search terms, with LSH banding.
+
+    Questions whose term sets have a high Jaccard similarity share at least
+    one band with high probability, so near-duplicates are found with a few
+    dict lookups instead of comparing against every cached question.
+    """
+
+    def __init__(self, permutations: int = 120, bands: int = 20):
+        self.rows = permutations // bands
+        self.bands = bands
+        seeds = [hashlib.blake2b(str(i).encode(), digest_size=16).digest() for i in range(permutations)]
+        self._params = [
+            (int.from_bytes(seed[:8], 'little') % (MERSENNE_PRIME - 1) + 1,
+             int.from_bytes(seed[8:], 'little') % MERSENNE_PRIME)
+            for seed in seeds
+        ]
+
+    def signature(self, terms: FrozenSet[str]) -> Tuple[int, ...]:
+        hashes = [int.from_bytes(hashlib.blake2b(term.encode(), digest_size=8).digest(), 'little') for term in terms]
+        return tuple(min((a * h + b) % MERSENNE_PRIME for h in hashes) for a, b in self._params)
+
+    def band_keys(self, signature: Tuple[int, ...]) -> List[Tuple[int, int]]:
+        return [(band, hash(signature[band * self.rows:(band + 1) * self.rows])) for band in range(self.bands)]
+
+@dataclass
+class CachedResponse:
+    answer: str
+    terms: FrozenSet[str]
+    guards: FrozenSet[str]
+    bands: List[Tuple[int, int]]
+    fingerprint: Hashable
+    expires_at: float
+
+class ResponseCache:
+    """Per-company cache of answers to repeated customer questions.
+
+    Lookups try the normalized question first, then near-duplicates: cached
+    questions of the same company whose search terms (stopwords and plurals
+    removed) have a Jaccard similarity of at least `similarity`, contain every
+    term of the new question (an added qualifier like "express" may change the
+    answer) and have the same negations and numbers. Entries are
+    tied to the KB version (documents_fingerprint) they were generated from,
+    so an edited KB never serves stale answers. Size-bounded LRU with a TTL.
+    """
+
+    def __init__(self, max_size: int = 10000, ttl: float = 21600.0, similarity: float = 0.75):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.similarity = similarity
+        self.hasher = MinHasher()
+        self._entries: "OrderedDict[Tuple[str, str], CachedResponse]" = OrderedDict()
+        self._bands: Dict[str, Dict[Tuple[int, int], Set[str]]] = defaultdict(lambda: defaultdict(set))
+        self.exact_hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _remove(self, key: Tuple[str, str]) -> None:
+        entry = self._entries.pop(key)
+        company_bands = self._bands[key[0]]
+        for band in entry.bands:
+            questions = company_bands.get(band)
+            if questions is not None:
+                questions.discard(key[1])
+                if not questions:
+                    del company_bands[band]
+        if not company_bands:
+            del self._bands[key[0]]
+
+    def _live(self, key: Tuple[str, str], fingerprint: Hashable, now: float) -> Optional[CachedResponse]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires_at <= now or entry.fingerprint != fingerprint:
+            self._remove(key)
+            return None
+        return entry
+
+    def get(self, company_id: str, fingerprint: Hashable, question: str) -> Optional[str]:
+        """Returns a cached answer for this question (or a near-duplicate), or None."""
+        now = time.monotonic()
+        normalized = normalize_question(question)
+        entry = self._live((company_id, normalized), fingerprint, now)
+        if entry is not None:
+            self._entries.move_to_end((company_id, normalized))
+            self.exact_hits += 1
+            return entry.answer
+
+        terms = question_terms(question)
+        guards = question_guards(question)
+        if terms and company_id in self._bands:
+            best, best_score = None, self.similarity
+            company_bands = self._bands[company_id]
+            candidates = set()
+            for band in self.hasher.band_keys(self.hasher.signature(terms)):
+                candidates |= company_bands.get(band, set())
+            for candidate in candidates:
+                entry = self._live((company_id, candidate), fingerprint, now)
+                if entry is None or entry.guards != guards or not terms <= entry.terms:
+                    continue
+                score = len(terms & entry.terms) / len(terms | entry.terms)
+                if score >= best_score:
+                    best, best_score = candidate, score
+            if best is not None:
+                self._entries.move_to_end((company_id, best))
+                self.similar_hits += 1
+                return self._entries[(company_id, best)].answer
+
+        self.misses += 1
+        return None
+
+    def set(self, company_id: str, fingerprint: Hashable, question: str, answer: str) -> None:
+        """Caches an answer, evicting the least recently used entry when full."""
+        key = (company_id, normalize_question(question))
+        if key in self._entries:
+            self._remove(key)
+        terms = question_terms(question)
+        bands = self.hasher.band_keys(self.hasher.signature(terms)) if terms else []
+        self._entries[key] = CachedResponse(answer, terms, question_guards(question), bands, fingerprint, time.monotonic() + self.ttl)
+        for band in bands:
+            self._bands[company_id][band].add(key[1])
+        self.stores += 1
+        while len(self._entries) > self.max_size:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def invalidate_company(self, company_id: str) -> int:
+        """Drops every cached answer of a company (its KB changed). Returns the number dropped."""
+        keys = [key for key in self._entries if key[0] == company_id]
+        for key in keys:
+            self._remove(key)
+        self.invalidations += len(keys)
+        return len(keys)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit/miss counters for the /metrics endpoint."""
+        lookups = self.exact_hits + self.similar_hits + self.misses
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'exact_hits': self.exact_hits,
+            'similar_hits': self.similar_hits,
+            'misses': self.misses,
+            'hit_rate': round((self.exact_hits + self.similar_hits) / lookups, 4) if lookups else 0.0,
+            'stores': self.stores,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations
+        }
+
+response_cache = ResponseCache(
+    max_size=config.RESPONSE_CACHE_MAX_SIZE,
+    ttl=config.RESPONSE_CACHE_TTL,
+    similarity=config.RESPONSE_CACHE_SIMILARITY
+)
@@ -0,0 +1,383 @@
+import hashlib
+import logging
+import math
+import re
+from abc import ABC, abstractmethod
+from collections import Counter, defaultdict
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import backend.config as config
+
+logger = logging.getLogger(__name__)
+
+WORD_RE = re.compile(r"[a-z0-9]+(?:[-'][a-z0-9]+)*")
+SENTENCE_RE = re.compile(r"(?<=[.!?])\s+")
+
+STOPWORDS = frozenset("""
+a an and are as at be by can do does for from has have how i if in is it its me my of on or our
+so that the their there this to was we what when where which who why will with you your
+""".split())
+
+def tokenize(text: str) -> List[str]:
+    """Lowercases and splits text into search terms, dropping stopwords and plural 's'."""
+    terms = []
+    for word in WORD_RE.findall(text.lower()):
+        if word in STOPWORDS:
+            continue
+        if len(word) > 3 and word.endswith('s') and not word.endswith('ss'):
+            word = word[:-1]
+        terms.append(word)
+    return terms
+
+@dataclass
+class Chunk:
+    """A retrievable piece of one knowledge base document."""
+    doc_id: str
+    position: int
+    text: str
+
+    @property
+    def key(self) -> Tuple[str, int]:
+        return (self.doc_id, self.position)
+
+def chunk_text(text: str, max_chars: int = 800, overlap: int = 100) -> List[str]:
+    """Splits a document into chunks of whole sentences, at most max_chars long.
+
+    Paragraph boundaries always start a new chunk. Consecutive chunks of the
+    same paragraph share up to `overlap` characters of trailing sentences so
+    facts that straddle a boundary stay retrievable.
+    """
+    chunks = []
+    for paragraph in re.split(r"\n\s*\n", text):
+        paragraph = " ".join(paragraph.split())
+        if not paragraph:
+            continue
+        sentences = SENTENCE_RE.split(paragraph)
+        current: List[str] = []
+        length = 0
+        for sentence in sentences:
+            # Hard-split sentences that are longer than a whole chunk
+            while len(sentence) > max_chars:
+                if current:
+                    chunks.append(" ".join(current))
+                    current, length = [], 0
+                chunks.append(sentence[:max_chars])
+                sentence = sentence[max_chars:]
+            if current and length + len(sentence) + 1 > max_chars:
+                chunks.append(" ".join(current))
+                carried: List[str] = []
+                carried_length = 0
+                for previous in reversed(current):
+                    if carried_length + len(previous) > overlap:
+                        break
+                    carried.insert(0, previous)
+                    carried_length += len(previous) + 1
+                current, length = carried, carried_length
+            current.append(sentence)
+            length += len(sentence) + 1
+        if current:
+            chunks.append(" ".join(current))
+    return chunks
+
+class BM25Index:
+    """Okapi BM25 over chunks, with postings that can be added and removed per chunk."""
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings: Dict[str, Dict[Tuple[str, int], int]] = defaultdict(dict)
+        self.lengths: Dict[Tuple[str, int], int] = {}
+        self._total_length = 0
+
+    def add(self, chunk: Chunk) -> None:
+        terms = Counter(tokenize(chunk.text))
+        for term, frequency in terms.items():
+            self.postings[term][chunk.key] = frequency
+        length = sum(terms.values())
+        self.lengths[chunk.key] = length
+        self._total_length += length
+
+    def remove(self, chunk: Chunk) -> None:
+        for term in set(tokenize(chunk.text)):
+            postings = self.postings.get(term)
+            if postings is not None:
+                postings.pop(chunk.key, None)
+                if not postings:
+                    del self.postings[term]
+        self._total_length -= self.lengths.pop(chunk.key, 0)
+
+    def search(self, query: str, k: int) -> List[Tuple[Tuple[str, int], float]]:
+        """Returns up to k (chunk_key, score) pairs with a positive score, best first."""
+        count = len(self.lengths)
+        if not count:
+            return []
+        average_length = self._total_length / count or 1.0
+        scores: Dict[Tuple[str, int], float] = defaultdict(float)
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for key, frequency in postings.items():
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[key] / average_length)
+                scores[key] += idf * frequency * (self.k1 + 1) / (frequency + norm)
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+
+class EmbeddingBackend(ABC):
+    """Interface for local embedding models used to re-rank BM25 candidates."""
+
+    @abstractmethod
+    def embed(self, texts: Sequence[str]) -> List[List[float]]:
+        """One embedding vector per text."""
+
+class HashingEmbeddingBackend(EmbeddingBackend):
+    """Dependency-free embeddings from hashed unigrams and bigrams (feature hashing)."""
+
+    def __init__(self, dimensions: int = 512):
+        self.dimensions = dimensions
+
+    def embed(self, texts: Sequence[str]) -> List[List[float]]:
+        vectors = []
+        for text in texts:
+            terms = tokenize(text)
+            features = terms + [f"{a} {b}" for a, b in zip(terms, terms[1:])]
+            vector = [0.0] * self.dimensions
+            for feature in features:
+                digest = hashlib.blake2b(feature.encode(), digest_size=8).digest()
+                bucket = int.from_bytes(digest[:4], 'little') % self.dimensions
+                vector[bucket] += 1.0 if digest[4] & 1 else -1.0
+            norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+            vectors.append([value / norm for value in vector])
+        return vectors
+
+class SentenceTransformerBackend(EmbeddingBackend):
+    """Local sentence-transformers model (optional dependency)."""
+
+    def __init__(self, model_name: str = "all-MiniLM-L6-v2"):
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError as e:
+            raise ValueError("RETRIEVAL_EMBEDDING_BACKEND=sentence-transformers requires the sentence-transformers package") from e
+        self.model = SentenceTransformer(model_name)
+
+    def embed(self, texts: Sequence[str]) -> List[List[float]]:
+        return [list(map(float, vector)) for vector in self.model.encode(list(texts), normalize_embeddings=True)]
+
+def create_embedding_backend(name: Optional[str]) -> Optional[EmbeddingBackend]:
+    """Builds the embedding backend selected by config.RETRIEVAL_EMBEDDING_BACKEND."""
+    if not name or name == "none":
+        return None
+    if name == "hashing":
+        return HashingEmbeddingBackend()
+    if name == "sentence-transformers":
+        return SentenceTransformerBackend()
+    raise ValueError(f"Unknown retrieval embedding backend: {name}")
+
+class KnowledgeIndex:
+    """Chunked, searchable index over one company's knowledge base documents."""
+
+    def __init__(self, embeddings: Optional[EmbeddingBackend] = None,
+                 chunk_size: int = 800, chunk_overlap: int = 100):
+        self.embeddings = embeddings
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.bm25 = BM25Index()
+        self.chunks: Dict[Tuple[str, int], Chunk] = {}
+        self.vectors: Dict[Tuple[str, int], List[float]] = {}
+        self.documents: Dict[str, List[Chunk]] = {}
+        self.doc_hashes: Dict[str, str] = {}
+        self.chunked = 0  # documents (re)chunked since the index was created
+
+    def upsert_document(self, doc_id: str, text: str) -> bool:
+        """Indexes a document, re-chunking it only if its content changed.
+
+        Returns True if the document was (re)indexed.
+        """
+        digest = content_hash(text)
+        if self.doc_hashes.get(doc_id) == digest:
+            return False
+        self.remove_document(doc_id)
+        if text:
+            self.add_document(doc_id, text)
+        self.doc_hashes[doc_id] = digest
+        return True
+
+    def sync(self, documents: Sequence[Dict[str, Any]]) -> Dict[str, int]:
+        """Brings the index in line with a full list of documents, touching only changed rows."""
+        seen = set()
+        updated = 0
+        for doc in documents:
+            doc_id = str(doc['id'])
+            seen.add(doc_id)
+            updated += int(self.upsert_document(doc_id, doc.get('content') or ""))
+        removed = 0
+        for doc_id in [doc_id for doc_id in self.doc_hashes if doc_id not in seen]:
+            self.remove_document(doc_id)
+            removed += 1
+        return {'updated': updated, 'removed': removed}
+
+    def add_document(self, doc_id: str, text: str) -> None:
+        chunks = [Chunk(doc_id, position, piece)
+                  for position, piece in enumerate(chunk_text(text, self.chunk_size, self.chunk_overlap))]
+        self.documents[doc_id] = chunks
+        self.chunked += 1
+        for chunk in chunks:
+            self.chunks[chunk.key] = chunk
+            self.bm25.add(chunk)
+        if self.embeddings and chunks:
+            for chunk, vector in zip(chunks, self.embeddings.embed([chunk.text for chunk in chunks])):
+                self.vectors[chunk.key] = vector
+
+    def remove_document(self, doc_id: str) -> None:
+        self.doc_hashes.pop(doc_id, None)
+        for chunk in self.documents.pop(doc_id, []):
+            self.bm25.remove(chunk)
+            self.chunks.pop(chunk.key, None)
+            self.vectors.pop(chunk.key, None)
+
+    def search(self, query: str, k: int) -> List[Chunk]:
+        """Returns the k most relevant chunks.
+
+        BM25 picks the candidates; with an embedding backend the candidates
+        are re-ranked by reciprocal rank fusion of BM25 and cosine similarity.
+        """
+        candidates = self.bm25.search(query, k * 3 if self.embeddings else k)
+        if self.embeddings and self.vectors:
+            query_vector = self.embeddings.embed([query])[0]
+            similarities = sorted(
+                self.vectors.items(),
+                key=lambda item: sum(a * b for a, b in zip(query_vector, item[1])),
+                reverse=True
+            )[:k * 3]
+            fused: Dict[Tuple[str, int], float] = defaultdict(float)
+            for rank, (key, _) in enumerate(candidates):
+                fused[key] += 1.0 / (60 + rank)
+            for rank, (key, _) in enumerate(similarities):
+                fused[key] += 1.0 / (60 + rank)
+            ranked = sorted(fused.items(), key=lambda item: item[1], reverse=True)
+        else:
+            ranked = candidates
+        return [self.chunks[key] for key, _ in ranked[:k]]
+
+    def __len__(self) -> int:
+        return len(self.chunks)
+
+def content_hash(text: str) -> str:
+    """Hash of one KB row's content, used to skip re-chunking unchanged rows."""
+    return hashlib.sha256(text.encode()).hexdigest()
+
+def documents_fingerprint(documents: Sequence[Dict[str, Any]]) -> Tuple:
+    """Cheap identity of one version of a company's KB rows.
+
+    Uses the updated_at watermark maintained by the update_knowledge_bases_updated_at
+    trigger, falling back to a content hash for rows without one.
+    """
+    return tuple(sorted(
+        (str(doc.get('id')), doc.get('updated_at') or content_hash(doc.get('content') or ""))
+        for doc in documents
+    ))
+
+class RetrievalEngine:
+    """Per-company knowledge indexes, kept up to date incrementally."""
+
+    def __init__(self, top_k: int = 4, chunk_size: int = 800, chunk_overlap: int = 100,
+                 embeddings: Optional[EmbeddingBackend] = None, max_indexes: int = 1000):
+        self.top_k = top_k
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.embeddings = embeddings
+        self.max_indexes = max_indexes
+        self._indexes: Dict[str, Tuple[Tuple, KnowledgeIndex]] = {}
+        self.builds = 0
+        self.documents_updated = 0
+        self.documents_removed = 0
+
+    def _store(self, company_id: str, fingerprint: Tuple, index: KnowledgeIndex) -> None:
+        # Re-insert so the dict keeps least recently used companies first
+        self._indexes.pop(company_id, None)
+        self._indexes[company_id] = (fingerprint, index)
+        while len(self._indexes) > self.max_indexes:
+            self._indexes.pop(next(iter(self._indexes)))
+
+    def get_index(self, company_id: str, documents: Sequence[Dict[str, Any]]) -> KnowledgeIndex:
+        """Returns the company's index, re-indexing only the rows that changed."""
+        fingerprint = documents_fingerprint(documents)
+        cached = self._indexes.get(company_id)
+        if cached is None:
+            index = KnowledgeIndex(self.embeddings, self.chunk_size, self.chunk_overlap)
+            self.builds += 1
+        else:
+            index = cached[1]
+        if cached is None or cached[0] != fingerprint:
+            changes = index.sync(documents)
+            self.documents_updated += changes['updated']
+            self.documents_removed += changes['removed']
+        self._store(company_id, fingerprint, index)
+        return index
+
+    def apply_changes(self, company_id: str, upserts: Sequence[Dict[str, Any]] = (),
+                      deleted_ids: Sequence[str] = ()) -> int:
+        """Applies changed and deleted KB rows to an existing index.
+
+        Returns how many documents were actually re-indexed or removed (0 if
+        the company has no index yet; it will be built on first use).
+        """
+        cached = self._indexes.get(company_id)
+        if cached is None:
+            return 0
+        index = cached[1]
+        applied = 0
+        for doc in upserts:
+            applied += int(index.upsert_document(str(doc['id']), doc.get('content') or ""))
+        self.documents_updated += applied
+        for doc_id in deleted_ids:
+            if str(doc_id) in index.doc_hashes:
+                index.remove_document(str(doc_id))
+                self.documents_removed += 1
+                applied += 1
+        if applied:
+            # The next request syncs against the reloaded tenant context; hashes make that a no-op
+            self._indexes[company_id] = ((), index)
+        return applied
+
+    def indexed_document_ids(self, company_id: str) -> List[str]:
+        cached = self._indexes.get(company_id)
+        return list(cached[1].doc_hashes) if cached else []
+
+    def indexed_companies(self) -> List[str]:
+        return list(self._indexes)
+
+    def retrieve(self, company_id: str, documents: Sequence[Dict[str, Any]], query: str,
+                 top_k: Optional[int] = None) -> str:
+        """Returns the most relevant KB chunks for a question, joined for the prompt.
+
+        If nothing matches, the first chunks are used so the model still sees
+        the company overview and contact details.
+        """
+        k = top_k or self.top_k
+        index = self.get_index(company_id, documents)
+        chunks = index.search(query, k)
+        if not chunks:
+            chunks = sorted(index.chunks.values(), key=lambda chunk: chunk.key)[:k]
+        # Keep the original document order so the excerpt reads naturally
+        order = {doc_id: position for position, doc_id in enumerate(index.documents)}
+        chunks = sorted(chunks, key=lambda chunk: (order[chunk.doc_id], chunk.position))
+        return "\n\n".join(chunk.text for chunk in chunks)
+
+    def stats(self) -> Dict[str, Any]:
+        """Index counters for the /metrics endpoint."""
+        return {
+            'indexes': len(self._indexes),
+            'chunks': sum(len(index) for _, index in self._indexes.values()),
+            'builds': self.builds,
+            'documents_updated': self.documents_updated,
+            'documents_removed': self.documents_removed
+        }
+
+engine = RetrievalEngine(
+    top_k=config.RETRIEVAL_TOP_K,
+    chunk_size=config.RETRIEVAL_CHUNK_SIZE,
+    chunk_overlap=config.RETRIEVAL_CHUNK_OVERLAP,
+    embeddings=create_embedding_backend(config.RETRIEVAL_EMBEDDING_BACKEND)
+)
@@ -1,77 +1,38 @@
-import google.generativeai as genai
-import requests
-from backend.database import supabase
+import asyncio
+import math
+import re
+from backend.database import get_async_supabase
+from backend.tenant_context import get_tenant_context
+from backend.usage_writer import usage_writer
+from backend.telegram_client import telegram
+from backend.llm_provider import LLMProvider
+from backend.llm_resilience import CircuitOpenError, create_resilient_provider
 import backend.config as config
-from datetime import datetime
 import logging
-import time
-from typing import Optional, Dict, Any
+from typing import Callable, Optional, Dict, Any, Tuple
 from supabase import PostgrestAPIError
 
 logger = logging.getLogger(__name__)
 
-genai.configure(api_key=config.GOOGLE_API_KEY)
-model = genai.GenerativeModel('gemini-1.5-flash')  # Fixed: Updated to working Gemini model
-
-def send_telegram_message(token: str, chat_id: int, text: str, retries: int = 3) -> bool:
-    """Sends a message to a Telegram user with retry logic."""
-    url = f"https://api.telegram.org/bot{token}/sendMessage"
-    payload = {
-        "chat_id": chat_id,
-        "text": text[:4096]  # Telegram message limit
-    }
-    
-    for attempt in range(retries):
-        try:
-            response = requests.post(url, json=payload, timeout=30)
-            if response.status_code == 200:
-                logger.info(f"Successfully sent message to chat_id {chat_id}")
-                return True
-            elif response.status_code == 429:  # Rate limit
-                retry_after = int(response.headers.get('Retry-After', 1))
-                logger.warning(f"Rate limited, waiting {retry_after} seconds")
-                time.sleep(retry_after)
-                continue
-            else:
-                logger.error(f"Telegram API error: {response.status_code} - {response.text}")
-                if attempt < retries - 1:
-                    time.sleep(2 ** attempt)  # Exponential backoff
-        except requests.RequestException as e:
-            logger.error(f"Request error sending message (attempt {attempt + 1}): {e}")
-            if attempt < retries - 1:
-                time.sleep(2 ** attempt)
-    
-    logger.error(f"Failed to send message after {retries} attempts")
-    return False
-
-def get_company_by_token(token: str) -> Optional[Dict[Any, Any]]:
-    """Fetches a company from the database based on the bot token."""
-    try:
-        # First, find the bot by token
-        bot_response = supabase.table('bots').select('company_id').eq('token', token).maybe_single().execute()
-
-        if not bot_response.data:
-            # Fallback to old method for backward compatibility
-            logger.warning(f"Bot not found in bots table, checking companies.telegram_bot_token")
-            response = supabase.table('companies').select('*').eq('telegram_bot_token', token).maybe_single().execute()
-            return response.data
-
-        # Get the company using the bot's company_id
-        company_id = bot_response.data['company_id']
-        company_response = supabase.table('companies').select('*').eq('id', company_id).maybe_single().execute()
-        return company_response.data
-    except PostgrestAPIError as e:
-        logger.error(f"Database error fetching company: {e}")
-        return None
-    except Exception as e:
-        logger.error(f"Unexpected error fetching company: {e}")
-        return None
+# Text generation backend selected by LLM_PROVIDER (Gemini, OpenAI-compatible, or the local stub),
+# behind a circuit breaker so a provider outage fails fast with FALLBACK_RESPONSE
+provider = create_resilient_provider(config.LLM_PROVIDER)
 
-def get_active_subscription(company_id: str) -> Optional[Dict[Any, Any]]:
+async def send_telegram_message(token: str, chat_id: int, text: str) -> bool:
+    """Sends a message to a Telegram user; retries happen in the background (see TelegramClient)."""
+    return await telegram.send_message(token, chat_id, text)
+
+async def get_company_by_token(token: str) -> Optional[Dict[Any, Any]]:
+    """Fetches a company based on the bot token (served from the cached tenant context)."""
+    context = await get_tenant_context(token)
+    return context.company if context else None
+
+async def get_active_subscription(company_id: str) -> Optional[Dict[Any, Any]]:
     """Fetches the active subscription for a given company."""
     try:
-        response = supabase.table('subscriptions').select('*, plans(*)').eq('company_id', company_id).eq('is_active', True).maybe_single().execute()
-        return response.data
+        supabase = await get_async_supabase()
+        response = await supabase.table('subscriptions').select('*, plans(*)').eq('company_id', company_id).eq('is_active', True).maybe_single().execute()
+        return response.data if response else None
     except PostgrestAPIError as e:
         logger.error(f"Database error fetching subscription for company {company_id}: {e}")
         return None
@@ -79,10 +40,11 @@ def get_active_subscription(company_id: str) -> Optional[Dict[Any, Any]]:
         logger.error(f"Unexpected error fetching subscription: {e}")
         return None
 
-def get_knowledge_base_content(company_id: str) -> str:
+async def get_knowledge_base_content(company_id: str) -> str:
     """Fetches and concatenates the knowledge base content for a given company."""
     try:
-        response = supabase.table('knowledge_bases').select('content').eq('company_id', company_id).execute()
+        supabase = await get_async_supabase()
+        response = await supabase.table('knowledge_bases').select('content').eq('company_id', company_id).execute()
         if not response.data:
             logger.warning(f"No knowledge base content found for company: {company_id}")
             return ""
@@ -94,15 +56,20 @@ def get_knowledge_base_content(company_id: str) -> str:
         logger.error(f"Unexpected error fetching knowledge base: {e}")
         return ""
 
-def get_total_usage(subscription_id: str, start_date: str, end_date: str) -> int:
+async def fetch_total_usage(subscription_id: str, start_date: str, end_date: str) -> int:
+    """Calls the get_total_usage database function, raising on database errors."""
+    supabase = await get_async_supabase()
+    response = await supabase.rpc('get_total_usage', {
+        'p_subscription_id': subscription_id,
+        'p_start_date': start_date,
+        'p_end_date': end_date
+    }).execute()
+    return response.data if response.data is not None else 0
+
+async def get_total_usage(subscription_id: str, start_date: str, end_date: str) -> int:
     """Calls the get_total_usage database function."""
     try:
-        response = supabase.rpc('get_total_usage', {
-            'p_subscription_id': subscription_id,
-            'p_start_date': start_date,
-            'p_end_date': end_date
-        }).execute()
-        return response.data if response.data is not None else 0
+        return await fetch_total_usage(subscription_id, start_date, end_date)
     except PostgrestAPIError as e:
         logger.error(f"Database error getting usage for subscription {subscription_id}: {e}")
         return 0
@@ -110,10 +77,18 @@ def get_total_usage(subscription_id: str, start_date: str, end_date: str) -> int
         logger.error(f"Unexpected error getting usage: {e}")
         return 0
 
-def record_usage(subscription_id: str, tokens_used: int) -> bool:
-    """Records token usage in the usage_logs table."""
+async def record_usage(subscription_id: str, tokens_used: int) -> bool:
+    """Records token usage in the usage_logs table.
+
+    While the usage writer is running the row is buffered and bulk-inserted
+    in the background; otherwise (scripts, tests) it is inserted directly.
+    """
+    if usage_writer.running:
+        usage_writer.record(subscription_id, tokens_used)
+        return True
     try:
-        supabase.table('usage_logs').insert({
+        supabase = await get_async_supabase()
+        await supabase.table('usage_logs').insert({
             'subscription_id': subscription_id,
             'total_tokens': tokens_used  # Fixed: Use 'total_tokens' column name from database
         }).execute()
@@ -126,9 +101,26 @@ def record_usage(subscription_id: str, tokens_used: int) -> bool:
         logger.error(f"Unexpected error recording usage: {e}")
         return False
 
-def generate_ai_response(user_message: str, knowledge_base: str, retries: int = 3) -> str:
-    """Generates a response using the AI model and knowledge base with retry logic."""
-    prompt = f"""
+async def increment_message_count(bot_id: str, user_id: str, increment: int = 1) -> Optional[str]:
+    """Counts messages in the chat's conversations row (increment_message_count RPC); returns its id."""
+    try:
+        supabase = await get_async_supabase()
+        response = await supabase.rpc('increment_message_count', {
+            'p_bot_id': bot_id,
+            'p_user_id': user_id,
+            'p_increment': increment
+        }).execute()
+        return response.data
+    except PostgrestAPIError as e:
+        logger.error(f"Database error incrementing message count: {e}")
+        return None
+    except Exception as e:
+        logger.error(f"Unexpected error incrementing message count: {e}")
+        return None
+
+def build_prompt_prefix(knowledge_base: str) -> str:
+    """The stable part of the prompt (instructions and knowledge base), shared by every question."""
+    return f"""
     You are a customer support agent. Your responses must be helpful, friendly, and professional.
     Use the following knowledge base to answer the user's question.
     If the answer is not in the knowledge base, state that you don't have that information and provide the company's support contact details from the knowledge base.
@@ -137,7 +129,17 @@ def generate_ai_response(user_message: str, knowledge_base: str, retries: int =
     ---
     {knowledge_base}
     ---
+"""
 
+def build_prompt_suffix(user_message: str, history: str = "") -> str:
+    """The per-message part of the prompt (recent conversation and question), appended to the prefix."""
+    conversation = f"""
+    Conversation so far (use it to understand follow-up questions):
+    ---
+    {history}
+    ---
+""" if history else ""
+    return conversation + f"""
     User's Question:
     ---
     {user_message}
@@ -145,34 +147,145 @@ def generate_ai_response(user_message: str, knowledge_base: str, retries: int =
 
     Answer:
     """
-    
+
+def build_prompt(user_message: str, knowledge_base: str, history: str = "") -> str:
+    """Builds the customer support prompt sent to the AI model."""
+    return build_prompt_prefix(knowledge_base) + build_prompt_suffix(user_message, history)
+
+# Word pieces, single digits, and every other non-space character on its own
+_TOKEN_PIECES = re.compile(r"[^\W\d_]+|\d|[^\w\s]|_")
+
+def estimate_tokens(text: str, scale: Optional[float] = None) -> int:
+    """Fast local token estimate for pre-flight budgeting (no network call).
+
+    Approximates Gemini's tokenizer: a common word is one token and longer
+    words add one per ~6 characters, each digit and punctuation mark is its
+    own token, non-ASCII letters count one each. Scaled by TOKEN_ESTIMATE_SCALE
+    so it errs on the high side; `benchmark.py tokens` calibrates it.
+    """
+    tokens = 0
+    for piece in _TOKEN_PIECES.findall(text):
+        if len(piece) == 1:
+            tokens += 1
+        elif piece.isascii():
+            tokens += 1 + (len(piece) - 1) // 6
+        else:
+            tokens += len(piece)
+    return math.ceil(tokens * (config.TOKEN_ESTIMATE_SCALE if scale is None else scale))
+
+async def count_response_tokens(prompt: str, response_text: str, llm: Optional[LLMProvider] = None) -> int:
+    """Counts prompt and response tokens with the provider's tokenizer (two remote calls).
+
+    Only used when a response carries no usage metadata.
+    """
+    llm = llm or provider
+    try:
+        prompt_tokens, response_tokens = await asyncio.gather(
+            llm.count_tokens(prompt),
+            llm.count_tokens(response_text)
+        )
+        return prompt_tokens + response_tokens
+    except Exception as e:
+        logger.error(f"Error counting tokens: {e}")
+        return estimate_tokens(prompt) + estimate_tokens(response_text)
+
+FALLBACK_RESPONSE = "I'm sorry, I'm experiencing technical difficulties right now. Please try again later or contact support."
+
+async def generate_ai_response(user_message: str, knowledge_base: str, retries: int = 3,
+                               max_output_tokens: Optional[int] = None) -> str:
+    """Generates a response using the AI model and knowledge base with retry logic."""
+    response_text, _ = await get_ai_response_and_count_tokens(
+        user_message, knowledge_base, retries=retries, max_output_tokens=max_output_tokens
+    )
+    return response_text
+
+def _prompt_for_attempt(attempt: int, prompt: str, user_message: str, cached_prefix: Any,
+                        history: str = "") -> Tuple[str, Any]:
+    """The prompt and cached prefix for one attempt: only the question when the prefix is cached.
+
+    Retries send the full prompt, in case the cached content expired or was
+    deleted on the provider's side.
+    """
+    if cached_prefix is not None and attempt == 0:
+        return build_prompt_suffix(user_message, history), cached_prefix
+    return prompt, None
+
+async def get_ai_response_and_count_tokens(user_message: str, knowledge_base: str, retries: int = 3,
+                                           max_output_tokens: Optional[int] = None,
+                                           cached_prefix: Any = None,
+                                           llm: Optional[LLMProvider] = None,
+                                           history: str = "") -> Tuple[str, int]:
+    """Gets the AI response and the total tokens used, as reported by the model.
+
+    cached_prefix is this knowledge base's prompt prefix cached with the
+    provider (see context_cache), so only the question is sent. llm picks
+    another provider than the default (e.g. a smaller model). history is the
+    chat's recent conversation (see conversation_memory).
+    """
+    prompt = build_prompt(user_message, knowledge_base, history)
+    llm = llm or provider
+
     for attempt in range(retries):
         try:
-            response = model.generate_content(prompt)
-            if response.text:
-                return response.text
+            attempt_prompt, attempt_prefix = _prompt_for_attempt(attempt, prompt, user_message, cached_prefix, history)
+            generation = await llm.generate(attempt_prompt, max_output_tokens=max_output_tokens,
+                                                 cached_prefix=attempt_prefix)
+            if generation.text:
+                total_tokens = generation.total_tokens
+                if total_tokens is None:
+                    total_tokens = await count_response_tokens(prompt, generation.text, llm)
+                return generation.text, total_tokens
             else:
                 logger.warning(f"Empty response from AI model (attempt {attempt + 1})")
+        except CircuitOpenError as e:
+            logger.warning(f"Skipping AI generation: {e}")
+            break
         except Exception as e:
             logger.error(f"AI generation error (attempt {attempt + 1}): {e}")
-            if attempt < retries - 1:
-                time.sleep(2 ** attempt)  # Exponential backoff
-    
-    # Fallback response
-    return "I'm sorry, I'm experiencing technical difficulties right now. Please try again later or contact support."
-
-def get_ai_response_and_count_tokens(user_message: str, knowledge_base: str) -> (str, int):
-    """Gets the AI response and counts the total tokens used."""
-    response_text = generate_ai_response(user_message, knowledge_base)
-    
-    # Count tokens for both prompt and response
-    try:
-        prompt_tokens = model.count_tokens(user_message + knowledge_base).total_tokens
-        response_tokens = model.count_tokens(response_text).total_tokens
-        total_tokens = prompt_tokens + response_tokens
-    except Exception as e:
-        logger.error(f"Error counting tokens: {e}")
-        # Fallback estimation: ~4 characters per token
-        total_tokens = (len(user_message) + len(knowledge_base) + len(response_text)) // 4
-    
-    return response_text, total_tokens
\ No newline at end of file
+            # No backoff once the breaker has opened: the next attempt fails fast anyway
+            if attempt < retries - 1 and llm.available():
+                await asyncio.sleep(2 ** attempt)  # Exponential backoff
+
+    # Fallback response: no answer was generated, so nothing is billed for it
+    return FALLBACK_RESPONSE, 0
+
+async def stream_ai_response_and_count_tokens(user_message: str, knowledge_base: str,
+                                              on_text: Callable[[str], None], retries: int = 3,
+                                              max_output_tokens: Optional[int] = None,
+                                              cached_prefix: Any = None,
+                                              llm: Optional[LLMProvider] = None,
+                                              history: str = "") -> Tuple[str, int]:
+    """Streams the AI response, calling on_text with the text so far as chunks arrive.
+
+    The token count is the stream's usage metadata (exact, as billed), with
+    count_tokens as a fallback when the metadata is missing.
+    """
+    prompt = build_prompt(user_message, knowledge_base, history)
+    llm = llm or provider
+
+    for attempt in range(retries):
+        try:
+            attempt_prompt, attempt_prefix = _prompt_for_attempt(attempt, prompt, user_message, cached_prefix, history)
+            stream = llm.stream(attempt_prompt, max_output_tokens=max_output_tokens,
+                                     cached_prefix=attempt_prefix)
+            text = ""
+            async for piece in stream:
+                text += piece
+                on_text(text)
+            if text:
+                total_tokens = stream.total_tokens
+                if total_tokens is None:
+                    total_tokens = await count_response_tokens(prompt, text, llm)
+                return text, total_tokens
+            logger.warning(f"Empty response from AI model (attempt {attempt + 1})")
+        except CircuitOpenError as e:
+            logger.warning(f"Skipping AI streaming: {e}")
+            break
+        except Exception as e:
+            logger.error(f"AI streaming error (attempt {attempt + 1}): {e}")
+            # No backoff once the breaker has opened: the next attempt fails fast anyway
+            if attempt < retries - 1 and llm.available():
+                await asyncio.sleep(2 ** attempt)  # Exponential backoff
+
+    # Fallback response: no answer was generated, so nothing is billed for it
+    return FALLBACK_RESPONSE, 0
@@ -0,0 +1,457 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Deque, Dict, Optional, Set
+
+import httpx
+
+import backend.config as config
+
+logger = logging.getLogger(__name__)
+
+class TokenBucket:
+    """Allows `rate` sends per second with bursts of up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """Seconds until one token is available."""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self, now: float) -> None:
+        self._refill(now)
+        self.tokens -= 1
+
+    def full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+@dataclass
+class OutboxItem:
+    """A Bot API call waiting for its turn (pacing) or its retry."""
+    method: str
+    payload: Dict[str, Any]
+    chat_id: int
+    attempt: int = 0
+    not_before: float = 0.0
+    enqueued_at: float = field(default_factory=time.monotonic)
+    result: Any = None  # the Bot API "result" once the call succeeded
+    completed: Optional[asyncio.Future] = None  # resolved when a queued call is done (see deliver)
+
+class BotOutbox:
+    """Send scheduling state for one bot: its global bucket, per-chat buckets and queues."""
+
+    def __init__(self, rate: float, burst: float, chat_rate: float, chat_burst: float):
+        self.bucket = TokenBucket(rate, burst)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chat_buckets: Dict[int, TokenBucket] = {}
+        self.queues: Dict[int, Deque[OutboxItem]] = {}
+        self.sending: Set[int] = set()  # chats with a call in flight (keeps per-chat order)
+        self.throttled_until = 0.0
+        self.wakeup = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+        self.in_flight: Set[asyncio.Task] = set()
+
+    def depth(self) -> int:
+        return sum(len(queue) for queue in self.queues.values())
+
+    def bot_wait(self, now: float) -> float:
+        """Seconds until this bot may send anything (429 back-off, then the global bucket)."""
+        return max(self.throttled_until - now, self.bucket.wait_time(now), 0.0)
+
+    def chat_wait(self, chat_id: int, now: float) -> float:
+        bucket = self.chat_buckets.get(chat_id)
+        return bucket.wait_time(now) if bucket else 0.0
+
+    def consume(self, chat_id: int, now: float) -> None:
+        self.bucket.consume(now)
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        bucket.consume(now)
+
+    def prune(self, now: float) -> None:
+        """Forgets refilled chat buckets, which behave exactly like new ones."""
+        for chat_id in [c for c, b in self.chat_buckets.items() if c not in self.queues and b.full(now)]:
+            del self.chat_buckets[chat_id]
+
+class TelegramClient:
+    """Shared Telegram Bot API client.
+
+    All calls go through one pooled keep-alive httpx client, so sending a
+    reply reuses an open connection instead of a fresh TCP+TLS handshake.
+
+    Sends are paced to Telegram's limits before they are made: a token bucket
+    per bot (about 30 messages/s) and one per chat (about 1 message/s). A
+    message that fits goes out immediately from the calling worker; one that
+    would exceed a limit, or that needs a retry, waits in the bot's outbox and
+    is sent by a background scheduler as soon as both buckets allow it. A 429
+    still pauses that bot until retry_after. Workers never wait, and one busy
+    or throttled bot never stalls the others. Messages to the same chat keep
+    their order.
+    """
+
+    MAX_CHAT_BUCKETS = 10000  # per bot, before refilled ones are pruned
+
+    def __init__(self, base_url: str = "https://api.telegram.org", retries: int = 3,
+                 max_outbox: int = 1000, rate: float = 30.0, burst: float = 1.0,
+                 chat_rate: float = 1.0, chat_burst: float = 1.0):
+        self.base_url = base_url.rstrip('/')
+        self.retries = retries
+        self.max_outbox = max_outbox
+        self.rate = rate
+        self.burst = burst
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.sent = 0
+        self.paced = 0
+        self.rate_limited = 0
+        self.retried = 0
+        self.failed = 0
+        self.wait_times: Deque[float] = deque(maxlen=1000)  # seconds queued, for recent paced sends
+        self._http: Optional[httpx.AsyncClient] = None
+        self._bots: Dict[str, BotOutbox] = {}
+
+    def http(self) -> httpx.AsyncClient:
+        """Returns the shared async HTTP client, creating it on first use."""
+        if self._http is None or self._http.is_closed:
+            self._http = httpx.AsyncClient(
+                timeout=httpx.Timeout(config.HTTP_TIMEOUT),
+                limits=httpx.Limits(
+                    max_connections=config.HTTP_MAX_CONNECTIONS,
+                    max_keepalive_connections=config.HTTP_MAX_KEEPALIVE_CONNECTIONS
+                )
+            )
+        return self._http
+
+    async def call(self, token: str, method: str, payload: Optional[Dict[str, Any]] = None) -> httpx.Response:
+        """Calls one Bot API method once, without pacing or retries."""
+        return await self.http().post(f"{self.base_url}/bot{token}/{method}", json=payload or {})
+
+    def _bot(self, token: str) -> BotOutbox:
+        bot = self._bots.get(token)
+        if bot is None:
+            bot = self._bots[token] = BotOutbox(self.rate, self.burst, self.chat_rate, self.chat_burst)
+        return bot
+
+    def throttled_for(self, token: str) -> float:
+        """Seconds until Telegram accepts calls for this bot again (0 if not throttled)."""
+        bot = self._bots.get(token)
+        return max(bot.throttled_until - time.monotonic(), 0.0) if bot else 0.0
+
+    async def send_message(self, token: str, chat_id: int, text: str) -> bool:
+        """Sends a message now if the rate limits allow it, otherwise queues it.
+
+        Returns False only if Telegram rejected the message outright.
+        """
+        return await self._submit(token, OutboxItem('sendMessage', {
+            "chat_id": chat_id,
+            "text": text[:4096]  # Telegram message limit
+        }, chat_id))
+
+    async def edit_message(self, token: str, chat_id: int, message_id: int, text: str) -> bool:
+        """Replaces a sent message's text, paced and retried like send_message."""
+        return await self._submit(token, OutboxItem('editMessageText', {
+            "chat_id": chat_id,
+            "message_id": message_id,
+            "text": text[:4096]
+        }, chat_id))
+
+    async def deliver(self, token: str, item: OutboxItem) -> bool:
+        """Makes a call paced and retried like send_message, but waits until it is done."""
+        item.completed = asyncio.get_running_loop().create_future()
+        if not await self._submit(token, item):
+            return False
+        if item.result is not None:
+            return True
+        return await item.completed
+
+    async def try_call(self, token: str, item: OutboxItem) -> bool:
+        """Makes one attempt right away if the bot and chat have budget for it.
+
+        Never queues or retries; returns False if the call was not made or failed.
+        """
+        bot = self._bot(token)
+        if not self._can_send_now(bot, item.chat_id, time.monotonic()):
+            return False
+        return bool(await self._send_now(token, bot, item))
+
+    def stream(self, token: str, chat_id: int, edit_interval: float = 1.0) -> 'MessageStream':
+        """Starts a message that is edited in place as more text arrives."""
+        return MessageStream(self, token, chat_id, edit_interval)
+
+    def _can_send_now(self, bot: BotOutbox, chat_id: int, now: float) -> bool:
+        return not (chat_id in bot.queues or chat_id in bot.sending
+                    or bot.bot_wait(now) or bot.chat_wait(chat_id, now))
+
+    async def _send_now(self, token: str, bot: BotOutbox, item: OutboxItem) -> Optional[bool]:
+        bot.consume(item.chat_id, time.monotonic())
+        bot.sending.add(item.chat_id)
+        try:
+            result = await self._attempt(token, bot, item)
+        finally:
+            bot.sending.discard(item.chat_id)
+        if len(bot.chat_buckets) > self.MAX_CHAT_BUCKETS:
+            bot.prune(time.monotonic())
+        return result
+
+    async def _submit(self, token: str, item: OutboxItem) -> bool:
+        bot = self._bot(token)
+        if not self._can_send_now(bot, item.chat_id, time.monotonic()):
+            return self._enqueue(token, bot, item)
+        result = await self._send_now(token, bot, item)
+        if result is None:
+            # Ahead of anything queued for this chat while it was in flight
+            return self._enqueue(token, bot, item, retry=True)
+        return result
+
+    async def _attempt(self, token: str, bot: BotOutbox, item: OutboxItem) -> Optional[bool]:
+        """Makes one attempt. Returns True/False when done, None to retry later."""
+        item.attempt += 1
+        try:
+            response = await self.call(token, item.method, item.payload)
+        except httpx.HTTPError as e:
+            logger.error(f"Request error calling {item.method} (attempt {item.attempt}): {e}")
+            return self._backoff(item)
+
+        if response.status_code == 200:
+            self.sent += 1
+            item.result = response.json().get('result')
+            logger.info(f"Successfully called {item.method} for chat_id {item.chat_id}")
+            return True
+        if response.status_code == 429:  # Rate limit, applies to the whole bot
+            self.rate_limited += 1
+            retry_after = self._retry_after(response)
+            bot.throttled_until = max(bot.throttled_until, time.monotonic() + retry_after)
+            logger.warning(f"Rate limited for bot {token[:10]}..., pausing its messages {retry_after} seconds")
+            return self._backoff(item, delay=0.0)
+        logger.error(f"Telegram API error: {response.status_code} - {response.text}")
+        if response.status_code >= 500:
+            return self._backoff(item)
+        # 4xx: bad request, bot blocked by the user, ... retrying won't help
+        self.failed += 1
+        return False
+
+    def _backoff(self, item: OutboxItem, delay: Optional[float] = None) -> Optional[bool]:
+        if item.attempt >= self.retries:
+            self.failed += 1
+            logger.error(f"Failed to send message after {item.attempt} attempts")
+            return False
+        item.not_before = time.monotonic() + (2 ** (item.attempt - 1) if delay is None else delay)
+        return None
+
+    @staticmethod
+    def _retry_after(response: httpx.Response) -> float:
+        try:
+            return float(response.json()['parameters']['retry_after'])
+        except (ValueError, KeyError, TypeError):
+            return float(response.headers.get('Retry-After', 1))
+
+    def _enqueue(self, token: str, bot: BotOutbox, item: OutboxItem, retry: bool = False) -> bool:
+        if bot.depth() >= self.max_outbox:
+            self.failed += 1
+            logger.error(f"Outbox full for bot {token[:10]}..., dropping message")
+            return False
+        queue = bot.queues.setdefault(item.chat_id, deque())
+        if retry:
+            queue.appendleft(item)
+        else:
+            queue.append(item)
+        bot.wakeup.set()
+        if bot.task is None:
+            bot.task = asyncio.create_task(self._schedule(token, bot))
+        return True
+
+    async def _schedule(self, token: str, bot: BotOutbox) -> None:
+        """Sends a bot's queued messages as soon as its buckets allow, oldest-ready chat first."""
+        try:
+            while bot.queues:
+                now = time.monotonic()
+                chat_id, ready_at = None, float('inf')
+                for candidate, queue in bot.queues.items():
+                    if candidate in bot.sending:
+                        continue
+                    at = max(queue[0].not_before, now + bot.chat_wait(candidate, now))
+                    if at < ready_at:
+                        chat_id, ready_at = candidate, at
+                if chat_id is not None:
+                    ready_at = max(ready_at, now + bot.bot_wait(now))
+                if chat_id is None or ready_at > now:
+                    bot.wakeup.clear()
+                    timeout = None if chat_id is None else ready_at - now
+                    try:
+                        await asyncio.wait_for(bot.wakeup.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+                bot.consume(chat_id, now)
+                bot.sending.add(chat_id)
+                task = asyncio.create_task(self._send_queued(token, bot, bot.queues[chat_id][0]))
+                bot.in_flight.add(task)
+                task.add_done_callback(bot.in_flight.discard)
+            bot.prune(time.monotonic())
+        finally:
+            bot.task = None
+
+    async def _send_queued(self, token: str, bot: BotOutbox, item: OutboxItem) -> None:
+        if item.attempt == 0:
+            self.paced += 1
+            self.wait_times.append(time.monotonic() - item.enqueued_at)
+        else:
+            self.retried += 1
+        try:
+            result = await self._attempt(token, bot, item)
+        except Exception as e:
+            logger.error(f"Unexpected error sending queued message: {e}")
+            result = False
+        finally:
+            bot.sending.discard(item.chat_id)
+        if result is not None:
+            queue = bot.queues[item.chat_id]
+            queue.popleft()
+            if not queue:
+                del bot.queues[item.chat_id]
+            if item.completed and not item.completed.done():
+                item.completed.set_result(result)
+        bot.wakeup.set()
+
+    async def close(self, timeout: float = 5.0) -> None:
+        """Gives queued messages up to timeout seconds, then closes the connection pool."""
+        tasks = [bot.task for bot in self._bots.values() if bot.task]
+        if tasks:
+            await asyncio.wait(tasks, timeout=timeout)
+        pending = [task for bot in self._bots.values() for task in (bot.task, *bot.in_flight) if task]
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        dropped = 0
+        for bot in self._bots.values():
+            for queue in bot.queues.values():
+                dropped += len(queue)
+                for item in queue:
+                    if item.completed and not item.completed.done():
+                        item.completed.set_result(False)
+        if dropped:
+            logger.warning(f"Dropped {dropped} queued Telegram messages on shutdown")
+        self._bots.clear()
+        if self._http is not None and not self._http.is_closed:
+            await self._http.aclose()
+        self._http = None
+
+    def stats(self) -> Dict[str, Any]:
+        """Client counters for the /metrics endpoint."""
+        waits = sorted(self.wait_times)
+        depths = [bot.depth() for bot in self._bots.values()]
+        return {
+            'sent': self.sent,
+            'paced': self.paced,
+            'rate_limited': self.rate_limited,
+            'retried': self.retried,
+            'failed': self.failed,
+            'queue_depth': sum(depths),
+            'max_bot_queue_depth': max(depths, default=0),
+            'wait_ms_p50': round(waits[len(waits) // 2] * 1000, 1) if waits else 0.0,
+            'wait_ms_p95': round(waits[int(len(waits) * 0.95)] * 1000, 1) if waits else 0.0,
+            'wait_ms_max': round(waits[-1] * 1000, 1) if waits else 0.0,
+            'throttled_bots': sum(1 for token in self._bots if self.throttled_for(token))
+        }
+
+class MessageStream:
+    """Shows a growing answer as a single Telegram message.
+
+    The first text is sent with sendMessage (paced like any message) and
+    later text replaces it with editMessageText, at most once per
+    edit_interval and only when the bot and chat have budget; intermediate
+    versions are skipped, never queued. update() never blocks the caller.
+    finish() delivers the complete text reliably (queued and retried),
+    falling back to a normal message if the first send failed.
+    """
+
+    def __init__(self, client: TelegramClient, token: str, chat_id: int, edit_interval: float = 1.0):
+        self.client = client
+        self.token = token
+        self.chat_id = chat_id
+        self.edit_interval = edit_interval
+        self.message_id: Optional[int] = None
+        self.shown = ""
+        self.edits = 0
+        self._latest = ""
+        self._changed = asyncio.Event()
+        self._in_call = False
+        self._done = False
+        self._task: Optional[asyncio.Task] = None
+
+    def update(self, text: str) -> None:
+        """Records the text generated so far; it is shown on the next allowed edit."""
+        self._latest = text[:4096]
+        self._changed.set()
+        if self._task is None and not self._done:
+            self._task = asyncio.create_task(self._pump())
+
+    async def _pump(self) -> None:
+        while not self._done:
+            await self._changed.wait()
+            self._changed.clear()
+            text = self._latest
+            self._in_call = True
+            try:
+                if self.message_id is None:
+                    # The first message is worth waiting for; it is what makes the answer visible
+                    item = OutboxItem('sendMessage', {"chat_id": self.chat_id, "text": text}, self.chat_id)
+                    sent = await self.client.deliver(self.token, item)
+                else:
+                    item = OutboxItem('editMessageText', {
+                        "chat_id": self.chat_id, "message_id": self.message_id, "text": text
+                    }, self.chat_id)
+                    sent = await self.client.try_call(self.token, item)
+            finally:
+                self._in_call = False
+            if sent:
+                if self.message_id is None:
+                    self.message_id = item.result.get('message_id') if item.result else None
+                else:
+                    self.edits += 1
+                self.shown = text
+            elif self.message_id is None:
+                return  # no first message; finish() sends the whole answer instead
+            if self._done:
+                return
+            await asyncio.sleep(self.edit_interval)
+
+    def cancel(self) -> None:
+        """Stops further edits (the message shows whatever was last sent)."""
+        self._done = True
+        if self._task is not None and not self._in_call:
+            self._task.cancel()
+
+    async def finish(self, text: str) -> bool:
+        """Shows the complete text, waiting for a first send that is still in flight."""
+        self.cancel()
+        if self._task is not None:
+            await asyncio.gather(self._task, return_exceptions=True)
+        if self.message_id is None:
+            return await self.client.send_message(self.token, self.chat_id, text)
+        if text[:4096] == self.shown:
+            return True
+        return await self.client.edit_message(self.token, self.chat_id, self.message_id, text)
+
+telegram = TelegramClient(
+    base_url=config.TELEGRAM_API_URL,
+    rate=config.TELEGRAM_BOT_RATE,
+    burst=config.TELEGRAM_BOT_BURST,
+    chat_rate=config.TELEGRAM_CHAT_RATE,
+    chat_burst=config.TELEGRAM_CHAT_BURST
+)
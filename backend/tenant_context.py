@@ -0,0 +1,137 @@
+import logging
+import time
+from dataclasses import dataclass, field
+from functools import cached_property
+from typing import Any, Dict, List, Optional, Tuple
+
+from supabase import PostgrestAPIError
+
+import backend.config as config
+from backend.cache import TTLCache, MISSING
+from backend.database import get_async_supabase
+from backend.retrieval import documents_fingerprint
+
+logger = logging.getLogger(__name__)
+
+# Columns embedded under the company so one PostgREST request returns everything
+# the pipeline needs: the company, its active subscription with the plan, and the KB rows.
+COMPANY_EMBED = (
+    '*, '
+    'subscriptions(*, plans(*)), '
+    'knowledge_bases(id, title, content, updated_at)'
+)
+
+@dataclass
+class TenantContext:
+    """Everything needed to answer a message for one bot, resolved in a single lookup."""
+    bot_token: str
+    company: Dict[str, Any]
+    subscription: Optional[Dict[str, Any]] = None
+    knowledge_documents: List[Dict[str, Any]] = field(default_factory=list)
+    bot_id: Optional[str] = None
+    bot_name: Optional[str] = None
+    loaded_at: float = field(default_factory=time.time)
+
+    @property
+    def company_id(self) -> str:
+        return self.company['id']
+
+    @property
+    def plan(self) -> Optional[Dict[str, Any]]:
+        return self.subscription.get('plans') if self.subscription else None
+
+    @cached_property
+    def kb_version(self) -> Tuple:
+        """Identity of this version of the KB rows; answers cached against it go stale with it."""
+        return documents_fingerprint(self.knowledge_documents)
+
+    @property
+    def knowledge_base(self) -> str:
+        """The company's knowledge base rows concatenated, as the prompt expects."""
+        return " ".join([doc['content'] for doc in self.knowledge_documents if doc.get('content')])
+
+# Bot token -> TenantContext. Kept short-lived because subscriptions and KB rows are
+# edited from the dashboard; /api/cache/invalidate drops entries as soon as they change.
+# Unknown tokens are cached as None for a shorter time, which also absorbs token probing.
+tenant_cache = TTLCache(
+    max_size=config.TENANT_CACHE_MAX_SIZE,
+    ttl=config.TENANT_CACHE_TTL,
+    negative_ttl=config.TENANT_CACHE_NEGATIVE_TTL
+)
+
+def _build_context(token: str, company: Dict[str, Any], bot_id: Optional[str] = None,
+                   bot_name: Optional[str] = None) -> TenantContext:
+    """Splits an embedded company row into a TenantContext."""
+    company = dict(company)
+    subscriptions = company.pop('subscriptions', None) or []
+    documents = company.pop('knowledge_bases', None) or []
+    active = [s for s in subscriptions if s.get('is_active')]
+    return TenantContext(
+        bot_token=token,
+        company=company,
+        subscription=active[0] if active else None,
+        knowledge_documents=documents,
+        bot_id=bot_id,
+        bot_name=bot_name
+    )
+
+async def _fetch_tenant_context(token: str) -> Optional[TenantContext]:
+    """Resolves the tenant with one embedded select (plus a legacy fallback for unknown bots)."""
+    supabase = await get_async_supabase()
+    response = await supabase.table('bots') \
+        .select(f'id, name, companies({COMPANY_EMBED})') \
+        .eq('token', token) \
+        .eq('companies.subscriptions.is_active', True) \
+        .limit(1) \
+        .execute()
+
+    if response.data and response.data[0].get('companies'):
+        row = response.data[0]
+        return _build_context(token, row['companies'], bot_id=row['id'], bot_name=row.get('name'))
+
+    # Fallback to old method for backward compatibility
+    logger.warning(f"Bot not found in bots table, checking companies.telegram_bot_token")
+    response = await supabase.table('companies') \
+        .select(COMPANY_EMBED) \
+        .eq('telegram_bot_token', token) \
+        .eq('subscriptions.is_active', True) \
+        .limit(1) \
+        .execute()
+    if response.data:
+        return _build_context(token, response.data[0])
+    return None
+
+async def get_tenant_context(token: str) -> Optional[TenantContext]:
+    """Returns the cached TenantContext for a bot token, loading it on a miss."""
+    cached = tenant_cache.get(token)
+    if cached is not MISSING:
+        return cached
+
+    try:
+        context = await _fetch_tenant_context(token)
+        tenant_cache.set(token, context)
+        return context
+    except PostgrestAPIError as e:
+        logger.error(f"Database error resolving tenant context: {e}")
+        return None
+    except Exception as e:
+        logger.error(f"Unexpected error resolving tenant context: {e}")
+        return None
+
+def invalidate_tenant(token: Optional[str] = None, company_id: Optional[str] = None) -> int:
+    """Drops cached contexts for a bot token, for every bot of a company, or all of them.
+
+    Returns the number of entries dropped.
+    """
+    if token is not None:
+        return int(tenant_cache.invalidate(token))
+    if company_id is None:
+        dropped = len(tenant_cache)
+        tenant_cache.clear()
+        return dropped
+
+    dropped = 0
+    for key, context in tenant_cache.items():
+        if context is not None and context.company_id == company_id:
+            dropped += int(tenant_cache.invalidate(key))
+    return dropped
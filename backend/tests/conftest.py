@@ -0,0 +1,10 @@
+import os
+
+# backend.config requires these at import time; the tests never reach the real services
+os.environ.setdefault("GOOGLE_API_KEY", "test")
+os.environ.setdefault("TELEGRAM_WEBHOOK_SECRET", "test")
+os.environ.setdefault("SUPABASE_URL", "https://test.supabase.co")
+os.environ.setdefault("SUPABASE_KEY", "eyJhbGciOiJIUzI1NiJ9.e30.test")
+os.environ.setdefault("LLM_PROVIDER", "stub")
+os.environ.setdefault("USAGE_COUNTER_BACKEND", "memory")
+os.environ.setdefault("BULKHEAD_ENABLED", "false")
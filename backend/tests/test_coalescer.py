@@ -0,0 +1,94 @@
+import asyncio
+
+import pytest
+
+from backend.coalescer import CoalescedResult, RequestCoalescer
+
+KEY = ("company-1", "what is your return policy", 1, "full")
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+def generation(tokens, started=None, release=None):
+    """A generate callback that streams one chunk and uses `tokens`."""
+    async def generate(publish):
+        if started is not None:
+            started.append(True)
+        publish("30 days")
+        if release is not None:
+            await release.wait()
+        return "30 days with the receipt", tokens
+    return generate
+
+async def coalesce(coalescer, requests, tokens=300):
+    """Runs `requests` identical requests together; returns their results, the leader's first."""
+    started, release = [], asyncio.Event()
+    tasks = [asyncio.ensure_future(coalescer.run(KEY, generation(tokens, started, release)))
+             for _ in range(requests)]
+    await asyncio.sleep(0)
+    release.set()
+    return await asyncio.gather(*tasks), len(started)
+
+def test_identical_requests_share_one_generation():
+    async def scenario():
+        coalescer = RequestCoalescer()
+        results, generations = await coalesce(coalescer, 3)
+        assert generations == 1
+        assert [result.leader for result in results] == [True, False, False]
+        assert all(result.participants == 3 and result.text == "30 days with the receipt" for result in results)
+        assert coalescer.stats()['tokens_saved'] == 600
+        assert coalescer.stats()['in_flight'] == 0
+    run(scenario())
+
+def test_followers_get_the_text_streamed_so_far():
+    async def scenario():
+        coalescer = RequestCoalescer()
+        release = asyncio.Event()
+        leader = asyncio.ensure_future(coalescer.run(KEY, generation(100, release=release)))
+        await asyncio.sleep(0)
+        seen = []
+        follower = asyncio.ensure_future(coalescer.run(KEY, generation(100), on_text=seen.append))
+        await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(leader, follower)
+        assert seen == ["30 days"]
+    run(scenario())
+
+@pytest.mark.parametrize("billing, leader_tokens, follower_tokens", [
+    ("each", 300, 300),
+    ("leader", 300, 0),
+    ("split", 100, 100),
+])
+def test_billing_policies(billing, leader_tokens, follower_tokens):
+    async def scenario():
+        coalescer = RequestCoalescer(billing=billing)
+        results, _ = await coalesce(coalescer, 3)
+        assert [coalescer.billed_tokens(result, reserved=500) for result in results] == \
+            [leader_tokens, follower_tokens, follower_tokens]
+    run(scenario())
+
+def test_follower_is_never_charged_more_than_it_reserved():
+    coalescer = RequestCoalescer(billing="each")
+    assert coalescer.billed_tokens(CoalescedResult("answer", 300, 2, leader=False), reserved=120) == 120
+    assert coalescer.billed_tokens(CoalescedResult("answer", 300, 2, leader=True), reserved=120) == 300
+    assert RequestCoalescer(billing="split").billed_tokens(
+        CoalescedResult("answer", 301, 2, leader=False), reserved=500) == 151
+
+def test_cancelled_follower_does_not_share_the_cost():
+    async def scenario():
+        coalescer = RequestCoalescer(billing="split")
+        release = asyncio.Event()
+        leader = asyncio.ensure_future(coalescer.run(KEY, generation(300, release=release)))
+        follower = asyncio.ensure_future(coalescer.run(KEY, generation(300)))
+        await asyncio.sleep(0)
+        follower.cancel()
+        await asyncio.gather(follower, return_exceptions=True)
+        release.set()
+        result = await leader
+        assert result.participants == 1
+        assert coalescer.billed_tokens(result, reserved=500) == 300
+    run(scenario())
+
+def test_unknown_billing_policy_is_rejected():
+    with pytest.raises(ValueError):
+        RequestCoalescer(billing="free")
@@ -0,0 +1,143 @@
+import asyncio
+
+import fakeredis.aioredis
+import pytest
+
+from backend.job_queue import InMemoryJobQueue, RedisJobQueue, WorkerPool
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+def in_memory_queue(max_size=100):
+    return InMemoryJobQueue(max_size=max_size)
+
+def redis_queue(max_size=100):
+    return RedisJobQueue(fakeredis.aioredis.FakeRedis(), max_size=max_size, poll_interval=0.01)
+
+QUEUES = [in_memory_queue, redis_queue]
+
+async def drain(queue):
+    order = []
+    while True:
+        item = await queue.get(timeout=0.05)
+        if item is None:
+            return order
+        tenant_key, job = item
+        order.append((tenant_key, job['n']))
+
+@pytest.mark.parametrize("make_queue", QUEUES)
+def test_jobs_of_one_tenant_come_out_in_order(make_queue):
+    async def scenario():
+        queue = make_queue()
+        for n in range(3):
+            assert await queue.put("bot-a", {'n': n})
+        assert await queue.size() == 3
+        assert await queue.tenant_size("bot-a") == 3
+        assert await drain(queue) == [("bot-a", 0), ("bot-a", 1), ("bot-a", 2)]
+        assert await queue.size() == 0
+    run(scenario())
+
+@pytest.mark.parametrize("make_queue", QUEUES)
+def test_tenants_are_served_round_robin(make_queue):
+    async def scenario():
+        queue = make_queue()
+        for n in range(4):
+            await queue.put("busy", {'n': n})
+        await queue.put("quiet", {'n': 0})
+        order = await drain(queue)
+        # The quiet tenant does not wait behind the busy tenant's backlog
+        assert order[:2] == [("busy", 0), ("quiet", 0)]
+        assert [n for tenant, n in order if tenant == "busy"] == [0, 1, 2, 3]
+    run(scenario())
+
+@pytest.mark.parametrize("make_queue", QUEUES)
+def test_weight_is_jobs_per_turn(make_queue):
+    async def scenario():
+        queue = make_queue()
+        for n in range(4):
+            await queue.put("pro", {'n': n}, weight=2)
+            await queue.put("free", {'n': n}, weight=1)
+        tenants = [tenant for tenant, _ in await drain(queue)]
+        assert tenants[:6] == ["pro", "pro", "free", "pro", "pro", "free"]
+    run(scenario())
+
+@pytest.mark.parametrize("make_queue", QUEUES)
+def test_skipped_tenants_are_passed_over(make_queue):
+    async def scenario():
+        queue = make_queue()
+        await queue.put("saturated", {'n': 0})
+        await queue.put("other", {'n': 1})
+        assert await queue.get(timeout=0.05, skip={"saturated"}) == ("other", {'n': 1})
+        assert await queue.get(timeout=0.05, skip={"saturated"}) is None
+        assert await queue.get(timeout=0.05) == ("saturated", {'n': 0})
+    run(scenario())
+
+@pytest.mark.parametrize("make_queue", QUEUES)
+def test_put_refuses_jobs_when_full(make_queue):
+    async def scenario():
+        queue = make_queue(max_size=2)
+        assert await queue.put("bot", {'n': 0})
+        assert await queue.put("bot", {'n': 1})
+        assert not await queue.put("bot", {'n': 2})
+        assert await queue.size() == 2
+    run(scenario())
+
+def test_get_waits_for_a_job():
+    async def scenario():
+        queue = in_memory_queue()
+        getter = asyncio.create_task(queue.get(timeout=1.0))
+        await asyncio.sleep(0.01)
+        await queue.put("bot", {'n': 0})
+        assert await getter == ("bot", {'n': 0})
+    run(scenario())
+
+def test_worker_pool_processes_every_job_before_stopping():
+    async def scenario():
+        handled = []
+
+        async def handler(job):
+            await asyncio.sleep(0.01)
+            handled.append(job['n'])
+
+        pool = WorkerPool(in_memory_queue(), handler, concurrency=4)
+        pool.start()
+        for n in range(20):
+            assert await pool.submit(f"bot-{n % 3}", {'n': n})
+        await pool.stop(timeout=5)
+        assert sorted(handled) == list(range(20))
+        assert pool.processed == 20
+        assert not await pool.submit("bot-0", {'n': 20})
+    run(scenario())
+
+def test_worker_pool_runs_jobs_concurrently():
+    async def scenario():
+        running, peak = 0, 0
+
+        async def handler(job):
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.05)
+            running -= 1
+
+        pool = WorkerPool(in_memory_queue(), handler, concurrency=5)
+        pool.start()
+        for n in range(10):
+            await pool.submit("bot", {'n': n})
+        await pool.stop(timeout=5)
+        assert peak == 5
+    run(scenario())
+
+def test_worker_pool_survives_failing_jobs():
+    async def scenario():
+        async def handler(job):
+            if job['n'] == 1:
+                raise RuntimeError("boom")
+
+        pool = WorkerPool(in_memory_queue(), handler, concurrency=2)
+        pool.start()
+        for n in range(3):
+            await pool.submit("bot", {'n': n})
+        await pool.stop(timeout=5)
+        assert (pool.processed, pool.failed) == (2, 1)
+    run(scenario())
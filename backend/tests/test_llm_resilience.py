@@ -0,0 +1,107 @@
+import asyncio
+
+import pytest
+
+from backend.llm_provider import StubProvider
+from backend.llm_resilience import CircuitBreaker, CircuitOpenError, ResilientProvider
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+class FlakyProvider(StubProvider):
+    """A stub that raises while `failing` is set."""
+
+    def __init__(self, **kwargs):
+        super().__init__(latency=0.0, **kwargs)
+        self.failing = False
+
+    async def generate(self, prompt, max_output_tokens=None, cached_prefix=None):
+        if self.failing:
+            raise ConnectionError("provider unavailable")
+        return await super().generate(prompt, max_output_tokens=max_output_tokens, cached_prefix=cached_prefix)
+
+def breaker(**kwargs):
+    return CircuitBreaker(**{'failure_rate': 0.5, 'window': 4, 'min_calls': 4, 'open_seconds': 0.05, **kwargs})
+
+def test_circuit_opens_once_the_error_rate_is_reached():
+    circuit = breaker()
+    for success in (True, False, True):
+        assert circuit.allow()
+        circuit.record(success)
+    assert circuit.state == CircuitBreaker.CLOSED  # fewer than min_calls so far
+    circuit.record(False)
+    assert circuit.state == CircuitBreaker.OPEN
+    assert not circuit.allow() and not circuit.available
+    assert circuit.stats()['rejected'] == 1 and circuit.stats()['opened'] == 1
+
+def test_half_open_lets_one_probe_through_and_closes_on_success():
+    async def scenario():
+        circuit = breaker(min_calls=1, window=1)
+        circuit.record(False)
+        assert circuit.state == CircuitBreaker.OPEN
+        await asyncio.sleep(0.06)
+        assert circuit.available
+        assert circuit.allow()
+        assert circuit.state == CircuitBreaker.HALF_OPEN
+        assert not circuit.allow()  # the probe is still in flight
+        circuit.record(True)
+        assert circuit.state == CircuitBreaker.CLOSED
+        assert circuit.stats()['half_opened'] == 1 and circuit.stats()['closed'] == 1
+    run(scenario())
+
+def test_failed_probe_opens_the_circuit_again():
+    async def scenario():
+        circuit = breaker(min_calls=1, window=1)
+        circuit.record(False)
+        await asyncio.sleep(0.06)
+        assert circuit.allow()
+        circuit.record(False)
+        assert circuit.state == CircuitBreaker.OPEN
+        assert circuit.stats()['opened'] == 2
+    run(scenario())
+
+def test_cancelled_probe_frees_the_half_open_slot():
+    async def scenario():
+        circuit = breaker(min_calls=1, window=1)
+        circuit.record(False)
+        await asyncio.sleep(0.06)
+        assert circuit.allow()
+        circuit.cancel()
+        assert circuit.allow()
+    run(scenario())
+
+def test_provider_fails_fast_while_the_circuit_is_open():
+    async def scenario():
+        inner = FlakyProvider()
+        provider = ResilientProvider(inner, breaker())
+        inner.failing = True
+        for _ in range(4):
+            with pytest.raises(ConnectionError):
+                await provider.generate("question")
+        with pytest.raises(CircuitOpenError):
+            await provider.generate("question")
+        assert not provider.available()
+
+        inner.failing = False
+        await asyncio.sleep(0.06)
+        assert (await provider.generate("question")).text
+        assert provider.stats()['circuit']['state'] == CircuitBreaker.CLOSED
+    run(scenario())
+
+def test_slow_call_times_out_and_counts_as_a_failure():
+    async def scenario():
+        provider = ResilientProvider(StubProvider(latency=1.0), breaker(min_calls=1, window=1), timeout=0.01)
+        with pytest.raises(asyncio.TimeoutError):
+            await provider.generate("question")
+        assert provider.stats()['timeouts'] == 1
+        assert provider.breaker.state == CircuitBreaker.OPEN
+    run(scenario())
+
+def test_stream_outcome_is_recorded_by_the_breaker():
+    async def scenario():
+        provider = ResilientProvider(StubProvider(latency=0.0), breaker())
+        stream = provider.stream("question")
+        text = "".join([piece async for piece in stream])
+        assert text and stream.total_tokens
+        assert provider.breaker.successes == 1
+    run(scenario())
@@ -0,0 +1,38 @@
+import pytest
+
+from backend.llm_provider import StubProvider
+from backend.model_router import ModelRouter, allowed_tiers
+
+QUESTION = "What is the shipping time to Dubai?"
+
+def plan(*tiers):
+    return {'features': {'model_tiers': list(tiers)}}
+
+def test_messages_are_classified_by_tier():
+    router = ModelRouter(small_provider=StubProvider())
+    assert router.route("thanks a lot!").tier == 'template'
+    assert router.route(QUESTION).tier == 'small'
+    assert router.route("Why was my order damaged?").tier == 'full'
+
+def test_plan_without_small_model_tier_uses_the_full_model():
+    router = ModelRouter(small_provider=StubProvider())
+    decision = router.route(QUESTION, plan("template", "full"))
+    assert decision.tier == 'full' and decision.restricted
+    assert router.stats()['restricted_by_plan'] == 1
+
+@pytest.mark.parametrize("small_provider", [None, StubProvider()])
+def test_question_is_never_answered_with_a_template(small_provider):
+    router = ModelRouter(small_provider=small_provider)
+    decision = router.route(QUESTION, plan("template", "small"))
+    assert decision.tier == ('small' if small_provider else 'full')
+    assert router.route("Why was my order damaged?", plan("template", "small")).tier != 'template'
+    assert router.route("hello", plan("template", "small")).tier == 'template'
+
+def test_template_only_plan_still_answers_questions_with_a_model():
+    router = ModelRouter()
+    assert router.route(QUESTION, plan("template")).tier == 'full'
+    assert router.route("hi there", plan("template")).tier == 'template'
+
+def test_unknown_tiers_fall_back_to_every_tier():
+    assert allowed_tiers(plan("gigantic")) == ("template", "small", "full")
+    assert allowed_tiers(None) == ("template", "small", "full")
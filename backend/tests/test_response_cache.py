@@ -0,0 +1,58 @@
+from backend.response_cache import ResponseCache, question_guards, question_terms
+
+COMPANY = "company-1"
+
+def test_question_terms_ignore_fillers_and_plurals():
+    assert question_terms("What's your return policy?") == question_terms("return policies, please")
+
+def test_question_guards_keep_negations_and_numbers():
+    assert question_guards("I don’t want order 12345 today") == frozenset({"don't", "12345"})
+    assert question_guards("What is the shipping time to Dubai") == frozenset()
+
+def test_exact_repeat_is_a_hit():
+    cache = ResponseCache()
+    cache.set(COMPANY, 1, "What is your return policy?", "30 days")
+    assert cache.get(COMPANY, 1, "what is your RETURN policy") == "30 days"
+    assert cache.stats()['exact_hits'] == 1
+
+def test_paraphrase_is_a_near_duplicate_hit():
+    cache = ResponseCache()
+    cache.set(COMPANY, 1, "What is your return policy?", "30 days")
+    assert cache.get(COMPANY, 1, "Could you tell me the return policies?") == "30 days"
+    assert cache.stats()['similar_hits'] == 1
+
+def test_negation_is_not_a_near_duplicate():
+    cache = ResponseCache()
+    cache.set(COMPANY, 1, "I want to cancel my order number 12345 today", "Order cancelled")
+    assert cache.get(COMPANY, 1, "I don't want to cancel my order number 12345 today") is None
+    cache.set(COMPANY, 1, "I don't want to cancel my order number 12345 today", "Order kept")
+    assert cache.get(COMPANY, 1, "I want to cancel my order number 12345 today please") == "Order cancelled"
+
+def test_different_number_is_not_a_near_duplicate():
+    cache = ResponseCache()
+    cache.set(COMPANY, 1, "Where is my order number 12345 now", "Shipped")
+    assert cache.get(COMPANY, 1, "Where is my order number 12346 now") is None
+    assert cache.get(COMPANY, 1, "Where is my order number now") is None
+
+def test_added_qualifier_is_not_a_near_duplicate():
+    cache = ResponseCache()
+    cache.set(COMPANY, 1, "What is the shipping time to Dubai", "5-7 days by standard shipping")
+    assert cache.get(COMPANY, 1, "What is the shipping time to Dubai for express") is None
+    assert cache.stats()['misses'] == 1
+
+def test_other_company_and_kb_version_miss():
+    cache = ResponseCache()
+    cache.set(COMPANY, 1, "What is your return policy?", "30 days")
+    assert cache.get("company-2", 1, "What is your return policy?") is None
+    assert cache.get(COMPANY, 2, "What is your return policy?") is None
+    assert len(cache) == 0
+
+def test_least_recently_used_entry_is_evicted():
+    cache = ResponseCache(max_size=2)
+    cache.set(COMPANY, 1, "return policy", "30 days")
+    cache.set(COMPANY, 1, "shipping to London", "3 days")
+    cache.get(COMPANY, 1, "return policy")
+    cache.set(COMPANY, 1, "support phone number", "555")
+    assert cache.get(COMPANY, 1, "shipping to London") is None
+    assert cache.get(COMPANY, 1, "return policy") == "30 days"
+    assert cache.stats()['evictions'] == 1
@@ -0,0 +1,58 @@
+import pytest
+
+from backend.retrieval import HashingEmbeddingBackend, KnowledgeIndex, RetrievalEngine, chunk_text, tokenize
+
+DOCUMENTS = [
+    {'id': 1, 'content': "UrbanStep sells leather shoes and sneakers. Call support on 555-0100."},
+    {'id': 2, 'content': "Shipping to London takes 3 days. Shipping to Dubai takes 7 days."},
+    {'id': 3, 'content': "Returns are accepted within 30 days with the receipt."},
+]
+
+def test_tokenize_drops_stopwords_and_plurals():
+    assert tokenize("What are the shipping times to London?") == ["shipping", "time", "london"]
+
+def test_chunks_keep_whole_sentences_with_overlap():
+    text = " ".join(f"Sentence number {n} is here." for n in range(20))
+    chunks = chunk_text(text, max_chars=120, overlap=40)
+    assert len(chunks) > 1 and all(len(chunk) <= 120 for chunk in chunks)
+    assert all(chunk.endswith(".") for chunk in chunks)
+    # The last sentence of a chunk starts the next one
+    assert chunks[1].startswith(chunks[0].split(". ")[-1].rstrip("."))
+
+def test_paragraphs_start_new_chunks():
+    assert chunk_text("First paragraph.\n\nSecond paragraph.") == ["First paragraph.", "Second paragraph."]
+
+@pytest.mark.parametrize("embeddings", [None, HashingEmbeddingBackend()])
+def test_search_finds_the_relevant_document(embeddings):
+    index = KnowledgeIndex(embeddings)
+    index.sync(DOCUMENTS)
+    assert index.search("how many days is shipping to Dubai", 1)[0].doc_id == "2"
+    assert index.search("can I return shoes", 1)[0].doc_id == "3"
+
+def test_only_changed_documents_are_rechunked():
+    index = KnowledgeIndex()
+    assert index.sync(DOCUMENTS) == {'updated': 3, 'removed': 0}
+    changed = [DOCUMENTS[0], {'id': 2, 'content': "Shipping to Paris takes 2 days."}]
+    assert index.sync(changed) == {'updated': 1, 'removed': 1}
+    assert index.chunked == 4
+    assert index.search("Paris", 1)[0].doc_id == "2"
+    assert not index.search("Dubai", 1)
+    assert "returns" not in index.bm25.postings and "return" not in index.bm25.postings
+
+def test_retrieve_falls_back_to_the_first_chunks_in_document_order():
+    engine = RetrievalEngine(top_k=2)
+    excerpt = engine.retrieve("company-1", DOCUMENTS, "Dubai or returns?")
+    assert excerpt.index("Dubai") < excerpt.index("Returns")
+    assert engine.retrieve("company-1", DOCUMENTS, "xylophone").startswith("UrbanStep")
+    assert engine.stats()['builds'] == 1
+
+def test_apply_changes_updates_an_existing_index():
+    engine = RetrievalEngine(top_k=1)
+    assert engine.apply_changes("company-1", upserts=DOCUMENTS) == 0  # no index yet
+    engine.get_index("company-1", DOCUMENTS)
+    applied = engine.apply_changes("company-1", upserts=[{'id': 3, 'content': "Refunds take 5 days."}],
+                                   deleted_ids=["1"])
+    assert applied == 2
+    assert engine.indexed_document_ids("company-1") == ["2", "3"]
+    assert "Refunds" in engine.retrieve("company-1", DOCUMENTS[1:2] + [{'id': 3, 'content': "Refunds take 5 days."}],
+                                        "refund")
@@ -0,0 +1,87 @@
+import asyncio
+
+import fakeredis
+import fakeredis.aioredis
+import pytest
+
+from backend.job_queue import ACCEPTED, DUPLICATE, REJECTED, InMemoryJobQueue, WorkerPool
+from backend.update_dedup import InMemoryUpdateDeduplicator, RedisUpdateDeduplicator, update_key
+
+TOKEN = "123456:bot-token"
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+def in_memory_dedup(redis=None):
+    return InMemoryUpdateDeduplicator(max_size=100)
+
+def redis_dedup(redis=None):
+    return RedisUpdateDeduplicator(redis or fakeredis.aioredis.FakeRedis())
+
+DEDUPLICATORS = [in_memory_dedup, redis_dedup]
+
+def test_update_key_does_not_contain_the_token():
+    key = update_key(TOKEN, 42)
+    assert TOKEN not in key and key.endswith(":42")
+    assert key != update_key("654321:other-bot", 42)
+
+@pytest.mark.parametrize("make_dedup", DEDUPLICATORS)
+def test_redelivered_update_is_a_duplicate(make_dedup):
+    async def scenario():
+        dedup = make_dedup()
+        assert await dedup.first_seen(TOKEN, 1)
+        assert not await dedup.first_seen(TOKEN, 1)
+        assert await dedup.first_seen(TOKEN, 2)
+        assert await dedup.first_seen("654321:other-bot", 1)
+        assert dedup.stats()['duplicates'] == 1
+    run(scenario())
+
+@pytest.mark.parametrize("make_dedup", DEDUPLICATORS)
+def test_forgotten_update_is_processed_again(make_dedup):
+    async def scenario():
+        dedup = make_dedup()
+        assert await dedup.first_seen(TOKEN, 1)
+        await dedup.forget(TOKEN, 1)
+        assert await dedup.first_seen(TOKEN, 1)
+    run(scenario())
+
+@pytest.mark.parametrize("make_dedup", DEDUPLICATORS)
+def test_concurrent_deliveries_are_accepted_once(make_dedup):
+    async def scenario():
+        dedup = make_dedup()
+        results = await asyncio.gather(*(dedup.first_seen(TOKEN, 7) for _ in range(10)))
+        assert results.count(True) == 1
+    run(scenario())
+
+def test_instances_sharing_redis_see_each_others_updates():
+    async def scenario():
+        redis = fakeredis.aioredis.FakeRedis()
+        assert await redis_dedup(redis).first_seen(TOKEN, 1)
+        assert not await redis_dedup(redis).first_seen(TOKEN, 1)
+    run(scenario())
+
+def test_redis_outage_falls_back_to_the_in_process_set():
+    async def scenario():
+        server = fakeredis.FakeServer()
+        server.connected = False
+        dedup = RedisUpdateDeduplicator(fakeredis.aioredis.FakeRedis(server=server))
+        assert await dedup.first_seen(TOKEN, 1)
+        assert not await dedup.first_seen(TOKEN, 1)
+        assert dedup.fallback_calls == 2
+    run(scenario())
+
+def test_enqueue_update_ignores_redeliveries_and_forgets_rejected_updates(monkeypatch):
+    import backend.main as main
+
+    async def scenario():
+        monkeypatch.setattr(main.config, "UPDATE_DEDUP_ENABLED", True)
+        monkeypatch.setattr(main, "update_dedup", InMemoryUpdateDeduplicator())
+        # A pool that is not started refuses jobs, like one shutting down
+        monkeypatch.setattr(main, "worker_pool", WorkerPool(InMemoryJobQueue(), handler=None))
+        assert await main.enqueue_update(TOKEN, 1, 99, "hello") == REJECTED
+
+        main.worker_pool.accepting = True
+        assert await main.enqueue_update(TOKEN, 1, 99, "hello") == ACCEPTED
+        assert await main.enqueue_update(TOKEN, 1, 99, "hello") == DUPLICATE
+        assert await main.worker_pool.queue.size() == 1
+    run(scenario())
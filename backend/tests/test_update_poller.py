@@ -0,0 +1,131 @@
+import asyncio
+import json
+
+import fakeredis.aioredis
+
+from backend.job_queue import ACCEPTED, REJECTED
+from backend.update_poller import FileOffsetStore, RedisOffsetStore, TelegramAPIError, UpdatePoller, bot_key
+
+BOTS = ["111:first-bot", "222:second-bot"]
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+def updates(first, count):
+    return [{'update_id': n, 'message': {'chat': {'id': 1}, 'text': f"message {n}"}}
+            for n in range(first, first + count)]
+
+class FakeTelegramPoller(UpdatePoller):
+    """Serves getUpdates from a fixed list per bot, like Telegram before updates are confirmed."""
+
+    def __init__(self, pending, **kwargs):
+        super().__init__(**kwargs)
+        self.pending = pending
+        self.requested_offsets = []
+
+    async def active_bot_tokens(self):
+        return list(self.pending)
+
+    async def _call(self, token, method, payload):
+        if method != 'getUpdates':
+            return True
+        if payload.get('timeout'):
+            self.requested_offsets.append((token, payload.get('offset')))
+        batch = [update for update in self.pending[token] if update['update_id'] >= payload.get('offset', 0)]
+        if not batch:
+            await asyncio.sleep(0.01)  # long poll with nothing to deliver
+        return batch[:payload.get('limit', 100)]
+
+async def poll_until(poller, queued, expected):
+    poller.start()
+    for _ in range(500):
+        if len(queued) >= expected:
+            break
+        await asyncio.sleep(0.01)
+    await poller.stop()
+
+def recorder(queued, refuse=()):
+    refused = set(refuse)
+
+    async def enqueue(token, update_id, chat_id, text):
+        if update_id in refused:
+            refused.discard(update_id)  # refused once, as if the queue was full
+            return REJECTED
+        queued.append((token, update_id))
+        return ACCEPTED
+
+    return enqueue
+
+def test_file_store_keeps_every_bots_offset_across_a_restart(tmp_path):
+    async def scenario():
+        path = str(tmp_path / "offsets.json")
+        store = FileOffsetStore(path)
+        await store.save({bot_key(BOTS[0]): 10})
+        await store.save({bot_key(BOTS[1]): 20})
+        await store.save({bot_key(BOTS[0]): 11})
+        assert await FileOffsetStore(path).load() == {bot_key(BOTS[0]): 11, bot_key(BOTS[1]): 20}
+        with open(path) as f:
+            assert not any(token in f.read() for token in BOTS)
+    run(scenario())
+
+def test_file_store_starts_empty_without_a_file(tmp_path):
+    assert run(FileOffsetStore(str(tmp_path / "missing.json")).load()) == {}
+
+def test_redis_store_keeps_every_bots_offset():
+    async def scenario():
+        redis = fakeredis.aioredis.FakeRedis()
+        await RedisOffsetStore(redis).save({bot_key(BOTS[0]): 10})
+        await RedisOffsetStore(redis).save({bot_key(BOTS[1]): 20})
+        assert await RedisOffsetStore(redis).load() == {bot_key(BOTS[0]): 10, bot_key(BOTS[1]): 20}
+    run(scenario())
+
+def test_restarted_poller_resumes_from_the_saved_offsets(tmp_path):
+    async def scenario():
+        path = str(tmp_path / "offsets.json")
+        pending = {BOTS[0]: updates(100, 5), BOTS[1]: updates(500, 3)}
+        queued = []
+        await poll_until(FakeTelegramPoller(pending, enqueue=recorder(queued), store=FileOffsetStore(path)),
+                         queued, 8)
+        assert sorted(queued) == sorted((token, update['update_id']) for token in pending for update in pending[token])
+        with open(path) as f:
+            assert json.load(f) == {bot_key(BOTS[0]): 105, bot_key(BOTS[1]): 503}
+
+        # Telegram still holds the same updates (never confirmed); nothing is queued twice
+        pending[BOTS[0]] += updates(105, 2)
+        queued.clear()
+        restarted = FakeTelegramPoller(pending, enqueue=recorder(queued), store=FileOffsetStore(path))
+        await poll_until(restarted, queued, 2)
+        assert queued == [(BOTS[0], 105), (BOTS[0], 106)]
+        assert (BOTS[1], 503) in restarted.requested_offsets
+    run(scenario())
+
+def test_offset_does_not_move_past_an_update_the_queue_refused(tmp_path):
+    async def scenario():
+        pending = {BOTS[0]: updates(1, 4)}
+        queued = []
+        poller = FakeTelegramPoller(pending, enqueue=recorder(queued, refuse={3}),
+                                    store=FileOffsetStore(str(tmp_path / "offsets.json")))
+        await poll_until(poller, queued, 4)
+        assert [update_id for _, update_id in queued] == [1, 2, 3, 4]
+        assert (BOTS[0], 3) in poller.requested_offsets
+        assert poller.offsets[bot_key(BOTS[0])] == 5
+    run(scenario())
+
+def test_bot_that_gave_up_is_polled_again_on_the_next_refresh(tmp_path):
+    async def scenario():
+        pending = {BOTS[0]: updates(1, 2)}
+        queued = []
+        poller = FakeTelegramPoller(pending, enqueue=recorder(queued), refresh_interval=0.05,
+                                    store=FileOffsetStore(str(tmp_path / "offsets.json")))
+        call = poller._call
+        unauthorized = [True]
+        async def revoked_once(token, method, payload):
+            if unauthorized[0]:
+                unauthorized[0] = False
+                raise TelegramAPIError(401, "Unauthorized")
+            return await call(token, method, payload)
+        poller._call = revoked_once
+        await poll_until(poller, queued, 2)
+        assert [update_id for _, update_id in queued] == [1, 2]
+        assert poller.stats()['errors'] == 1
+    run(scenario())
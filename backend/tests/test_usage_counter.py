@@ -0,0 +1,214 @@
+import asyncio
+from collections import defaultdict
+
+import fakeredis.aioredis
+import pytest
+
+import backend.services as services
+from backend.usage_counter import InMemoryUsageCounter, RedisUsageCounter
+
+SUBSCRIPTION = {'id': 'sub-1', 'start_date': '2026-10-01', 'end_date': '2026-11-01'}
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+class DatabaseTotal:
+    """Replaces the get_total_usage RPC with a settable total."""
+
+    database_total = 0
+    database_latency = 0.0
+
+    async def _database_total(self, subscription):
+        total = self.database_total
+        await asyncio.sleep(self.database_latency)
+        if isinstance(total, Exception):
+            raise total
+        return total
+
+class InMemoryCounter(DatabaseTotal, InMemoryUsageCounter):
+    pass
+
+class RedisCounter(DatabaseTotal, RedisUsageCounter):
+    pass
+
+@pytest.fixture(autouse=True)
+def buffered_usage_logs(monkeypatch):
+    """usage_logs rows recorded by commit(), as a buffered writer would hold them."""
+    buffered = defaultdict(int)
+
+    async def record_usage(subscription_id, tokens_used):
+        buffered[subscription_id] += tokens_used
+        return True
+
+    monkeypatch.setattr(services, "record_usage", record_usage)
+    return buffered
+
+def in_memory_counter(redis=None, **kwargs):
+    return InMemoryCounter(**kwargs)
+
+def redis_counter(redis=None, **kwargs):
+    return RedisCounter(redis or fakeredis.aioredis.FakeRedis(), **kwargs)
+
+COUNTERS = [in_memory_counter, redis_counter]
+
+@pytest.mark.parametrize("make_counter", COUNTERS)
+def test_reserve_grants_the_desired_tokens_within_the_budget(make_counter):
+    async def scenario():
+        counter = make_counter()
+        counter.database_total = 100
+        reservation = await counter.reserve(SUBSCRIPTION, minimum=50, desired=300, limit=1000)
+        assert reservation.amount == 300
+        assert await counter.current(SUBSCRIPTION) == 400
+    run(scenario())
+
+@pytest.mark.parametrize("make_counter", COUNTERS)
+def test_reserve_is_capped_at_the_remaining_budget(make_counter):
+    async def scenario():
+        counter = make_counter()
+        counter.database_total = 900
+        reservation = await counter.reserve(SUBSCRIPTION, minimum=50, desired=300, limit=1000)
+        assert reservation.amount == 100
+        assert await counter.current(SUBSCRIPTION) == 1000
+    run(scenario())
+
+@pytest.mark.parametrize("make_counter", COUNTERS)
+def test_reserve_is_refused_below_the_minimum(make_counter):
+    async def scenario():
+        counter = make_counter()
+        counter.database_total = 960
+        assert await counter.reserve(SUBSCRIPTION, minimum=50, desired=300, limit=1000) is None
+        assert counter.rejections == 1
+        assert await counter.current(SUBSCRIPTION) == 960
+    run(scenario())
+
+@pytest.mark.parametrize("make_counter", COUNTERS)
+def test_commit_replaces_the_reservation_with_the_tokens_used(make_counter):
+    async def scenario():
+        counter = make_counter()
+        reservation = await counter.reserve(SUBSCRIPTION, minimum=50, desired=500, limit=1000)
+        await counter.commit(reservation, 120)
+        assert await counter.current(SUBSCRIPTION) == 120
+        assert counter.stats()['outstanding_tokens'] == 0
+    run(scenario())
+
+@pytest.mark.parametrize("make_counter", COUNTERS)
+def test_refund_returns_the_tokens_to_the_budget(make_counter):
+    async def scenario():
+        counter = make_counter()
+        counter.database_total = 500
+        reservation = await counter.reserve(SUBSCRIPTION, minimum=50, desired=500, limit=1000)
+        assert await counter.reserve(SUBSCRIPTION, minimum=50, desired=50, limit=1000) is None
+        await counter.refund(reservation)
+        assert await counter.current(SUBSCRIPTION) == 500
+        assert await counter.reserve(SUBSCRIPTION, minimum=50, desired=500, limit=1000) is not None
+    run(scenario())
+
+@pytest.mark.parametrize("make_counter", COUNTERS)
+def test_concurrent_reservations_never_overshoot_the_limit(make_counter):
+    async def scenario():
+        counter = make_counter()
+        reservations = await asyncio.gather(*(
+            counter.reserve(SUBSCRIPTION, minimum=100, desired=100, limit=1000) for _ in range(25)
+        ))
+        granted = [reservation for reservation in reservations if reservation is not None]
+        assert len(granted) == 10
+        assert await counter.current(SUBSCRIPTION) == 1000
+    run(scenario())
+
+@pytest.mark.parametrize("make_counter", COUNTERS)
+def test_reconcile_keeps_reservations_in_flight(make_counter):
+    async def scenario():
+        counter = make_counter()
+        counter.database_total = 100
+        await counter.reserve(SUBSCRIPTION, minimum=50, desired=300, limit=1000)
+        # usage_logs gained 50 tokens written by a path that bypassed the counter
+        counter.database_total = 150
+        assert await counter.reconcile() == 1
+        assert await counter.current(SUBSCRIPTION) == 450
+        assert await counter.reconcile() == 0
+    run(scenario())
+
+@pytest.mark.parametrize("make_counter", COUNTERS)
+def test_reconcile_lowers_an_overcounted_total_but_keeps_unflushed_usage(make_counter):
+    async def scenario():
+        counter = make_counter()
+        counter.database_total = 500
+        await counter.commit(await counter.reserve(SUBSCRIPTION, minimum=50, desired=300, limit=1000), 300)
+        # usage_logs was corrected down to 200; 40 tokens still wait in the write-behind buffer
+        counter.database_total = 200
+        counter.pending_tokens = lambda subscription_id: 40
+        assert await counter.reconcile() == 1
+        assert await counter.current(SUBSCRIPTION) == 240
+    run(scenario())
+
+@pytest.mark.parametrize("make_counter", COUNTERS)
+def test_abandoned_reservation_is_released_when_it_expires(make_counter):
+    async def scenario():
+        # The worker holding the reservation died: it is never committed or refunded
+        counter = make_counter(reservation_ttl=0)
+        counter.database_total = 100
+        assert (await counter.reserve(SUBSCRIPTION, minimum=50, desired=300, limit=1000)).amount == 300
+        assert await counter.reconcile() == 0
+        assert await counter.current(SUBSCRIPTION) == 100
+        assert (await counter.reserve(SUBSCRIPTION, minimum=50, desired=900, limit=1000)).amount == 900
+    run(scenario())
+
+@pytest.mark.parametrize("make_counter", COUNTERS)
+def test_commit_after_expiry_charges_the_tokens_used(make_counter):
+    async def scenario():
+        counter = make_counter(reservation_ttl=0)
+        reservation = await counter.reserve(SUBSCRIPTION, minimum=50, desired=300, limit=1000)
+        await counter.reconcile()
+        await counter.commit(reservation, 120)
+        assert await counter.current(SUBSCRIPTION) == 120
+    run(scenario())
+
+@pytest.mark.parametrize("make_counter", COUNTERS)
+def test_commit_records_the_usage_row(make_counter, buffered_usage_logs):
+    async def scenario():
+        counter = make_counter()
+        reservation = await counter.reserve(SUBSCRIPTION, minimum=50, desired=300, limit=1000)
+        await counter.commit(reservation, 120)
+        assert buffered_usage_logs[SUBSCRIPTION['id']] == 120
+        await counter.refund(await counter.reserve(SUBSCRIPTION, minimum=50, desired=300, limit=1000))
+        assert buffered_usage_logs[SUBSCRIPTION['id']] == 120
+    run(scenario())
+
+@pytest.mark.parametrize("make_counter", COUNTERS)
+def test_commit_during_reconcile_keeps_the_tokens_counted(make_counter, buffered_usage_logs):
+    async def scenario():
+        counter = make_counter()
+        counter.pending_tokens = lambda subscription_id: buffered_usage_logs[subscription_id]
+        reservation = await counter.reserve(SUBSCRIPTION, minimum=50, desired=300, limit=1000)
+        # The commit lands while reconcile waits for usage_logs
+        counter.database_latency = 0.05
+        reconciling = asyncio.create_task(counter.reconcile())
+        await asyncio.sleep(0.01)
+        await counter.commit(reservation, 200)
+        await reconciling
+        assert await counter.current(SUBSCRIPTION) == 200
+        granted = await counter.reserve(SUBSCRIPTION, minimum=50, desired=1000, limit=1000)
+        assert granted.amount == 800
+    run(scenario())
+
+def test_two_redis_instances_share_one_budget():
+    async def scenario():
+        redis = fakeredis.aioredis.FakeRedis()
+        first, second = redis_counter(redis), redis_counter(redis)
+        assert await first.reserve(SUBSCRIPTION, minimum=100, desired=600, limit=1000) is not None
+        reservation = await second.reserve(SUBSCRIPTION, minimum=100, desired=600, limit=1000)
+        assert reservation.amount == 400
+        assert await second.reserve(SUBSCRIPTION, minimum=100, desired=600, limit=1000) is None
+        # Each instance counts the other's reservation as reserved, not as drift
+        assert await first.reconcile() == 0
+        assert await second.reconcile() == 0
+    run(scenario())
+
+def test_reservation_is_not_enforced_when_the_counter_cannot_be_seeded():
+    async def scenario():
+        counter = in_memory_counter()
+        counter.database_total = RuntimeError("database down")
+        reservation = await counter.reserve(SUBSCRIPTION, minimum=50, desired=300, limit=100)
+        assert reservation.amount == 300 and not reservation.tracked
+        await counter.commit(reservation, 200)
+    run(scenario())
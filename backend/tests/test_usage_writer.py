@@ -0,0 +1,96 @@
+import asyncio
+import os
+import threading
+
+from backend.usage_writer import UsageLogWriter
+
+SUBSCRIPTION = "subscription-1"
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+class FakeUsageLogs:
+    """Stands in for UsageLogWriter._insert: stores rows by id, or fails while down."""
+
+    def __init__(self):
+        self.rows = {}
+        self.down = False
+
+    async def insert(self, rows):
+        if self.down:
+            raise ConnectionError("database unreachable")
+        for row in rows:
+            self.rows[row['id']] = row
+
+def make_writer(tmp_path, usage_logs, **kwargs):
+    writer = UsageLogWriter(spill_path=str(tmp_path / "spill.jsonl"), **kwargs)
+    writer._insert = usage_logs.insert
+    return writer
+
+def test_full_buffer_is_spilled_by_the_flush_task_off_the_event_loop(tmp_path):
+    async def scenario():
+        usage_logs = FakeUsageLogs()
+        usage_logs.down = True
+        writer = make_writer(tmp_path, usage_logs, flush_interval=60, max_buffer=3)
+        spill_threads = []
+        append_spill = writer._append_spill
+        def tracked_append_spill(rows):
+            spill_threads.append(threading.current_thread())
+            append_spill(rows)
+        writer._append_spill = tracked_append_spill
+        writer.start()
+        for _ in range(3):
+            writer.record(SUBSCRIPTION, 10)
+        # record() only hands the rows over; the flush task writes the file
+        assert not spill_threads and not os.path.exists(writer.spill_path)
+        for _ in range(50):
+            await asyncio.sleep(0.01)
+            if writer.stats()['spilled_rows']:
+                break
+        assert writer.stats()['spilled_rows'] == 3
+        assert spill_threads and threading.main_thread() not in spill_threads
+        assert writer.pending_tokens(SUBSCRIPTION) == 30
+
+        usage_logs.down = False
+        assert await writer.flush() == 3
+        assert not os.path.exists(writer.spill_path)
+        assert writer.pending_tokens(SUBSCRIPTION) == 0
+        await writer.stop()
+        assert len(usage_logs.rows) == 3
+    run(scenario())
+
+def test_spilled_rows_survive_a_restart(tmp_path):
+    async def scenario():
+        usage_logs = FakeUsageLogs()
+        usage_logs.down = True
+        writer = make_writer(tmp_path, usage_logs, flush_interval=60)
+        writer.start()
+        writer.record(SUBSCRIPTION, 25)
+        writer.record(SUBSCRIPTION, 5)
+        await writer.stop()
+        assert writer.stats()['spilled_rows'] == 2
+
+        usage_logs.down = False
+        restarted = make_writer(tmp_path, usage_logs, flush_interval=0.01)
+        restarted.start()
+        for _ in range(50):
+            await asyncio.sleep(0.01)
+            if len(usage_logs.rows) == 2:
+                break
+        assert sum(row['total_tokens'] for row in usage_logs.rows.values()) == 30
+        assert restarted.pending_tokens(SUBSCRIPTION) == 0
+        await restarted.stop()
+        assert not os.path.exists(restarted.spill_path)
+    run(scenario())
+
+def test_replayed_rows_are_not_written_twice(tmp_path):
+    async def scenario():
+        usage_logs = FakeUsageLogs()
+        writer = make_writer(tmp_path, usage_logs)
+        writer.record(SUBSCRIPTION, 7)
+        rows = writer._take(1)
+        await writer._spill(rows)
+        await usage_logs.insert(rows)  # written before the spill file was truncated
+        assert await writer.flush() == 1
+        assert len(usage_logs.rows) == 1 and writer.pending_tokens(SUBSCRIPTION) == 0
+    run(scenario())
@@ -0,0 +1,118 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import backend.webhook_router as webhook_router_module
+from backend.webhook_router import WebhookRouter
+
+TOKEN = "123456:bot-token"
+OTHER_TOKEN = "654321:other-bot"
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+class FakeBotsQuery:
+    """Just enough of a postgrest select on the bots table for WebhookRouter.refresh."""
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def select(self, columns):
+        return self
+
+    def eq(self, column, value):
+        return FakeBotsQuery([row for row in self.rows if row.get(column) == value])
+
+    def gte(self, column, value):
+        return FakeBotsQuery([row for row in self.rows if row[column] >= value])
+
+    def order(self, column):
+        return FakeBotsQuery(sorted(self.rows, key=lambda row: row[column]))
+
+    def range(self, start, end):
+        return FakeBotsQuery(self.rows[start:end + 1])
+
+    async def execute(self):
+        return SimpleNamespace(data=self.rows)
+
+@pytest.fixture
+def bots(monkeypatch):
+    rows = []
+    fake_supabase = SimpleNamespace(table=lambda name: FakeBotsQuery(rows))
+    async def get_async_supabase():
+        return fake_supabase
+    monkeypatch.setattr(webhook_router_module, "get_async_supabase", get_async_supabase)
+    return rows
+
+def bot(bot_id, token, updated_at):
+    return {'id': bot_id, 'company_id': f"company-{bot_id}", 'token': token,
+            'platform': 'telegram', 'updated_at': updated_at}
+
+def test_webhook_id_and_secret_are_per_bot_and_hide_the_token():
+    router = WebhookRouter("key")
+    assert TOKEN not in router.webhook_id(TOKEN) and TOKEN not in router.secret(TOKEN)
+    assert router.webhook_id(TOKEN) != router.webhook_id(OTHER_TOKEN)
+    assert router.secret(TOKEN) != router.secret(OTHER_TOKEN)
+    assert router.webhook_id(TOKEN) == WebhookRouter("key").webhook_id(TOKEN)
+    assert router.webhook_id(TOKEN) != WebhookRouter("other key").webhook_id(TOKEN)
+
+def test_resolve_checks_the_bots_own_secret():
+    async def scenario():
+        router = WebhookRouter("key")
+        router.add(TOKEN, bot_id="1")
+        router.add(OTHER_TOKEN, bot_id="2")
+        webhook_id = router.webhook_id(TOKEN)
+        assert (await router.resolve(webhook_id, router.secret(TOKEN))).bot_token == TOKEN
+        assert await router.resolve(webhook_id, router.secret(OTHER_TOKEN)) is None
+        assert await router.resolve(webhook_id, None) is None
+        assert router.stats()['rejected'] == 2
+    run(scenario())
+
+def test_changed_token_replaces_the_old_route():
+    async def scenario():
+        router = WebhookRouter("key")
+        router.add(TOKEN, bot_id="1")
+        router.add(OTHER_TOKEN, bot_id="1")
+        assert router.stats()['routes'] == 1
+        router.remove(bot_id="1")
+        assert router.stats()['routes'] == 0
+    run(scenario())
+
+def test_refresh_loads_changed_bots_and_drops_deleted_ones(bots):
+    async def scenario():
+        router = WebhookRouter("key")
+        bots.extend([bot(1, TOKEN, "2026-01-01T00:00:00"), bot(2, OTHER_TOKEN, "2026-01-02T00:00:00")])
+        assert await router.refresh() == 2
+        assert router.watermark == "2026-01-02T00:00:00"
+
+        bots[:] = [bot(2, OTHER_TOKEN, "2026-01-02T00:00:00")]
+        await router.refresh()
+        assert await router.resolve(router.webhook_id(TOKEN), router.secret(TOKEN)) is None
+        route = await router.resolve(router.webhook_id(OTHER_TOKEN), router.secret(OTHER_TOKEN))
+        assert route.company_id == "company-2"
+    run(scenario())
+
+def test_unknown_id_refreshes_at_most_once_per_interval(bots):
+    async def scenario():
+        router = WebhookRouter("key", miss_refresh_interval=60)
+        await router.refresh()
+        router._last_refresh = 0.0
+        bots.append(bot(1, TOKEN, "2026-01-01T00:00:00"))
+        assert await router.resolve(router.webhook_id(TOKEN), router.secret(TOKEN)) is not None
+        bots.append(bot(2, OTHER_TOKEN, "2026-01-02T00:00:00"))
+        assert await router.resolve(router.webhook_id(OTHER_TOKEN), router.secret(OTHER_TOKEN)) is None
+        assert router.stats()['refreshes'] == 2
+    run(scenario())
+
+def test_router_without_key_routes_nothing(bots):
+    async def scenario():
+        router = WebhookRouter(None)
+        assert not router.enabled and not WebhookRouter("").enabled
+        with pytest.raises(ValueError):
+            router.add(TOKEN)
+        bots.append(bot(1, TOKEN, "2026-01-01T00:00:00"))
+        assert await router.refresh() == 0
+        assert await router.resolve("any-id", "") is None
+        assert router.stats()['routes'] == 0
+    run(scenario())
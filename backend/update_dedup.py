@@ -0,0 +1,123 @@
+import hashlib
+import logging
+import time
+from abc import ABC, abstractmethod
+from typing import Any, Dict
+
+import backend.config as config
+from backend.cache import MISSING, TTLCache
+
+logger = logging.getLogger(__name__)
+
+def update_key(bot_token: str, update_id: int) -> str:
+    """Dedup key for one update; the bot token is hashed so it is never stored."""
+    return f"{hashlib.sha256(bot_token.encode()).hexdigest()[:16]}:{update_id}"
+
+class UpdateDeduplicator(ABC):
+    """Remembers the Telegram update_ids already accepted, per bot.
+
+    Telegram redelivers an update when the webhook does not answer 2xx in
+    time; without this every redelivery meant another model call, another
+    reply and another usage_logs row. Keys expire after ttl seconds
+    (Telegram gives up on an update after 24 hours).
+    """
+
+    def __init__(self, ttl: float = 86400.0):
+        self.ttl = ttl
+        self.checked = 0
+        self.duplicates = 0
+
+    @abstractmethod
+    async def _claim(self, key: str) -> bool:
+        """Marks key as seen. False if it already was."""
+
+    @abstractmethod
+    async def _release(self, key: str) -> None:
+        """Removes the mark set by _claim."""
+
+    async def first_seen(self, bot_token: str, update_id: int) -> bool:
+        """True the first time an update arrives, False for redeliveries."""
+        self.checked += 1
+        if await self._claim(update_key(bot_token, update_id)):
+            return True
+        self.duplicates += 1
+        return False
+
+    async def forget(self, bot_token: str, update_id: int) -> None:
+        """Un-marks an update that was not accepted after all, so its redelivery is processed."""
+        await self._release(update_key(bot_token, update_id))
+
+    def stats(self) -> Dict[str, Any]:
+        """Dedup counters for the /metrics endpoint."""
+        return {
+            'backend': type(self).__name__,
+            'checked': self.checked,
+            'duplicates': self.duplicates,
+            'duplicate_rate': round(self.duplicates / self.checked, 4) if self.checked else 0.0
+        }
+
+class InMemoryUpdateDeduplicator(UpdateDeduplicator):
+    """Per-process set of recent update keys, bounded by max_size (single instance deployments)."""
+
+    def __init__(self, max_size: int = 100000, **kwargs):
+        super().__init__(**kwargs)
+        self._seen = TTLCache(max_size=max_size, ttl=self.ttl)
+
+    async def _claim(self, key: str) -> bool:
+        if self._seen.peek(key) is not MISSING:
+            return False
+        self._seen.set(key, True)
+        return True
+
+    async def _release(self, key: str) -> None:
+        self._seen.invalidate(key)
+
+class RedisUpdateDeduplicator(UpdateDeduplicator):
+    """Update keys shared by every instance (SET NX with a TTL).
+
+    If Redis is unreachable the in-process set is used until it answers again.
+    """
+
+    def __init__(self, redis, prefix: str = "botai:update", retry_after: float = 30.0, **kwargs):
+        super().__init__(**kwargs)
+        self.redis = redis
+        self.prefix = prefix
+        self.retry_after = retry_after
+        self.fallback = InMemoryUpdateDeduplicator(ttl=self.ttl)
+        self.fallback_calls = 0
+        self._redis_down_until = 0.0
+
+    async def _call(self, method: str, key: str):
+        from redis.exceptions import RedisError
+        if time.monotonic() >= self._redis_down_until:
+            try:
+                return await getattr(self, f"_redis{method}")(key)
+            except (RedisError, OSError) as e:
+                logger.warning(f"Redis unavailable for update dedup, using in-process fallback for {self.retry_after}s: {e}")
+                self._redis_down_until = time.monotonic() + self.retry_after
+        self.fallback_calls += 1
+        return await getattr(self.fallback, method)(key)
+
+    async def _claim(self, key: str) -> bool:
+        return await self._call('_claim', key)
+
+    async def _release(self, key: str) -> None:
+        await self._call('_release', key)
+
+    async def _redis_claim(self, key: str) -> bool:
+        return bool(await self.redis.set(f"{self.prefix}:{key}", 1, ex=int(self.ttl), nx=True))
+
+    async def _redis_release(self, key: str) -> None:
+        await self.redis.delete(f"{self.prefix}:{key}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {**super().stats(), 'fallback_calls': self.fallback_calls}
+
+def create_update_deduplicator() -> UpdateDeduplicator:
+    """Builds the deduplicator selected by config.UPDATE_DEDUP_BACKEND."""
+    if config.UPDATE_DEDUP_BACKEND == "redis":
+        from backend.database import get_async_redis
+        return RedisUpdateDeduplicator(get_async_redis(), ttl=config.UPDATE_DEDUP_TTL)
+    return InMemoryUpdateDeduplicator(max_size=config.UPDATE_DEDUP_MAX_SIZE, ttl=config.UPDATE_DEDUP_TTL)
+
+update_dedup = create_update_deduplicator()
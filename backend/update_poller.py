@@ -0,0 +1,325 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+from abc import ABC, abstractmethod
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+
+import httpx
+from supabase import PostgrestAPIError
+
+import backend.config as config
+from backend.bulkhead import BUSY_MESSAGE
+from backend.database import get_async_supabase, select_all
+from backend.job_queue import REJECTED, SHED
+from backend.telegram_client import telegram
+
+logger = logging.getLogger(__name__)
+
+def bot_key(token: str) -> str:
+    """Offset key for a bot; the token is hashed so it is never stored."""
+    return hashlib.sha256(token.encode()).hexdigest()[:16]
+
+class TelegramAPIError(Exception):
+    """A Bot API call answered ok=false (error_code, description, parameters.retry_after)."""
+
+    def __init__(self, code: int, description: str, retry_after: Optional[float] = None):
+        super().__init__(f"{code} {description}")
+        self.code = code
+        self.retry_after = retry_after
+
+class OffsetStore(ABC):
+    """Persists the next getUpdates offset per bot."""
+
+    @abstractmethod
+    async def load(self) -> Dict[str, int]:
+        """The stored offsets by bot key."""
+
+    @abstractmethod
+    async def save(self, offsets: Dict[str, int]) -> None:
+        """Stores the given bots' offsets, keeping those of other bots."""
+
+class FileOffsetStore(OffsetStore):
+    """Offsets in a local JSON file, replaced atomically on every save.
+
+    Saves merge into the offsets already stored, so each bot's save keeps the
+    others'. File I/O runs in a worker thread, off the event loop.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._offsets: Optional[Dict[str, int]] = None
+        self._lock = asyncio.Lock()
+
+    def _read(self) -> Dict[str, int]:
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path) as f:
+                return {key: int(value) for key, value in json.load(f).items()}
+        except (OSError, ValueError) as e:
+            logger.error(f"Error reading getUpdates offsets from {self.path}: {e}")
+            return {}
+
+    def _write(self, offsets: Dict[str, int]) -> None:
+        temporary = f"{self.path}.tmp"
+        with open(temporary, 'w') as f:
+            json.dump(offsets, f)
+        os.replace(temporary, self.path)
+
+    async def load(self) -> Dict[str, int]:
+        async with self._lock:
+            if self._offsets is None:
+                self._offsets = await asyncio.to_thread(self._read)
+            return dict(self._offsets)
+
+    async def save(self, offsets: Dict[str, int]) -> None:
+        async with self._lock:
+            if self._offsets is None:
+                self._offsets = await asyncio.to_thread(self._read)
+            self._offsets.update(offsets)
+            await asyncio.to_thread(self._write, dict(self._offsets))
+
+class RedisOffsetStore(OffsetStore):
+    """Offsets in a Redis hash, shared by restarts on other machines."""
+
+    def __init__(self, redis, key: str = "botai:poll:offsets"):
+        self.redis = redis
+        self.key = key
+
+    async def load(self) -> Dict[str, int]:
+        raw = await self.redis.hgetall(self.key)
+        return {(k.decode() if isinstance(k, bytes) else k): int(v) for k, v in raw.items()}
+
+    async def save(self, offsets: Dict[str, int]) -> None:
+        if offsets:
+            await self.redis.hset(self.key, mapping=offsets)
+
+class UpdatePoller:
+    """Long-polls getUpdates for every active Telegram bot (ingestion without a public webhook).
+
+    One task per bot in this process waits in getUpdates for up to `timeout`
+    seconds and receives up to `limit` updates per call. Each batch goes
+    through enqueue (the same path as the webhook). The offset only moves
+    past updates that were queued; Telegram treats updates below the offset
+    as confirmed on the next call. A batch cut short by a full queue is
+    fetched again later, so nothing is lost, and the persisted offset plus
+    update_id dedup keep a restart from replaying what was already queued.
+
+    The active bots are re-read from the bots table every refresh_interval
+    seconds. A bot's webhook is deleted before polling it (Telegram refuses
+    getUpdates while one is set).
+    """
+
+    def __init__(self, enqueue: Callable[[str, Optional[int], int, str], Awaitable[str]],
+                 store: OffsetStore, timeout: int = 25, limit: int = 100, refresh_interval: float = 60.0):
+        self.enqueue = enqueue
+        self.store = store
+        self.timeout = timeout
+        self.limit = limit
+        self.refresh_interval = refresh_interval
+        self.offsets: Dict[str, int] = {}
+        self.polls = 0
+        self.updates = 0
+        self.queued = 0
+        self.skipped = 0
+        self.errors = 0
+        self._pollers: Dict[str, asyncio.Task] = {}
+        self._idle: Set[str] = set()  # bots waiting in getUpdates or a backoff, safe to cancel
+        self._stopping = False
+        self._http: Optional[httpx.AsyncClient] = None
+        self._max_connections = 0
+        self._retired_clients: List[httpx.AsyncClient] = []
+        self._task: Optional[asyncio.Task] = None
+
+    def _client(self) -> httpx.AsyncClient:
+        # Long polls hold a connection each; keep them off the pool used for replies
+        if self._http is None:
+            self._size_pool(len(self._pollers))
+        return self._http
+
+    def _size_pool(self, bots: int) -> None:
+        """Makes sure the pool has a connection for every bot's long poll (plus headroom)."""
+        if self._http is not None and bots + 10 <= self._max_connections:
+            return
+        self._max_connections = max(100, 2 * (bots + 10))
+        if self._http is not None:
+            # Long polls in flight keep using the old client; it is closed on stop()
+            self._retired_clients.append(self._http)
+        self._http = httpx.AsyncClient(
+            timeout=httpx.Timeout(self.timeout + 10),
+            limits=httpx.Limits(max_connections=self._max_connections,
+                                max_keepalive_connections=self._max_connections)
+        )
+
+    async def _call(self, token: str, method: str, payload: Dict[str, Any]) -> Any:
+        """Calls a Bot API method; returns its result or raises with Telegram's error code."""
+        response = await self._client().post(f"{telegram.base_url}/bot{token}/{method}", json=payload)
+        body = response.json()
+        if not body.get('ok'):
+            raise TelegramAPIError(body.get('error_code', response.status_code), body.get('description', ''),
+                                   (body.get('parameters') or {}).get('retry_after'))
+        return body['result']
+
+    async def active_bot_tokens(self) -> List[str]:
+        """Tokens of the active Telegram bots in the bots table."""
+        try:
+            supabase = await get_async_supabase()
+            rows = await select_all(
+                lambda: supabase.table('bots')
+                .select('id, token')
+                .eq('platform', 'telegram')
+                .eq('is_active', True)
+                .order('id')
+            )
+            return [row['token'] for row in rows if row.get('token')]
+        except PostgrestAPIError as e:
+            logger.error(f"Database error listing bots to poll: {e}")
+        except Exception as e:
+            logger.error(f"Unexpected error listing bots to poll: {e}")
+        return list(self._pollers)  # keep polling the known bots
+
+    async def _ingest(self, token: str, update: Dict[str, Any]) -> bool:
+        """Queues one update. False if the queue refused it (fetch it again later)."""
+        message = update.get('message') or {}
+        chat_id = (message.get('chat') or {}).get('id')
+        if chat_id is None or not message.get('text'):
+            self.skipped += 1  # not a text message: nothing to answer
+            return True
+        status = await self.enqueue(token, update['update_id'], chat_id, message['text'])
+        if status == REJECTED:
+            return False
+        if status == SHED:
+            await telegram.send_message(token, chat_id, BUSY_MESSAGE)
+        self.queued += 1
+        return True
+
+    async def _wait(self, token: str, awaitable: Awaitable) -> Any:
+        """Awaits a long poll or a backoff sleep, during which stop() may cancel the bot's task."""
+        self._idle.add(token)
+        try:
+            return await awaitable
+        finally:
+            self._idle.discard(token)
+
+    async def _poll_bot(self, token: str) -> None:
+        key = bot_key(token)
+        backoff = 1.0
+        webhook_deleted = False
+        while not self._stopping:
+            try:
+                if not webhook_deleted:
+                    await self._wait(token, self._call(token, 'deleteWebhook', {'drop_pending_updates': False}))
+                    webhook_deleted = True
+                payload = {'timeout': self.timeout, 'limit': self.limit, 'allowed_updates': ['message']}
+                if key in self.offsets:
+                    payload['offset'] = self.offsets[key]
+                batch = await self._wait(token, self._call(token, 'getUpdates', payload))
+                self.polls += 1
+                self.updates += len(batch)
+                # A batch is always ingested to the end (or to a full queue) and its offset saved,
+                # even while stopping, so nothing queued is fetched again after a restart
+                stalled = False
+                for update in batch:
+                    if not await self._ingest(token, update):
+                        stalled = True
+                        break
+                    self.offsets[key] = update['update_id'] + 1
+                if batch and key in self.offsets:
+                    await self.store.save({key: self.offsets[key]})
+                if stalled:
+                    # Queue full: let the workers catch up before fetching the rest again
+                    await self._wait(token, asyncio.sleep(1.0))
+                backoff = 1.0
+            except asyncio.CancelledError:
+                raise
+            except TelegramAPIError as e:
+                self.errors += 1
+                if e.code in (401, 404):
+                    logger.error(f"Stopped polling bot {token[:10]}...: {e}")
+                    # The next refresh starts it again if the bot is still active (e.g. a new token)
+                    self._pollers.pop(token, None)
+                    return
+                if e.code == 409:
+                    webhook_deleted = False  # a webhook was set again
+                delay = e.retry_after or backoff
+                logger.warning(f"getUpdates failed for bot {token[:10]}..., retrying in {delay:g}s: {e}")
+                await self._wait(token, asyncio.sleep(delay))
+                backoff = min(backoff * 2, 30.0)
+            except Exception as e:
+                self.errors += 1
+                logger.warning(f"getUpdates failed for bot {token[:10]}..., retrying in {backoff:g}s: {e}")
+                await self._wait(token, asyncio.sleep(backoff))
+                backoff = min(backoff * 2, 30.0)
+
+    async def refresh(self) -> None:
+        """Starts polling new active bots and stops polling removed ones."""
+        tokens = set(await self.active_bot_tokens())
+        self._size_pool(len(tokens))
+        for token in tokens - set(self._pollers):
+            self._pollers[token] = asyncio.create_task(self._poll_bot(token))
+            logger.info(f"Polling getUpdates for bot {token[:10]}...")
+        for token in set(self._pollers) - tokens:
+            self._pollers.pop(token).cancel()
+            logger.info(f"Stopped polling bot {token[:10]}... (no longer active)")
+
+    async def _run(self) -> None:
+        self.offsets.update(await self.store.load())
+        while True:
+            await self.refresh()
+            await asyncio.sleep(self.refresh_interval)
+
+    def start(self) -> None:
+        """Starts the poller."""
+        if self._task is None:
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+
+    async def _confirm(self, token: str) -> None:
+        offset = self.offsets.get(bot_key(token))
+        if offset is None:
+            return
+        try:
+            await self._call(token, 'getUpdates', {'offset': offset, 'timeout': 0, 'limit': 1})
+        except Exception as e:
+            logger.warning(f"Error confirming updates for bot {token[:10]}...: {e}")
+
+    async def stop(self) -> None:
+        """Stops polling and confirms the queued updates with Telegram."""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        # Bots in the middle of a batch finish it first
+        self._stopping = True
+        pollers, self._pollers = self._pollers, {}
+        for token in self._idle & set(pollers):
+            pollers[token].cancel()
+        await asyncio.gather(*pollers.values(), return_exceptions=True)
+        # Telegram only forgets updates below the offset on the next getUpdates; confirm them now
+        # so they are not delivered again if the offset file does not survive the restart
+        await asyncio.gather(*(self._confirm(token) for token in pollers))
+        for client in [*self._retired_clients, self._http]:
+            if client is not None:
+                await client.aclose()
+        self._http, self._retired_clients, self._max_connections = None, [], 0
+
+    def stats(self) -> Dict[str, Any]:
+        """Poller counters for the /metrics endpoint."""
+        return {
+            'bots': len(self._pollers),
+            'polls': self.polls,
+            'updates': self.updates,
+            'queued': self.queued,
+            'skipped': self.skipped,
+            'errors': self.errors,
+            'avg_batch': round(self.updates / self.polls, 2) if self.polls else 0.0
+        }
+
+def create_offset_store() -> OffsetStore:
+    """Builds the offset store selected by config.TELEGRAM_OFFSET_BACKEND."""
+    if config.TELEGRAM_OFFSET_BACKEND == "redis":
+        from backend.database import get_async_redis
+        return RedisOffsetStore(get_async_redis())
+    return FileOffsetStore(config.TELEGRAM_OFFSET_PATH)
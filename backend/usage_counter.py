@@ -0,0 +1,528 @@
+import asyncio
+import logging
+import time
+import uuid
+from abc import ABC, abstractmethod
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Any, AsyncIterator, Callable, Dict, Optional
+
+import backend.config as config
+import backend.services as services
+
+logger = logging.getLogger(__name__)
+
+def period_key(subscription: Dict[str, Any]) -> str:
+    """Counter key for a subscription's current billing window."""
+    return f"{subscription['id']}:{subscription.get('start_date')}"
+
+def period_ttl(subscription: Dict[str, Any]) -> int:
+    """Seconds until the billing window ends (plus a day), so stale counters expire."""
+    end_date = subscription.get('end_date')
+    if end_date:
+        try:
+            ends_at = datetime.fromisoformat(str(end_date).replace('Z', '+00:00'))
+            if ends_at.tzinfo is None:
+                ends_at = ends_at.replace(tzinfo=timezone.utc)
+            remaining = (ends_at - datetime.now(timezone.utc)).total_seconds()
+            return max(int(remaining), 0) + 86400
+        except ValueError:
+            pass
+    return 35 * 86400
+
+@dataclass
+class Reservation:
+    """Tokens held against a subscription's budget while a response is generated."""
+    subscription: Dict[str, Any]
+    amount: int
+    tracked: bool = True  # False when the counter could not be seeded (budget not enforced)
+    id: str = field(default_factory=lambda: uuid.uuid4().hex)
+
+class CommitGate:
+    """Lets commits of one counter run together, but never during its reconcile pass.
+
+    A pass waiting for the gate holds back new commits, so it is not starved.
+    """
+
+    def __init__(self):
+        self._condition = asyncio.Condition()
+        self._commits = 0
+        self._reconciling = False
+
+    @asynccontextmanager
+    async def commit(self) -> AsyncIterator[None]:
+        async with self._condition:
+            await self._condition.wait_for(lambda: not self._reconciling)
+            self._commits += 1
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self._commits -= 1
+                self._condition.notify_all()
+
+    @asynccontextmanager
+    async def reconcile(self) -> AsyncIterator[None]:
+        async with self._condition:
+            await self._condition.wait_for(lambda: not self._reconciling)
+            self._reconciling = True
+            await self._condition.wait_for(lambda: self._commits == 0)
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self._reconciling = False
+                self._condition.notify_all()
+
+class UsageCounter(ABC):
+    """Running token usage per subscription per billing period.
+
+    Counters are seeded once from the get_total_usage RPC and then updated
+    in place, so quota checks never scan usage_logs. A periodic reconcile
+    pass re-reads the RPC and sets each counter to it plus the tokens not in
+    usage_logs yet (reserved, or buffered by a writer). Setting an absolute
+    value keeps the pass idempotent when several instances run it.
+
+    Tokens are reserved before generation and committed (or refunded)
+    afterwards, so concurrent messages can never overshoot the plan limit.
+    Each reservation expires after reservation_ttl seconds: one that is
+    never settled (the process died, or Redis went away in between) is
+    released then instead of holding the budget until the period ends.
+    """
+
+    def __init__(self, reservation_ttl: float = 600.0):
+        self.reservation_ttl = reservation_ttl
+        self.subscriptions: Dict[str, Dict[str, Any]] = {}  # period key -> subscription, for reconcile
+        # Tokens recorded locally but not yet visible in usage_logs (set by a buffered writer)
+        self.pending_tokens: Optional[Callable[[str], int]] = None
+        self.outstanding: Dict[str, int] = {}  # subscription id -> tokens this process holds reserved
+        self._seeding: Dict[str, asyncio.Future] = {}
+        # period key -> gate that keeps commits from landing while a reconcile pass has read
+        # the unflushed tokens but not yet set the counter
+        self._gates: Dict[str, CommitGate] = {}
+        self.seeds = 0
+        self.corrections = 0
+        self.reservations = 0
+        self.rejections = 0
+
+    @abstractmethod
+    async def _load(self, key: str) -> Optional[int]:
+        """The counter's value, or None if it does not exist."""
+
+    @abstractmethod
+    async def _seed(self, key: str, value: int, ttl: int) -> int:
+        """Stores value if the counter does not exist yet; returns the counter's value."""
+
+    @abstractmethod
+    async def _reserve(self, key: str, limit: int, minimum: int, desired: int, ttl: int,
+                       reservation_id: str) -> int:
+        """Atomically adds up to `desired` tokens if at least `minimum` fit under `limit`,
+        and records them as reservation_id (expiring after reservation_ttl).
+
+        Returns the tokens granted, -1 if the counter does not exist, -2 if over budget.
+        """
+
+    @abstractmethod
+    async def _settle(self, key: str, reservation_id: str, amount: int, actual: int, ttl: int) -> None:
+        """Atomically releases a reservation of `amount` and adjusts the counter to `actual`
+        (if the reservation already expired, its amount was released then)."""
+
+    @abstractmethod
+    async def _reconcile_to(self, key: str, database_total: int, unflushed: int, ttl: int) -> Optional[int]:
+        """Sets the counter to database_total plus the unexpired reservations and unflushed tokens
+        of every instance (`unflushed` is this process's). Returns the change, None if there is no counter."""
+
+    async def _database_total(self, subscription: Dict[str, Any]) -> int:
+        return await services.fetch_total_usage(subscription['id'], subscription['start_date'], subscription['end_date'])
+
+    async def current(self, subscription: Dict[str, Any]) -> int:
+        """Tokens used in the subscription's billing period."""
+        key = period_key(subscription)
+        self.subscriptions[key] = subscription
+        value = await self._load(key)
+        if value is None:
+            # Concurrent first messages share one seeding query
+            seeding = self._seeding.get(key)
+            if seeding is None:
+                seeding = self._seeding[key] = asyncio.ensure_future(self._seed_from_database(key, subscription))
+                seeding.add_done_callback(lambda _: self._seeding.pop(key, None))
+            value = await asyncio.shield(seeding)
+        return value
+
+    async def _seed_from_database(self, key: str, subscription: Dict[str, Any]) -> int:
+        try:
+            total = await self._database_total(subscription)
+        except Exception as e:
+            # Same as before counters existed: don't block messages, but don't cache a guess either
+            logger.error(f"Error seeding usage counter for subscription {subscription['id']}: {e}")
+            return 0
+        self.seeds += 1
+        return await self._seed(key, total, period_ttl(subscription))
+
+    async def reserve(self, subscription: Dict[str, Any], minimum: int, desired: int,
+                      limit: int) -> Optional[Reservation]:
+        """Reserves between `minimum` and `desired` tokens of the remaining budget.
+
+        Returns None if fewer than `minimum` tokens are left in the period.
+        """
+        key = period_key(subscription)
+        ttl = period_ttl(subscription)
+        self.subscriptions[key] = subscription
+        reservation_id = uuid.uuid4().hex
+        granted = await self._reserve(key, limit, minimum, desired, ttl, reservation_id)
+        if granted == -1:
+            await self.current(subscription)
+            granted = await self._reserve(key, limit, minimum, desired, ttl, reservation_id)
+            if granted == -1:
+                # Counter could not be seeded (database error); don't block the message
+                return Reservation(subscription, desired, tracked=False)
+        if granted == -2:
+            self.rejections += 1
+            return None
+        self.reservations += 1
+        self.outstanding[subscription['id']] = self.outstanding.get(subscription['id'], 0) + granted
+        return Reservation(subscription, granted, id=reservation_id)
+
+    def _release(self, reservation: Reservation) -> None:
+        subscription_id = reservation.subscription['id']
+        remaining = self.outstanding.get(subscription_id, 0) - reservation.amount
+        if remaining > 0:
+            self.outstanding[subscription_id] = remaining
+        else:
+            self.outstanding.pop(subscription_id, None)
+
+    def _gate(self, key: str) -> CommitGate:
+        gate = self._gates.get(key)
+        if gate is None:
+            gate = self._gates[key] = CommitGate()
+        return gate
+
+    async def commit(self, reservation: Reservation, actual: int) -> None:
+        """Replaces a reservation with the tokens actually used and records them in usage_logs.
+
+        The usage row is handed to the writer before the reservation is
+        released, so the tokens are always counted by reconcile: reserved,
+        buffered (pending_tokens) or in usage_logs.
+        """
+        subscription = reservation.subscription
+        key = period_key(subscription)
+        async with self._gate(key).commit():
+            if actual:
+                await services.record_usage(subscription['id'], actual)
+            if not reservation.tracked:
+                return
+            self._release(reservation)
+            await self._settle(key, reservation.id, reservation.amount, actual, period_ttl(subscription))
+
+    async def refund(self, reservation: Reservation) -> None:
+        """Returns a reservation's tokens to the budget (generation did not happen)."""
+        await self.commit(reservation, 0)
+
+    async def reconcile(self) -> int:
+        """Corrects every known counter against usage_logs. Returns the number corrected."""
+        corrected = 0
+        for key, subscription in list(self.subscriptions.items()):
+            async with self._gate(key).reconcile():
+                # Buffered tokens are in the counter but not in usage_logs yet. Read before the
+                # total, so rows flushed in between are counted twice rather than not at all.
+                unflushed = self.pending_tokens(subscription['id']) if self.pending_tokens else 0
+                try:
+                    total = await self._database_total(subscription)
+                except Exception as e:
+                    logger.error(f"Error reconciling usage counter for subscription {subscription['id']}: {e}")
+                    continue
+                drift = await self._reconcile_to(key, total, unflushed, period_ttl(subscription))
+            if drift is None:
+                self.subscriptions.pop(key, None)
+                self._gates.pop(key, None)
+                continue
+            if drift:
+                logger.warning(f"Corrected usage counter for subscription {subscription['id']} by {drift} tokens")
+                corrected += 1
+        self.corrections += corrected
+        return corrected
+
+    def stats(self) -> Dict[str, Any]:
+        """Counter metrics for the /metrics endpoint."""
+        return {
+            'backend': type(self).__name__,
+            'tracked_periods': len(self.subscriptions),
+            'seeds': self.seeds,
+            'corrections': self.corrections,
+            'reservations': self.reservations,
+            'rejections': self.rejections,
+            'outstanding_tokens': sum(self.outstanding.values())
+        }
+
+class InMemoryUsageCounter(UsageCounter):
+    """Per-process counters (single instance deployments, or when Redis is down)."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._values: Dict[str, tuple] = {}
+        # period key -> reservation id -> (tokens, expires at)
+        self._reservations: Dict[str, Dict[str, tuple]] = {}
+
+    async def _load(self, key: str) -> Optional[int]:
+        entry = self._values.get(key)
+        if entry is None or entry[1] <= time.monotonic():
+            return None
+        return entry[0]
+
+    async def _seed(self, key: str, value: int, ttl: int) -> int:
+        existing = await self._load(key)
+        if existing is not None:
+            return existing
+        self._values[key] = (value, time.monotonic() + ttl)
+        return value
+
+    def _release_expired(self, key: str) -> None:
+        """Gives the tokens of reservations that were never settled back to the budget."""
+        reservations = self._reservations.get(key, {})
+        now = time.monotonic()
+        for reservation_id, (amount, expires_at) in list(reservations.items()):
+            if expires_at <= now:
+                del reservations[reservation_id]
+                entry = self._values.get(key)
+                if entry is not None:
+                    self._values[key] = (entry[0] - amount, entry[1])
+        if not reservations:
+            self._reservations.pop(key, None)
+
+    async def _reserve(self, key: str, limit: int, minimum: int, desired: int, ttl: int,
+                       reservation_id: str) -> int:
+        # No await between the check and the update, so this is atomic on the event loop
+        self._release_expired(key)
+        entry = self._values.get(key)
+        if entry is None or entry[1] <= time.monotonic():
+            return -1
+        remaining = limit - entry[0]
+        if remaining < minimum:
+            return -2
+        granted = min(desired, remaining)
+        self._values[key] = (entry[0] + granted, time.monotonic() + ttl)
+        self._reservations.setdefault(key, {})[reservation_id] = (granted, time.monotonic() + self.reservation_ttl)
+        return granted
+
+    async def _settle(self, key: str, reservation_id: str, amount: int, actual: int, ttl: int) -> None:
+        self._release_expired(key)
+        held = self._reservations.get(key, {}).pop(reservation_id, None)
+        delta = actual - amount if held is not None else actual
+        value = await self._load(key)
+        if delta and value is not None:
+            self._values[key] = (value + delta, time.monotonic() + ttl)
+
+    async def _reconcile_to(self, key: str, database_total: int, unflushed: int, ttl: int) -> Optional[int]:
+        self._release_expired(key)
+        value = await self._load(key)
+        if value is None:
+            self._reservations.pop(key, None)
+            return None
+        reserved = sum(amount for amount, _ in self._reservations.get(key, {}).values())
+        drift = database_total + reserved + unflushed - value
+        if drift:
+            self._values[key] = (value + drift, time.monotonic() + ttl)
+        return drift
+
+class RedisUsageCounter(UsageCounter):
+    """Counters shared by every instance through Redis INCRBY.
+
+    Next to each counter, Redis keeps the reservations of all instances
+    ({key}:reservations, a sorted set of "id:tokens" scored by expiry) and
+    each instance's buffered tokens ({key}:unflushed, one field per instance,
+    refreshed by its reconcile pass). Every
+    instance may reconcile; the script sets the same absolute value.
+    Instances that stopped reporting are ignored after max_report_age seconds.
+
+    If Redis is unreachable the counter falls back to in-process counters
+    (seeded from the database) until Redis answers again.
+    """
+
+    # Shared prologue: reservations past their expiry give their tokens back to the counter
+    RELEASE_EXPIRED = """
+    local now = tonumber(redis.call('TIME')[1])
+    local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', now)
+    if #expired > 0 then
+        local released = 0
+        for _, member in ipairs(expired) do
+            released = released + tonumber(string.match(member, ':(%d+)$'))
+        end
+        redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', now)
+        if redis.call('EXISTS', KEYS[1]) == 1 then
+            redis.call('DECRBY', KEYS[1], released)
+        end
+    end
+    """
+
+    # ARGV: limit, minimum, desired, ttl, reservation id, reservation ttl
+    RESERVE_SCRIPT = RELEASE_EXPIRED + """
+    local value = redis.call('GET', KEYS[1])
+    if not value then
+        return -1
+    end
+    local remaining = tonumber(ARGV[1]) - tonumber(value)
+    if remaining < tonumber(ARGV[2]) then
+        return -2
+    end
+    local granted = math.min(tonumber(ARGV[3]), remaining)
+    redis.call('INCRBY', KEYS[1], granted)
+    redis.call('EXPIRE', KEYS[1], ARGV[4])
+    redis.call('ZADD', KEYS[2], now + tonumber(ARGV[6]), ARGV[5] .. ':' .. granted)
+    redis.call('EXPIRE', KEYS[2], ARGV[4])
+    return granted
+    """
+
+    # ARGV: reservation id, reserved amount, actual tokens, ttl
+    SETTLE_SCRIPT = RELEASE_EXPIRED + """
+    local delta = tonumber(ARGV[3])
+    if redis.call('ZREM', KEYS[2], ARGV[1] .. ':' .. ARGV[2]) == 1 then
+        delta = delta - tonumber(ARGV[2])
+    end
+    if delta ~= 0 and redis.call('EXISTS', KEYS[1]) == 1 then
+        redis.call('INCRBY', KEYS[1], delta)
+        redis.call('EXPIRE', KEYS[1], ARGV[4])
+    end
+    return 0
+    """
+
+    # ARGV: database total, instance id, this instance's unflushed tokens, ttl, max report age
+    RECONCILE_SCRIPT = RELEASE_EXPIRED + """
+    redis.call('HSET', KEYS[3], ARGV[2], ARGV[3] .. ':' .. now)
+    redis.call('EXPIRE', KEYS[3], ARGV[4])
+    local value = redis.call('GET', KEYS[1])
+    if not value then
+        return false
+    end
+    local pending = 0
+    for _, member in ipairs(redis.call('ZRANGE', KEYS[2], 0, -1)) do
+        pending = pending + tonumber(string.match(member, ':(%d+)$'))
+    end
+    local reports = redis.call('HGETALL', KEYS[3])
+    for i = 1, #reports, 2 do
+        local tokens, at = string.match(reports[i + 1], '^(-?%d+):(%d+)$')
+        if tokens and now - tonumber(at) <= tonumber(ARGV[5]) then
+            pending = pending + tonumber(tokens)
+        else
+            redis.call('HDEL', KEYS[3], reports[i])
+        end
+    end
+    local drift = tonumber(ARGV[1]) + pending - tonumber(value)
+    if drift ~= 0 then
+        redis.call('SET', KEYS[1], tonumber(value) + drift, 'EX', ARGV[4])
+    end
+    return drift
+    """
+
+    def __init__(self, redis, prefix: str = "botai:usage", retry_after: float = 30.0,
+                 max_report_age: float = 900.0, **kwargs):
+        super().__init__(**kwargs)
+        self.redis = redis
+        self.prefix = prefix
+        self.retry_after = retry_after
+        self.max_report_age = max_report_age
+        self.instance_id = uuid.uuid4().hex
+        self.fallback = InMemoryUsageCounter(**kwargs)
+        self.fallback_calls = 0
+        self._redis_down_until = 0.0
+        self._reserve_script = redis.register_script(self.RESERVE_SCRIPT)
+        self._settle_script = redis.register_script(self.SETTLE_SCRIPT)
+        self._reconcile_script = redis.register_script(self.RECONCILE_SCRIPT)
+
+    async def _call(self, method: str, *args):
+        from redis.exceptions import RedisError
+        if time.monotonic() >= self._redis_down_until:
+            try:
+                return await getattr(self, f"_redis{method}")(*args)
+            except (RedisError, OSError) as e:
+                # Don't pay a connection timeout on every message while Redis is down
+                logger.warning(f"Redis unavailable for usage counters, using in-process fallback for {self.retry_after}s: {e}")
+                self._redis_down_until = time.monotonic() + self.retry_after
+        self.fallback_calls += 1
+        return await getattr(self.fallback, method)(*args)
+
+    async def _load(self, key: str) -> Optional[int]:
+        return await self._call('_load', key)
+
+    async def _seed(self, key: str, value: int, ttl: int) -> int:
+        return await self._call('_seed', key, value, ttl)
+
+    async def _reserve(self, key: str, limit: int, minimum: int, desired: int, ttl: int,
+                       reservation_id: str) -> int:
+        return await self._call('_reserve', key, limit, minimum, desired, ttl, reservation_id)
+
+    async def _settle(self, key: str, reservation_id: str, amount: int, actual: int, ttl: int) -> None:
+        await self._call('_settle', key, reservation_id, amount, actual, ttl)
+
+    async def _reconcile_to(self, key: str, database_total: int, unflushed: int, ttl: int) -> Optional[int]:
+        return await self._call('_reconcile_to', key, database_total, unflushed, ttl)
+
+    async def _redis_reserve(self, key: str, limit: int, minimum: int, desired: int, ttl: int,
+                             reservation_id: str) -> int:
+        return int(await self._reserve_script(
+            keys=[f"{self.prefix}:{key}", f"{self.prefix}:{key}:reservations"],
+            args=[limit, minimum, desired, ttl, reservation_id, int(self.reservation_ttl)]
+        ))
+
+    async def _redis_settle(self, key: str, reservation_id: str, amount: int, actual: int, ttl: int) -> None:
+        await self._settle_script(keys=[f"{self.prefix}:{key}", f"{self.prefix}:{key}:reservations"],
+                                  args=[reservation_id, amount, actual, ttl])
+
+    async def _redis_reconcile_to(self, key: str, database_total: int, unflushed: int, ttl: int) -> Optional[int]:
+        drift = await self._reconcile_script(
+            keys=[f"{self.prefix}:{key}", f"{self.prefix}:{key}:reservations", f"{self.prefix}:{key}:unflushed"],
+            args=[database_total, self.instance_id, unflushed, ttl, int(self.max_report_age)]
+        )
+        return None if drift is None else int(drift)
+
+    async def _redis_load(self, key: str) -> Optional[int]:
+        value = await self.redis.get(f"{self.prefix}:{key}")
+        return None if value is None else int(value)
+
+    async def _redis_seed(self, key: str, value: int, ttl: int) -> int:
+        # NX so concurrent seeds from several instances agree on one value
+        await self.redis.set(f"{self.prefix}:{key}", value, ex=ttl, nx=True)
+        return int(await self.redis.get(f"{self.prefix}:{key}") or value)
+
+    def stats(self) -> Dict[str, Any]:
+        return {**super().stats(), 'fallback_calls': self.fallback_calls}
+
+class UsageReconciler:
+    """Periodically corrects usage counters against usage_logs."""
+
+    def __init__(self, counter: UsageCounter, interval: float = 300.0):
+        self.counter = counter
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.counter.reconcile()
+            except Exception as e:
+                logger.error(f"Unexpected error reconciling usage counters: {e}")
+
+    def start(self) -> None:
+        """Starts the periodic reconciliation task."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Cancels the periodic reconciliation task."""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+def create_usage_counter() -> UsageCounter:
+    """Builds the counter selected by config.USAGE_COUNTER_BACKEND."""
+    if config.USAGE_COUNTER_BACKEND == "redis":
+        from backend.database import get_async_redis
+        # Reports from instances that missed three reconcile passes are ignored
+        return RedisUsageCounter(get_async_redis(), max_report_age=3 * config.USAGE_RECONCILE_INTERVAL,
+                                 reservation_ttl=config.USAGE_RESERVATION_TTL)
+    return InMemoryUsageCounter(reservation_ttl=config.USAGE_RESERVATION_TTL)
+
+usage_counter = create_usage_counter()
+usage_reconciler = UsageReconciler(usage_counter, interval=config.USAGE_RECONCILE_INTERVAL)
@@ -0,0 +1,245 @@
+import asyncio
+import json
+import logging
+import os
+import uuid
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+from postgrest import ReturnMethod
+from supabase import PostgrestAPIError
+
+import backend.config as config
+from backend.database import get_async_supabase
+
+logger = logging.getLogger(__name__)
+
+class UsageLogWriter:
+    """Write-behind buffer for usage_logs rows.
+
+    record() only appends to memory; a background task bulk-inserts the buffer
+    every flush_interval seconds, or sooner once batch_size rows are waiting.
+    Rows that cannot be written (Supabase down, or the buffer is full) are
+    appended to a local JSON-lines spill file and replayed on later flushes.
+    All file I/O runs in a worker thread from the flush task, never in record().
+    Each row carries a client-generated id and is upserted with
+    ignore_duplicates, so a replay after a partial failure never double-bills.
+    """
+
+    def __init__(self, flush_interval: float = 0.5, batch_size: int = 500,
+                 max_buffer: int = 10000, spill_path: Optional[str] = None):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_buffer = max_buffer
+        self.spill_path = spill_path
+        self.rows_recorded = 0
+        self.rows_written = 0
+        self.rows_spilled = 0
+        self.flushes = 0
+        self.errors = 0
+        self._buffer: List[Dict[str, Any]] = []
+        self._overflow: List[Dict[str, Any]] = []  # rows for the flush task to spill
+        self._pending: Dict[str, int] = defaultdict(int)  # subscription id -> tokens not yet in usage_logs
+        self._spill_rows = 0
+        self._wakeup = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    def record(self, subscription_id: str, tokens_used: int) -> None:
+        """Buffers one usage_logs row. Never blocks on the database."""
+        row = {
+            'id': str(uuid.uuid4()),
+            'subscription_id': subscription_id,
+            'total_tokens': tokens_used,
+            'created_at': datetime.now(timezone.utc).isoformat()
+        }
+        self._buffer.append(row)
+        self._pending[subscription_id] += tokens_used
+        self.rows_recorded += 1
+        if len(self._buffer) >= self.max_buffer:
+            # Keep memory bounded while the database is unreachable
+            self._overflow.extend(self._take(len(self._buffer)))
+            self._wakeup.set()
+        elif len(self._buffer) >= self.batch_size:
+            self._wakeup.set()
+
+    def pending_tokens(self, subscription_id: str) -> int:
+        """Tokens recorded for a subscription that are not in usage_logs yet."""
+        return self._pending.get(subscription_id, 0)
+
+    def _take(self, count: int) -> List[Dict[str, Any]]:
+        rows, self._buffer = self._buffer[:count], self._buffer[count:]
+        return rows
+
+    def _mark_written(self, rows: List[Dict[str, Any]]) -> None:
+        for row in rows:
+            self._pending[row['subscription_id']] -= row['total_tokens']
+            if self._pending[row['subscription_id']] <= 0:
+                del self._pending[row['subscription_id']]
+
+    def _append_spill(self, rows: List[Dict[str, Any]]) -> None:
+        with open(self.spill_path, 'a') as f:
+            for row in rows:
+                f.write(json.dumps(row) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    async def _spill(self, rows: List[Dict[str, Any]]) -> None:
+        if not rows:
+            return
+        if not self.spill_path:
+            logger.error(f"Dropping {len(rows)} usage_logs rows: no spill file configured")
+            self._mark_written(rows)
+            return
+        try:
+            await asyncio.to_thread(self._append_spill, rows)
+            self._spill_rows += len(rows)
+            self.rows_spilled += len(rows)
+            logger.warning(f"Spilled {len(rows)} usage_logs rows to {self.spill_path}")
+        except OSError as e:
+            logger.error(f"Error spilling usage_logs rows, {len(rows)} rows lost: {e}")
+            self._mark_written(rows)
+
+    def _read_spill_lines(self) -> List[str]:
+        if not self.spill_path or not os.path.exists(self.spill_path):
+            return []
+        with open(self.spill_path) as f:
+            return f.readlines()
+
+    def _parse_spill(self, lines: List[str]) -> List[Dict[str, Any]]:
+        rows = []
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                rows.append(json.loads(line))
+            except ValueError:
+                logger.error(f"Skipping corrupt line in {self.spill_path}")
+        return rows
+
+    def _truncate_spill(self, replayed: int) -> int:
+        """Drops the first `replayed` lines of the spill file. Returns the number of lines left."""
+        remaining = self._read_spill_lines()[replayed:]
+        if remaining:
+            with open(self.spill_path, 'w') as f:
+                f.writelines(remaining)
+        else:
+            os.remove(self.spill_path)
+        return len(remaining)
+
+    async def _insert(self, rows: List[Dict[str, Any]]) -> None:
+        supabase = await get_async_supabase()
+        for start in range(0, len(rows), self.batch_size):
+            await supabase.table('usage_logs') \
+                .upsert(rows[start:start + self.batch_size], on_conflict='id',
+                        ignore_duplicates=True, returning=ReturnMethod.minimal) \
+                .execute()
+
+    async def flush(self) -> int:
+        """Writes spilled rows, then buffered rows. Returns the number of rows written."""
+        async with self._lock:
+            if self._overflow:
+                rows, self._overflow = self._overflow, []
+                await self._spill(rows)
+
+            written = 0
+            if self._spill_rows:
+                lines = await asyncio.to_thread(self._read_spill_lines)
+                spilled = self._parse_spill(lines)
+                try:
+                    await self._insert(spilled)
+                except Exception as e:
+                    # Still unreachable: keep buffering in memory until max_buffer
+                    self.errors += 1
+                    logger.error(f"Error replaying spilled usage_logs rows: {e}")
+                    return 0
+                self._spill_rows = await asyncio.to_thread(self._truncate_spill, len(lines))
+                self._mark_written(spilled)
+                written += len(spilled)
+
+            rows = self._take(len(self._buffer))
+            if rows:
+                try:
+                    await self._insert(rows)
+                    self._mark_written(rows)
+                    written += len(rows)
+                except PostgrestAPIError as e:
+                    self.errors += 1
+                    logger.error(f"Database error writing usage_logs batch: {e}")
+                    await self._spill(rows)
+                except Exception as e:
+                    self.errors += 1
+                    logger.error(f"Unexpected error writing usage_logs batch: {e}")
+                    await self._spill(rows)
+
+            if written:
+                self.flushes += 1
+                self.rows_written += written
+                logger.info(f"Wrote {written} usage_logs rows")
+            return written
+
+    async def _load_spill(self) -> None:
+        """Counts rows left in the spill file by a previous process as pending."""
+        lines = await asyncio.to_thread(self._read_spill_lines)
+        spilled = self._parse_spill(lines)
+        for row in spilled:
+            self._pending[row['subscription_id']] += row['total_tokens']
+        self._spill_rows = len(lines)
+        if spilled:
+            logger.info(f"Found {len(spilled)} spilled usage_logs rows to replay")
+
+    async def _run(self) -> None:
+        async with self._lock:
+            await self._load_spill()
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                self.errors += 1
+                logger.error(f"Unexpected error flushing usage_logs: {e}")
+
+    def start(self) -> None:
+        """Replays any spill file and starts the periodic flush task."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stops the flush task and writes (or spills) everything still buffered."""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+        # Whatever could not reach the database survives the restart on disk
+        async with self._lock:
+            await self._spill(self._overflow + self._take(len(self._buffer)))
+            self._overflow = []
+
+    def stats(self) -> Dict[str, Any]:
+        """Writer counters for the /metrics endpoint."""
+        return {
+            'buffered_rows': len(self._buffer) + len(self._overflow),
+            'spilled_rows': self._spill_rows,
+            'rows_recorded': self.rows_recorded,
+            'rows_written': self.rows_written,
+            'rows_spilled': self.rows_spilled,
+            'flushes': self.flushes,
+            'errors': self.errors
+        }
+
+usage_writer = UsageLogWriter(
+    flush_interval=config.USAGE_FLUSH_INTERVAL_MS / 1000,
+    batch_size=config.USAGE_FLUSH_BATCH_SIZE,
+    max_buffer=config.USAGE_BUFFER_MAX_ROWS,
+    spill_path=config.USAGE_SPILL_PATH or None
+)
@@ -0,0 +1,197 @@
+import asyncio
+import hashlib
+import hmac
+import logging
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, Optional
+
+from supabase import PostgrestAPIError
+
+import backend.config as config
+from backend.database import get_async_supabase, select_all
+
+logger = logging.getLogger(__name__)
+
+@dataclass
+class WebhookRoute:
+    bot_token: str
+    secret: str
+    bot_id: Optional[str] = None
+    company_id: Optional[str] = None
+
+class WebhookRouter:
+    """In-memory routing table for per-bot Telegram webhooks.
+
+    Each bot is registered at /webhook/telegram/{webhook_id} with its own
+    secret_token, so the bot token never appears in URLs or access logs and
+    one leaked secret only exposes one bot. Both values are derived from the
+    bot token with HMAC-SHA256 under `key`: nothing extra is stored in the
+    bots table, and any instance can compute them. Without a key the router
+    is disabled: it routes nothing and refuses to derive ids or secrets.
+
+    The table (webhook id -> token and secret) is loaded from the bots table
+    at startup and refreshed incrementally: rows whose updated_at is at or
+    past the last watermark, plus an id-only listing to drop deleted bots.
+    An unknown id triggers an early refresh (at most every miss_refresh_interval
+    seconds) for bots registered by another instance.
+    """
+
+    def __init__(self, key: Optional[str], interval: float = 60.0, miss_refresh_interval: float = 5.0):
+        self._key = key.encode() if key else None
+        self.interval = interval
+        self.miss_refresh_interval = miss_refresh_interval
+        self.watermark: Optional[str] = None
+        self.lookups = 0
+        self.misses = 0
+        self.rejected = 0
+        self.refreshes = 0
+        self.errors = 0
+        self._routes: Dict[str, WebhookRoute] = {}
+        self._ids_by_bot: Dict[str, str] = {}
+        self._last_refresh = 0.0
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self._key is not None
+
+    def _derive(self, purpose: str, token: str) -> str:
+        if self._key is None:
+            raise ValueError("TELEGRAM_WEBHOOK_KEY (or TELEGRAM_WEBHOOK_SECRET) is not set")
+        return hmac.new(self._key, f"{purpose}:{token}".encode(), hashlib.sha256).hexdigest()
+
+    def webhook_id(self, token: str) -> str:
+        """Opaque path segment for a bot's webhook URL."""
+        return self._derive("webhook-id", token)[:32]
+
+    def secret(self, token: str) -> str:
+        """The bot's secret_token (Telegram allows A-Z, a-z, 0-9, _ and -, up to 256 characters)."""
+        return self._derive("webhook-secret", token)
+
+    def add(self, token: str, bot_id: Optional[str] = None, company_id: Optional[str] = None) -> WebhookRoute:
+        """Adds or updates the route for a bot."""
+        route = WebhookRoute(bot_token=token, secret=self.secret(token), bot_id=bot_id, company_id=company_id)
+        webhook_id = self.webhook_id(token)
+        if bot_id:
+            previous = self._ids_by_bot.get(bot_id)
+            if previous and previous != webhook_id:
+                self._routes.pop(previous, None)  # the bot's token was changed
+            self._ids_by_bot[bot_id] = webhook_id
+        self._routes[webhook_id] = route
+        return route
+
+    def remove(self, bot_id: Optional[str] = None, token: Optional[str] = None) -> None:
+        """Drops the route for a deleted bot."""
+        webhook_id = self._ids_by_bot.pop(bot_id, None) if bot_id else None
+        if token and self.enabled:
+            webhook_id = self.webhook_id(token)
+        if webhook_id:
+            self._routes.pop(webhook_id, None)
+
+    async def resolve(self, webhook_id: str, secret: Optional[str]) -> Optional[WebhookRoute]:
+        """The route for a request, or None if the id is unknown or the secret does not match."""
+        self.lookups += 1
+        if not self.enabled:
+            self.rejected += 1
+            return None
+        route = self._routes.get(webhook_id)
+        if route is None:
+            self.misses += 1
+            if time.monotonic() - self._last_refresh >= self.miss_refresh_interval:
+                self._last_refresh = time.monotonic()  # concurrent misses wait for the next window
+                await self.load()
+                route = self._routes.get(webhook_id)
+            if route is None:
+                return None
+        if not secret or not hmac.compare_digest(secret, route.secret):
+            self.rejected += 1
+            return None
+        return route
+
+    async def refresh(self) -> int:
+        """Applies bots changed since the last refresh. Returns the number of routes changed."""
+        if not self.enabled:
+            return 0
+        async with self._lock:
+            self._last_refresh = time.monotonic()
+            supabase = await get_async_supabase()
+
+            def changed_bots():
+                query = supabase.table('bots') \
+                    .select('id, company_id, token, updated_at') \
+                    .eq('platform', 'telegram') \
+                    .order('id')
+                if self.watermark:
+                    # Rows at the watermark are re-read; adding a route twice is a no-op
+                    query = query.gte('updated_at', self.watermark)
+                return query
+
+            rows = await select_all(changed_bots)
+            for row in rows:
+                if row.get('token'):
+                    self.add(row['token'], bot_id=str(row['id']), company_id=row.get('company_id'))
+                else:
+                    self.remove(bot_id=str(row['id']))
+            if self.refreshes:
+                listing = await select_all(
+                    lambda: supabase.table('bots').select('id').eq('platform', 'telegram').order('id')
+                )
+                existing = {str(row['id']) for row in listing}
+                for bot_id in [bot_id for bot_id in self._ids_by_bot if bot_id not in existing]:
+                    self.remove(bot_id=bot_id)
+            # The watermark comes from the database's clock, never this machine's
+            stamps = [row['updated_at'] for row in rows if row.get('updated_at')]
+            if stamps:
+                self.watermark = max(stamps + ([self.watermark] if self.watermark else []))
+            self.refreshes += 1
+            return len(rows)
+
+    async def load(self) -> None:
+        """Refreshes the table, logging failures (the routes already loaded stay in use)."""
+        try:
+            changed = await self.refresh()
+            if changed:
+                logger.info(f"Refreshed webhook routes: {changed} bots changed, {len(self._routes)} routes")
+        except PostgrestAPIError as e:
+            self.errors += 1
+            logger.error(f"Database error refreshing webhook routes: {e}")
+        except Exception as e:
+            self.errors += 1
+            logger.error(f"Unexpected error refreshing webhook routes: {e}")
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.load()
+
+    def start(self) -> None:
+        """Starts the periodic refresh task (call load() first for the initial table)."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Cancels the periodic refresh task."""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def stats(self) -> Dict[str, Any]:
+        """Routing counters for the /metrics endpoint."""
+        return {
+            'enabled': self.enabled,
+            'routes': len(self._routes),
+            'watermark': self.watermark,
+            'lookups': self.lookups,
+            'misses': self.misses,
+            'rejected': self.rejected,
+            'refreshes': self.refreshes,
+            'errors': self.errors
+        }
+
+webhook_router = WebhookRouter(
+    config.TELEGRAM_WEBHOOK_KEY,
+    interval=config.WEBHOOK_ROUTES_REFRESH_INTERVAL
+)
@@ -1,13 +1,18 @@
 #!/usr/bin/env python3
 """
 Webhook Fix Script
-Fixes all existing bots by setting their webhooks to the production Render URL
+Fixes all existing bots by setting their webhooks to the production Render URL.
+Bots move to their per-bot webhook (/webhook/telegram/{id} with their own secret
+token), which the backend derives from TELEGRAM_WEBHOOK_KEY.
 """
 
 import requests
 import sys
 from typing import List, Dict
 
+# One keep-alive session for every Bot API call instead of a new connection per request
+session = requests.Session()
+
 # Bot tokens from database
 BOTS = [
     {
@@ -25,17 +30,29 @@ BOTS = [
 ]
 
 def set_webhook(bot_token: str, backend_url: str) -> Dict:
-    """Set webhook for a Telegram bot"""
-    webhook_url = f"{backend_url}/webhook/{bot_token}"
-    api_url = f"https://api.telegram.org/bot{bot_token}/setWebhook"
-
-    response = requests.post(api_url, json={"url": webhook_url})
-    return response.json()
+    """Set the per-bot webhook for a Telegram bot through the backend's /api/webhooks/setup"""
+    response = session.post(f"{backend_url}/api/webhooks/setup",
+                            params={"platform": "telegram", "bot_token": bot_token})
+    if response.status_code != 200:
+        return {"ok": False, "description": f"Backend returned {response.status_code}: {response.text}"}
+    setup = response.json()
+
+    if setup.get("status") == "manual":
+        # Non-production backend: it only returns the URL and secret, so register them here
+        api_url = f"https://api.telegram.org/bot{bot_token}/setWebhook"
+        result = session.post(api_url, json={
+            "url": setup["webhook_url"],
+            "secret_token": setup["secret_token"]
+        }).json()
+    else:
+        result = {"ok": True}
+    result["webhook_url"] = setup["webhook_url"]
+    return result
 
 def get_webhook_info(bot_token: str) -> Dict:
     """Get current webhook info for a bot"""
     api_url = f"https://api.telegram.org/bot{bot_token}/getWebhookInfo"
-    response = requests.get(api_url)
+    response = session.get(api_url)
     return response.json()
 
 def main():
@@ -77,7 +94,7 @@ def main():
 
         if result.get('ok'):
             print(f"    ✅ Webhook set successfully!")
-            new_url = f"{backend_url}/webhook/{bot['token']}"
+            new_url = result['webhook_url']
             print(f"    New webhook: {new_url}")
             results.append({
                 "bot": bot['name'],
@@ -26,4 +26,7 @@ ON subscriptions(plan_id);
 -- Partial index for companies with whatsapp (for future WhatsApp integration)
 CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_companies_whatsapp_identifier 
 ON companies(whatsapp_identifier) 
-WHERE whatsapp_identifier IS NOT NULL;
\ No newline at end of file
+WHERE whatsapp_identifier IS NOT NULL;
+-- Index for the backend's knowledge base reconciler (rows changed since a watermark)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_knowledge_bases_company_updated_at
+ON knowledge_bases(company_id, updated_at DESC);
@@ -219,12 +219,41 @@ AS $$
     SELECT NOW();
 $$;
 
+-- 8. INCREMENT_MESSAGE_COUNTS Function
+-- Batched increment_message_count: one call applies many (bot, user) deltas (backend analytics sink)
+CREATE OR REPLACE FUNCTION increment_message_counts(p_counts JSONB)
+RETURNS INTEGER
+LANGUAGE plpgsql
+SECURITY DEFINER
+AS $$
+DECLARE
+    updated_rows INTEGER;
+BEGIN
+    INSERT INTO conversations (bot_id, user_id, message_count, last_message_at)
+    SELECT
+        (c->>'bot_id')::UUID,
+        c->>'user_id',
+        (c->>'count')::INTEGER,
+        (c->>'last_message_at')::TIMESTAMP WITH TIME ZONE
+    FROM jsonb_array_elements(p_counts) AS c
+    ON CONFLICT (bot_id, user_id)
+    DO UPDATE SET
+        message_count = conversations.message_count + EXCLUDED.message_count,
+        last_message_at = GREATEST(conversations.last_message_at, EXCLUDED.last_message_at),
+        updated_at = NOW();
+
+    GET DIAGNOSTICS updated_rows = ROW_COUNT;
+    RETURN updated_rows;
+END;
+$$;
+
 -- Grant necessary permissions
 -- These functions can be called by authenticated users
 GRANT EXECUTE ON FUNCTION get_total_usage TO authenticated;
 GRANT EXECUTE ON FUNCTION log_usage TO authenticated;
 GRANT EXECUTE ON FUNCTION get_user_metrics TO authenticated;
 GRANT EXECUTE ON FUNCTION increment_message_count TO authenticated;
+GRANT EXECUTE ON FUNCTION increment_message_counts TO authenticated;
 GRANT EXECUTE ON FUNCTION get_recent_activities TO authenticated;
 GRANT EXECUTE ON FUNCTION ensure_user_company TO authenticated;
 GRANT EXECUTE ON FUNCTION now TO anon, authenticated;
@@ -233,6 +262,7 @@ COMMENT ON FUNCTION get_total_usage IS 'Calculate total token usage for a subscr
 COMMENT ON FUNCTION log_usage IS 'Log token usage for billing tracking';
 COMMENT ON FUNCTION get_user_metrics IS 'Get dashboard metrics for a company';
 COMMENT ON FUNCTION increment_message_count IS 'Increment message count for bot conversations';
+COMMENT ON FUNCTION increment_message_counts IS 'Increment message counts for many bot conversations at once';
 COMMENT ON FUNCTION get_recent_activities IS 'Get recent activities for dashboard display';
 COMMENT ON FUNCTION ensure_user_company IS 'Ensure user has a company, create if needed';
 COMMENT ON FUNCTION now IS 'Get current timestamp (for connection testing)';
\ No newline at end of file